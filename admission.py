@@ -0,0 +1,116 @@
+"""
+Admission control for the recognition path.
+
+At most `limit` recognitions run at once. Up to `queue_length` more wait for
+a slot, first come first served, for at most the wait deadline. Anything
+beyond that is turned away at once with Busy, which carries a retry-after
+estimate. A burst, such as a whole class logging in together, then queues
+briefly or is asked to retry. Every session no longer starts its own model
+run and slows all of them down.
+"""
+
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
+
+# Wait and service times kept for the metrics panel
+RECENT_LIMIT = 500
+
+
+class Busy(Exception):
+    """Recognition is at capacity; retry after `retry_after` seconds"""
+
+    def __init__(self, retry_after, reason):
+        super().__init__(f"busy ({reason}), retry in {retry_after} s")
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class AdmissionController:
+    """Bounded concurrency with a bounded, deadline-limited FIFO queue"""
+
+    def __init__(self, limit, queue_length, deadline_ms):
+        self.limit = max(1, limit)
+        self.queue_length = max(0, queue_length)
+        self.deadline = deadline_ms / 1000.0
+        self._lock = threading.Lock()
+        self._running = 0
+        self._waiting = deque()
+        self._waits = deque(maxlen=RECENT_LIMIT)
+        self._service = deque(maxlen=RECENT_LIMIT)
+        self._counters = {'admitted': 0, 'queued': 0, 'rejected_full': 0, 'rejected_deadline': 0, 'max_waiting': 0}
+
+    def _retry_after(self):
+        """Seconds until the queue ahead should have drained (caller holds the lock)"""
+        service = float(np.mean(self._service)) if self._service else 1.0
+        return max(1, math.ceil(service * (len(self._waiting) + 1) / self.limit))
+
+    @contextmanager
+    def slot(self):
+        """Run the block in a recognition slot; raises Busy instead of queueing past the limits"""
+        waited = self._acquire()
+        start = time.perf_counter()
+        try:
+            yield waited
+        finally:
+            self._release(time.perf_counter() - start)
+
+    def _acquire(self):
+        with self._lock:
+            if self._running < self.limit and not self._waiting:
+                self._running += 1
+                self._counters['admitted'] += 1
+                self._waits.append(0.0)
+                return 0.0
+            if len(self._waiting) >= self.queue_length:
+                self._counters['rejected_full'] += 1
+                raise Busy(self._retry_after(), "queue full")
+
+            ticket = threading.Event()
+            self._waiting.append(ticket)
+            self._counters['queued'] += 1
+            self._counters['max_waiting'] = max(self._counters['max_waiting'], len(self._waiting))
+
+        start = time.perf_counter()
+        ticket.wait(self.deadline)
+        with self._lock:
+            # A slot handed over just as the deadline passed is still taken
+            if not ticket.is_set():
+                self._waiting.remove(ticket)
+                self._counters['rejected_deadline'] += 1
+                raise Busy(self._retry_after(), "wait deadline passed")
+            waited = time.perf_counter() - start
+            self._counters['admitted'] += 1
+            self._waits.append(waited)
+            return waited
+
+    def _release(self, service_seconds):
+        with self._lock:
+            self._service.append(service_seconds)
+            if self._waiting:
+                # Hand the slot straight to the oldest waiter, so newcomers can't jump the queue
+                self._waiting.popleft().set()
+            else:
+                self._running -= 1
+
+    def metrics(self):
+        """Admissions, rejections by cause, queue-wait and service times, current load"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['running'] = self._running
+            stats['waiting'] = len(self._waiting)
+            waits = list(self._waits)
+            service = list(self._service)
+
+        stats.update(limit=self.limit, queue_length=self.queue_length, deadline_ms=self.deadline * 1000)
+        requests = stats['admitted'] + stats['rejected_full'] + stats['rejected_deadline']
+        stats['rejection_rate'] = (stats['rejected_full'] + stats['rejected_deadline']) / requests if requests else 0.0
+        if waits:
+            stats['mean_wait_ms'] = float(np.mean(waits)) * 1000
+            stats['p95_wait_ms'] = float(np.percentile(waits, 95)) * 1000
+        if service:
+            stats['mean_service_ms'] = float(np.mean(service)) * 1000
+        return stats
@@ -0,0 +1,110 @@
+import numpy as np
+
+
+class IVFIndex:
+    """
+    Inverted-file (IVF) approximate nearest-neighbour index for unit-length
+    embeddings, written in plain NumPy.
+
+    Embeddings are bucketed under their closest k-means centroid. A query
+    only visits the `nprobe` closest buckets, and the owning Gallery scores
+    those candidates exactly. `nlist` and `nprobe` trade recall for latency:
+    more buckets means smaller buckets, more probes means higher recall.
+    """
+
+    def __init__(self, nlist=None, nprobe=8, iterations=10, seed=0):
+        self.nlist = nlist  # None picks sqrt(N) at training time
+        self.nprobe = nprobe
+        self.iterations = iterations
+        self.seed = seed
+        self.centroids = None
+        self.trained_size = 0
+        self._buckets = []
+        self._where = {}
+
+    def __len__(self):
+        return len(self._where)
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def fresh(self):
+        """An untrained index with the same settings, to train on the side and swap in"""
+        return IVFIndex(nlist=self.nlist, nprobe=self.nprobe, iterations=self.iterations, seed=self.seed)
+
+    def _assign(self, vectors, block_size=4096):
+        """Closest centroid for each row, computed in blocks to bound memory"""
+        assignments = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), block_size):
+            block = vectors[start:start + block_size]
+            assignments[start:start + block_size] = np.argmax(block @ self.centroids.T, axis=1)
+        return assignments
+
+    def train(self, keys, vectors):
+        """Cluster the vectors with spherical k-means and bucket every key"""
+        count = len(keys)
+        if count == 0:
+            return
+
+        nlist = min(self.nlist or max(1, int(np.sqrt(count))), count)
+        rng = np.random.default_rng(self.seed)
+
+        # Train on a bounded sample, ~64 points per centroid is plenty
+        sample_size = min(count, nlist * 64)
+        sample = np.asarray(vectors[np.sort(rng.choice(count, size=sample_size, replace=False))], dtype=np.float32)
+        self.centroids = sample[rng.choice(sample_size, size=nlist, replace=False)].copy()
+
+        for _ in range(self.iterations):
+            assignments = self._assign(sample)
+            order = np.argsort(assignments, kind='stable')
+            clusters, starts = np.unique(assignments[order], return_index=True)
+            sums = np.add.reduceat(sample[order], starts, axis=0)
+
+            centroids = sample[rng.choice(sample_size, size=nlist)].copy()  # re-seed empty buckets
+            centroids[clusters] = sums
+            norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+            self.centroids = centroids / np.maximum(norms, 1e-12)
+
+        self._buckets = [[] for _ in range(nlist)]
+        self._where = {}
+        for key, bucket in zip(keys, self._assign(vectors)):
+            self._insert(key, int(bucket))
+        self.trained_size = count
+
+    def _insert(self, key, bucket):
+        self._where[key] = (bucket, len(self._buckets[bucket]))
+        self._buckets[bucket].append(key)
+
+    def add(self, key, vector):
+        """Insert or move a key; ignored until the index has been trained"""
+        if not self.is_trained:
+            return
+
+        self.remove(key)
+        self._insert(key, int(np.argmax(self.centroids @ vector)))
+
+    def remove(self, key):
+        """Remove a key in O(1) by swapping it with the last key in its bucket"""
+        location = self._where.pop(key, None)
+        if location is None:
+            return False
+
+        bucket, slot = location
+        members = self._buckets[bucket]
+        last = members.pop()
+        if slot < len(members):
+            members[slot] = last
+            self._where[last] = (bucket, slot)
+        return True
+
+    def candidates(self, query):
+        """Keys stored in the `nprobe` buckets closest to the query"""
+        scores = self.centroids @ query
+        nprobe = min(self.nprobe, len(scores))
+        probes = np.argpartition(-scores, nprobe - 1)[:nprobe]
+
+        keys = []
+        for bucket in probes:
+            keys.extend(self._buckets[bucket])
+        return keys
@@ -5,8 +5,10 @@ import clear
 import home as home
 import register as register
 import login
+import attendance
 import reports
 import graphs
+import models
 
 # Page configuration
 st.set_page_config(
@@ -16,6 +18,9 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Build the face models in the background so the first login doesn't stall
+models.start_warm_up()
+
 # Custom CSS for better styling
 st.markdown("""
     <style>
@@ -38,10 +43,11 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # Create tabs
-homeTab, registerTab, loginTab, reportsTab, graphsTab, clearTab = st.tabs([
+homeTab, registerTab, loginTab, attendanceTab, reportsTab, graphsTab, clearTab = st.tabs([
     "🏠 Home",
     "📝 Register Student", 
     "🔐 Student Login",
+    "📋 Attendance",
     "📊 Reports",
     "📈 Graphs",
     "🗑️ Clear Data"
@@ -56,6 +62,9 @@ with registerTab:
 with loginTab:
     login.login()
 
+with attendanceTab:
+    attendance.attendance()
+
 with reportsTab:
     reports.reports()
 
@@ -0,0 +1,61 @@
+"""
+Archival of graduated or inactive students into a cold partition.
+
+Archived students leave the hot gallery used by every login and the user
+data read by every report. Their records, photos and embeddings move under
+ARCHIVE_FOLDER. From there, Reports can still list them and search them by
+face on demand (see image.search_archive).
+"""
+
+import pandas as pd
+import image
+from db import Database
+from dropbox_utils import get_dropbox_client, archive_user_files_in_dropbox
+
+
+def admission_years(df):
+    """Years present in the admission_date column"""
+    if 'admission_date' not in df.columns:
+        return []
+    years = pd.to_datetime(df['admission_date'], errors='coerce').dt.year.dropna()
+    return sorted(int(year) for year in years.unique())
+
+
+def select_students(df, classes=(), years=(), user_ids=()):
+    """IDs of the students in any of the classes, admitted in any of the years, or listed explicitly"""
+    selected = pd.Series(False, index=df.index)
+    if classes and 'class' in df.columns:
+        selected |= df['class'].astype(str).isin([str(c) for c in classes])
+    if years and 'admission_date' in df.columns:
+        selected |= pd.to_datetime(df['admission_date'], errors='coerce').dt.year.isin(list(years))
+    if user_ids:
+        selected |= df['id'].isin([int(user_id) for user_id in user_ids])
+    return [int(user_id) for user_id in df.loc[selected, 'id']]
+
+
+def archive_students(user_ids):
+    """
+    Move students to the archive: embeddings first (so nothing has to be
+    re-embedded), then photos, then records. Returns (archived, failed,
+    unrecorded) ID lists. Unrecorded students are among the failed ones:
+    their photos moved but their records could not. Archiving them again
+    finishes the move, since every step skips what is already done.
+    """
+    dbx = get_dropbox_client()
+    if not dbx or not user_ids:
+        return [], list(user_ids), []
+
+    if not image.archive_gallery_entries(dbx, user_ids):
+        return [], list(user_ids), []
+
+    archived, failed = [], []
+    for user_id in user_ids:
+        (archived if archive_user_files_in_dropbox(dbx, user_id) else failed).append(user_id)
+
+    if not archived:
+        return archived, failed, []
+    image.remove_gallery_entries(dbx, archived)
+    # Reports its own errors; the photos have moved either way
+    if not Database().archive_users(archived):
+        return [], failed + archived, archived
+    return archived, failed, []
@@ -0,0 +1,179 @@
+import streamlit as st
+import numpy as np
+import pandas as pd
+import admission
+import image
+from db import Database
+from dropbox_utils import get_dropbox_client
+from PIL import Image, ImageDraw
+
+
+def assign_faces(distances, threshold):
+    """
+    One-to-one assignment of faces (rows) to students (columns).
+    Pairs are taken greedily from the closest distance upwards, so a student
+    is claimed by at most one face and each face by at most one student.
+    Returns a list of (face_index, student_index, distance).
+    """
+    if distances.size == 0:
+        return []
+
+    faces, students = np.nonzero(distances < threshold)
+    order = np.argsort(distances[faces, students], kind='stable')
+
+    assignments = []
+    used_faces, used_students = set(), set()
+    for i in order:
+        face, student = int(faces[i]), int(students[i])
+        if face in used_faces or student in used_students:
+            continue
+        used_faces.add(face)
+        used_students.add(student)
+        assignments.append((face, student, float(distances[face, student])))
+    return assignments
+
+
+def take_attendance(dbx, images, roster_ids=None):
+    """
+    Recognise every face in one or more classroom photos.
+    `images` are decoded RGB arrays; `roster_ids` optionally limits who is
+    expected (e.g. one class) and therefore who can be marked absent.
+    Returns a dict with 'present' [(user_id, distance)], 'absent' [user_id]
+    and 'unknown' [(image_index, facial_area)], plus the detected 'faces'.
+    Runs in one recognition slot, taken after the gallery sync; raises
+    admission.Busy when none frees up in time.
+    """
+    image.prepare_search(dbx)
+    faces = []
+    with image.recognition_slot():
+        for image_index, img in enumerate(images):
+            for face in image.embed_all_faces(img):
+                face['image_index'] = image_index
+                faces.append(face)
+
+        user_ids, distances = image.gallery_distance_matrix(dbx, [face['embedding'] for face in faces], sync=False)
+
+    if roster_ids is not None:
+        roster = {str(uid) for uid in roster_ids}
+        columns = [i for i, uid in enumerate(user_ids) if uid in roster]
+        user_ids = [user_ids[i] for i in columns]
+        distances = distances[:, columns]
+    else:
+        roster = set(user_ids)
+
+    assignments = assign_faces(distances, image.MATCH_THRESHOLD)
+    matched_faces = {face for face, _, _ in assignments}
+
+    present = sorted(((user_ids[student], distance) for _, student, distance in assignments), key=lambda p: p[1])
+    present_ids = {user_id for user_id, _ in present}
+
+    for face_index, student, distance in assignments:
+        faces[face_index]['user_id'] = user_ids[student]
+        faces[face_index]['distance'] = distance
+
+    return {
+        'present': present,
+        'absent': sorted(roster - present_ids, key=lambda uid: int(uid) if uid.isdigit() else uid),
+        'unknown': [(face['image_index'], face['facial_area']) for i, face in enumerate(faces) if i not in matched_faces],
+        'faces': faces
+    }
+
+
+def _annotate(img, faces, image_index):
+    """Draw recognised (green) and unknown (red) faces on a classroom photo"""
+    annotated = Image.fromarray(img)
+    draw = ImageDraw.Draw(annotated)
+    for face in faces:
+        if face['image_index'] != image_index:
+            continue
+        area = face['facial_area']
+        colour = (0, 200, 0) if 'user_id' in face else (220, 0, 0)
+        draw.rectangle([area['x'], area['y'], area['x'] + area['w'], area['y'] + area['h']], outline=colour, width=3)
+        if 'user_id' in face:
+            draw.text((area['x'], max(area['y'] - 12, 0)), f"ID {face['user_id']}", fill=colour)
+    return annotated
+
+
+def attendance():
+    st.markdown("""
+        <style>
+        .attendance-header {
+            background: linear-gradient(135deg, #43e97b 0%, #38f9d7 100%);
+            padding: 20px;
+            border-radius: 10px;
+            color: white;
+            text-align: center;
+            margin-bottom: 20px;
+        }
+        </style>
+    """, unsafe_allow_html=True)
+
+    st.markdown("""
+        <div class="attendance-header">
+            <h2 style="margin:0;">📋 Classroom Attendance</h2>
+            <p style="margin:5px 0 0 0;">Recognise a whole class from one group photo</p>
+        </div>
+    """, unsafe_allow_html=True)
+
+    db = Database()
+    df = db.get_all_students()
+
+    classes = sorted(df['class'].dropna().unique().tolist()) if 'class' in df.columns else []
+    selected_class = st.selectbox("Class", ["All Students"] + classes, key="attendanceClass")
+
+    photos = st.file_uploader(
+        "Upload classroom photo(s)",
+        type=["jpg", "jpeg", "png"],
+        accept_multiple_files=True,
+        key="attendanceUpload"
+    )
+
+    if not photos or not st.button("✅ Take Attendance", key="attendanceRun"):
+        st.info("📸 Upload one or more photos where every student's face is visible")
+        return
+
+    dbx = get_dropbox_client()
+    if not dbx:
+        st.error("Could not connect to Dropbox")
+        return
+
+    roster_ids = None
+    if selected_class != "All Students":
+        roster_ids = [str(int(uid)) for uid in df.loc[df['class'] == selected_class, 'id']]
+
+    with st.spinner("🔍 Recognising faces..."):
+        try:
+            images = [image.decode_image(photo.getvalue()) for photo in photos]
+            result = take_attendance(dbx, images, roster_ids)
+        except admission.Busy as busy:
+            st.warning(f"⏳ Face recognition is busy, please try again in {busy.retry_after} s")
+            return
+        except Exception as e:
+            st.error(f"Error taking attendance: {e}")
+            return
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("✅ Present", len(result['present']))
+    with col2:
+        st.metric("❌ Absent", len(result['absent']))
+    with col3:
+        st.metric("❓ Unknown Faces", len(result['unknown']))
+
+    for image_index, img in enumerate(images):
+        st.image(_annotate(img, result['faces'], image_index), caption=f"Photo {image_index + 1}", use_column_width=True)
+
+    names = {str(int(row['id'])): row.get('name', '') for _, row in df.iterrows()}
+    records = (
+        [{'id': uid, 'name': names.get(uid, ''), 'status': 'Present', 'distance': round(dist, 3)} for uid, dist in result['present']]
+        + [{'id': uid, 'name': names.get(uid, ''), 'status': 'Absent', 'distance': None} for uid in result['absent']]
+    )
+    report = pd.DataFrame(records, columns=['id', 'name', 'status', 'distance'])
+    st.dataframe(report, use_container_width=True)
+
+    st.download_button(
+        label="📄 Download Attendance (CSV)",
+        data=report.to_csv(index=False),
+        file_name=f"attendance_{pd.Timestamp.now().strftime('%Y%m%d_%H%M')}.csv",
+        mime="text/csv"
+    )
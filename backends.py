@@ -0,0 +1,204 @@
+import numpy as np
+import detection
+import models
+from config import RECOGNITION_BACKEND, RECOGNITION_MODEL
+
+
+class RecognitionBackend:
+    """
+    One way of turning photos into comparable face embeddings.
+    Subclasses provide detect() and embed(); distance() and the default
+    match threshold follow from `metric` and `threshold`.
+    """
+
+    name = None
+    model_name = None
+    metric = 'cosine'
+    threshold = None
+    # Whether aligned face crops can be stored and re-embedded without detection
+    stores_crops = False
+    # How faces are cut before embedding; embeddings only compare within one version
+    preprocessing = None
+
+    def available(self):
+        """True if the backend's libraries and models can be loaded here"""
+        raise NotImplementedError
+
+    def detect(self, image):
+        """
+        Every face in a decoded RGB array, as a list of
+        {'facial_area', 'confidence', 'face'} dicts where 'face' is the crop embed() expects
+        """
+        raise NotImplementedError
+
+    def embed(self, faces):
+        """Embeddings of the crops from detect(), None where a crop could not be embedded"""
+        raise NotImplementedError
+
+    def primary_face(self, image):
+        """The detect() result to embed for a single-person photo, or None"""
+        faces = self.detect(image)
+        if not faces:
+            return None
+        # The largest face is the one closest to the camera
+        return max(faces, key=lambda f: f['facial_area']['w'] * f['facial_area']['h'])
+
+    def embed_image(self, image):
+        """Embedding of the most prominent face in a decoded RGB array, or None"""
+        face = self.primary_face(image)
+        if face is None:
+            return None
+        return self.embed([face])[0]
+
+    def distance(self, a, b):
+        """Distance between two embeddings under the backend's metric"""
+        a = np.asarray(a, dtype=np.float32).ravel()
+        b = np.asarray(b, dtype=np.float32).ravel()
+        if self.metric == 'cosine':
+            return float(1.0 - a @ b / (np.linalg.norm(a) * np.linalg.norm(b)))
+        return float(np.linalg.norm(a - b))
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.model_name!r})"
+
+
+class ModelBackend(RecognitionBackend):
+    """Backends run by models.py, behind the shared detection cascade in detection.py"""
+
+    stores_crops = True
+    preprocessing = detection.CROP_VERSION
+
+    def available(self):
+        raise NotImplementedError
+
+    def detect(self, image):
+        return detection.detect(image)
+
+    def embed(self, faces):
+        if not faces:
+            return []
+        return list(models.embed_face_batch([face['face'] for face in faces]))
+
+    def primary_face(self, image):
+        face = super().primary_face(image)
+        if face is None:
+            # Like enforce_detection=False, fall back to the whole frame
+            face = {'face': image.astype(np.float32) / 255.0}
+        return face
+
+
+class DeepFaceBackend(ModelBackend):
+    """DeepFace recognition models (TensorFlow)"""
+
+    name = 'deepface'
+
+    # Cosine thresholds DeepFace.verify uses for these models
+    THRESHOLDS = {
+        'VGG-Face': 0.68,
+        'Facenet512': 0.30,
+        'ArcFace': 0.68,
+        'SFace': 0.593
+    }
+
+    def __init__(self, model_name='VGG-Face'):
+        if model_name not in self.THRESHOLDS:
+            raise ValueError(f"Unsupported DeepFace model: {model_name}")
+        self.model_name = model_name
+        self.threshold = self.THRESHOLDS[model_name]
+
+    def available(self):
+        # models.py only loads the model configured by RECOGNITION_MODEL
+        return (
+            not models.USE_OPENCV_DNN
+            and models.DeepFace is not None
+            and models.RECOGNITION_MODEL == self.model_name
+        )
+
+
+class OpenCVDNNBackend(ModelBackend):
+    """YuNet + SFace through OpenCV's DNN module, without TensorFlow"""
+
+    name = 'opencv_dnn'
+    # Not interchangeable with DeepFace's SFace embeddings, the crops are aligned differently
+    model_name = 'SFace-opencv'
+    # OpenCV's published SFace cut-off is a cosine similarity of 0.363
+    threshold = 0.637
+
+    def available(self):
+        return models.USE_OPENCV_DNN and models.backend_available()
+
+
+class FaceRecognitionBackend(RecognitionBackend):
+    """dlib's ResNet through the face_recognition package"""
+
+    name = 'face_recognition'
+    model_name = 'face_recognition'
+    metric = 'euclidean'
+    threshold = 0.4
+
+    def available(self):
+        try:
+            import face_recognition  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def detect(self, image):
+        import face_recognition as fr
+
+        faces = []
+        for top, right, bottom, left in fr.face_locations(image):
+            faces.append({
+                'facial_area': {'x': left, 'y': top, 'w': right - left, 'h': bottom - top},
+                'confidence': 1.0,
+                'face': image[top:bottom, left:right]
+            })
+        return faces
+
+    def embed(self, faces):
+        import face_recognition as fr
+
+        embeddings = []
+        for face in faces:
+            height, width = face['face'].shape[:2]
+            encodings = fr.face_encodings(face['face'], known_face_locations=[(0, width, height, 0)])
+            embeddings.append(encodings[0] if encodings else None)
+        return embeddings
+
+    def embed_image(self, image):
+        import face_recognition as fr
+
+        face_encodings = fr.face_encodings(image)
+        if len(face_encodings) == 0:
+            return None
+        return face_encodings[0]
+
+
+def create_backend(name, model_name=None):
+    """Backend by its RECOGNITION_BACKEND name"""
+    if name == 'deepface':
+        return DeepFaceBackend(model_name or 'VGG-Face')
+    if name == 'opencv_dnn':
+        return OpenCVDNNBackend()
+    if name == 'face_recognition':
+        return FaceRecognitionBackend()
+    raise ValueError(f"Unknown recognition backend: {name}")
+
+
+def get_backend():
+    """
+    The configured backend, or face_recognition when it cannot run here.
+    Raises RuntimeError if neither can.
+    """
+    backend = create_backend(RECOGNITION_BACKEND, RECOGNITION_MODEL)
+    if backend.available():
+        return backend
+
+    fallback = FaceRecognitionBackend()
+    if fallback.available():
+        return fallback
+    raise RuntimeError(
+        f"RECOGNITION_BACKEND={RECOGNITION_BACKEND!r} cannot run here and face_recognition, the fallback, "
+        f"is not installed. Install the backend's packages (deepface, or OpenCV with the YuNet and SFace "
+        f"ONNX files for opencv_dnn) or face_recognition."
+    )
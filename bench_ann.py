@@ -0,0 +1,126 @@
+"""
+Benchmark the IVF approximate index and the quantized memory-mapped gallery
+against the exact brute-force scan. Builds synthetic galleries of clustered
+unit-length embeddings, queries them with noisy copies of enrolled students
+and reports recall@1, latency and the memory held in RAM for the scan.
+
+Usage:
+    python bench_ann.py --sizes 10000 100000 --dim 4096
+    python bench_ann.py --sizes 1000000 --dim 128 --nprobe 4 8 16
+    python bench_ann.py --sizes 100000 --quantize --rerank 32
+    python bench_ann.py --sizes 100000 --shards 2 4
+"""
+
+import argparse
+import tempfile
+import time
+import numpy as np
+from gallery import Gallery
+from ann_index import IVFIndex
+from shard_pool import ShardPool
+
+
+def synthetic_gallery(size, dim, seed=0, clusters=256, block_size=65536):
+    """Unit-length embeddings grouped around shared cluster centres, like real faces"""
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dim)).astype(np.float32)
+    vectors = np.empty((size, dim), dtype=np.float32)
+
+    for start in range(0, size, block_size):
+        stop = min(start + block_size, size)
+        block = centres[rng.integers(0, clusters, stop - start)]
+        block += 0.8 * rng.standard_normal((stop - start, dim)).astype(np.float32)
+        vectors[start:stop] = block / np.linalg.norm(block, axis=1, keepdims=True)
+    return vectors
+
+
+def build_gallery(vectors):
+    """Load vectors straight into a Gallery without per-row copies"""
+    return Gallery.from_arrays('synthetic', 'cosine', [str(i) for i in range(len(vectors))], vectors)
+
+
+def time_queries(gallery, queries):
+    """Top-1 result and latency (ms) of each query"""
+    results, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        best = gallery.search(query, k=1)
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append(best[0][0])
+    return results, np.array(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--dim", type=int, default=4096, help="4096 for VGG-Face, 128 for SFace/face_recognition")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--nlist", type=int, default=0, help="0 picks sqrt(size)")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[8, 16])
+    parser.add_argument("--noise", type=float, default=0.8, help="probe noise relative to the enrolled embedding")
+    parser.add_argument("--quantize", action="store_true", help="also benchmark the PCA/int8 memory-mapped gallery")
+    parser.add_argument("--components", type=int, default=256)
+    parser.add_argument("--rerank", type=int, default=32)
+    parser.add_argument("--shards", type=int, nargs="*", default=[], help="also benchmark scatter-gather over N shard processes")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    print(f"{'size':>9} {'dim':>5} {'mode':>16} {'recall@1':>9} {'p50 ms':>8} {'p99 ms':>8} {'build s':>8} {'RAM MB':>8}")
+
+    for size in args.sizes:
+        vectors = synthetic_gallery(size, args.dim)
+        targets = rng.integers(0, size, args.queries)
+        queries = vectors[targets] + args.noise * rng.standard_normal((args.queries, args.dim)).astype(np.float32) / np.sqrt(args.dim)
+
+        gallery = build_gallery(vectors)
+        exact, latencies = time_queries(gallery, queries)
+        print(f"{size:>9} {args.dim:>5} {'brute-force':>16} {1.0:>9.3f} "
+              f"{np.percentile(latencies, 50):>8.2f} {np.percentile(latencies, 99):>8.2f} {'-':>8} "
+              f"{vectors.nbytes / 2**20:>8.1f}")
+
+        for shards in args.shards:
+            pool = ShardPool(gallery, shards)
+            pool.search(queries[0], k=1)  # first search pays for process start-up
+            latencies = []
+            for query in queries:
+                start = time.perf_counter()
+                pool.search(query, k=1)
+                latencies.append((time.perf_counter() - start) * 1000)
+            pool.shutdown()
+            print(f"{size:>9} {args.dim:>5} {f'shards={shards}':>16} {1.0:>9.3f} "
+                  f"{np.percentile(latencies, 50):>8.2f} {np.percentile(latencies, 99):>8.2f} {'-':>8} "
+                  f"{vectors.nbytes / 2**20 / shards:>8.1f}")
+
+        index = IVFIndex(nlist=args.nlist or None)
+        start = time.perf_counter()
+        gallery.set_index(index)
+        gallery.build_index()
+        build_seconds = time.perf_counter() - start
+
+        for nprobe in args.nprobe:
+            index.nprobe = nprobe
+            approx, latencies = time_queries(gallery, queries)
+            recall = np.mean([a == e for a, e in zip(approx, exact)])
+            print(f"{size:>9} {args.dim:>5} {f'ivf nprobe={nprobe}':>16} {recall:>9.3f} "
+                  f"{np.percentile(latencies, 50):>8.2f} {np.percentile(latencies, 99):>8.2f} {build_seconds:>8.1f} "
+                  f"{vectors.nbytes / 2**20:>8.1f}")
+
+        if args.quantize:
+            gallery.set_index(None)
+            start = time.perf_counter()
+            gallery.enable_quantization(tempfile.mkdtemp(), components=args.components, rerank=args.rerank)
+            gallery.build_quantized()
+            build_seconds = time.perf_counter() - start
+            del vectors  # full-precision rows now live in the memory-mapped file
+
+            approx, latencies = time_queries(gallery, queries)
+            recall = np.mean([a == e for a, e in zip(approx, exact)])
+            codes = gallery.quantized
+            resident = (codes.codes[:size].nbytes + codes.basis.nbytes + codes.mean.nbytes) / 2**20
+            print(f"{size:>9} {args.dim:>5} {f'int8 rerank={args.rerank}':>16} {recall:>9.3f} "
+                  f"{np.percentile(latencies, 50):>8.2f} {np.percentile(latencies, 99):>8.2f} {build_seconds:>8.1f} "
+                  f"{resident:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
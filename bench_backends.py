@@ -0,0 +1,271 @@
+"""
+Compare recognition backends side by side to pick the cheapest one that is
+accurate enough: import time, model build/warm-up time, resident memory,
+per-image latency (decode, detect, embed), embedding size and verification
+accuracy at each backend's default threshold.
+
+Each backend runs in a fresh Python process so import costs and memory are
+not shared between them. Backends are named as RECOGNITION_BACKEND values,
+with the DeepFace model after a colon. --images is a labelled set laid out
+as one folder per person:
+
+    test_photos/
+        alice/1.jpg, alice/2.jpg, ...
+        bob/1.jpg, ...
+
+Every pair of photos is verified: same-folder pairs should match, the rest
+should not. Without photos a synthetic frame is used, which only measures
+the no-face path.
+
+Usage:
+    python bench_backends.py --images test_photos/
+    python bench_backends.py --backends deepface:Facenet512 opencv_dnn --images test_photos/ --min-accuracy 0.97
+    python bench_backends.py --backends opencv_dnn --repeat 20 --json
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+DEFAULT_BACKENDS = [
+    'deepface:VGG-Face',
+    'deepface:Facenet512',
+    'deepface:ArcFace',
+    'deepface:SFace',
+    'opencv_dnn',
+    'face_recognition'
+]
+
+
+def find_images(directory):
+    """Photo paths under a directory, in a stable order"""
+    paths = []
+    for root, _, files in os.walk(directory):
+        paths.extend(os.path.join(root, f) for f in files if f.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(paths)
+
+
+def backend_env(backend):
+    """
+    Environment for a child process that runs one backend ("name" or
+    "name:model"). It overrides secrets.toml too (see config.ENV_OVERRIDES_SECRETS).
+    """
+    name, _, model_name = backend.partition(':')
+    return dict(os.environ, RECOGNITION_BACKEND=name, RECOGNITION_MODEL=model_name or 'VGG-Face',
+                ENV_OVERRIDES_SECRETS='1')
+
+
+def create_requested_backend(backend):
+    """
+    In the child: the backend it was started for, built from the config the
+    models module loaded. Raises RuntimeError if that config names another
+    backend, rather than measuring the wrong one under this name.
+    """
+    import config
+    import backends
+
+    name, _, model_name = backend.partition(':')
+    configured = f"{config.RECOGNITION_BACKEND}:{config.RECOGNITION_MODEL}"
+    if config.RECOGNITION_BACKEND != name or (name == 'deepface' and config.RECOGNITION_MODEL != (model_name or 'VGG-Face')):
+        raise RuntimeError(f"child configured for {configured}, not {backend}")
+    created = backends.create_backend(name, config.RECOGNITION_MODEL)
+    if created.name != name:
+        raise RuntimeError(f"child built the {created.name} backend, not {backend}")
+    return created
+
+
+def _rss_mb():
+    """Current resident set size in MB (Linux), falling back to the peak"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _synthetic_frame():
+    """JPEG bytes of a noise frame the size of a camera capture"""
+    from io import BytesIO
+    from PIL import Image
+
+    rng = np.random.default_rng(0)
+    buffer = BytesIO()
+    Image.fromarray(rng.integers(0, 255, (720, 1280, 3), dtype=np.uint8)).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+def verification_accuracy(backend, labels, embeddings):
+    """Accuracy, true-accept and false-accept rates over every pair of labelled photos"""
+    genuine = impostor = true_accepts = false_accepts = 0
+    for i in range(len(embeddings)):
+        for j in range(i + 1, len(embeddings)):
+            if embeddings[i] is None or embeddings[j] is None:
+                continue
+            accepted = backend.distance(embeddings[i], embeddings[j]) < backend.threshold
+            if labels[i] == labels[j]:
+                genuine += 1
+                true_accepts += accepted
+            else:
+                impostor += 1
+                false_accepts += accepted
+
+    pairs = genuine + impostor
+    if not pairs:
+        return {}
+    return {
+        'pairs': pairs,
+        'accuracy': (true_accepts + impostor - false_accepts) / pairs,
+        'tar': true_accepts / genuine if genuine else None,
+        'far': false_accepts / impostor if impostor else None
+    }
+
+
+def measure(image_paths, repeat, requested):
+    """Runs inside the child process, for the requested backend ("name" or "name:model")"""
+    import config  # Streamlit and the app config, paid by every backend
+
+    result = {'backend': requested, 'baseline_rss_mb': _rss_mb()}
+
+    start = time.perf_counter()
+    import models
+    import backends
+    result['import_s'] = time.perf_counter() - start
+    result['tensorflow_imported'] = 'tensorflow' in sys.modules
+
+    try:
+        backend = create_requested_backend(requested)
+    except RuntimeError as e:
+        result['error'] = str(e)
+        return result
+    result['backend'] = f"{backend.name}:{backend.model_name}"
+    result['threshold'] = backend.threshold
+    if not backend.available():
+        result['error'] = "backend not available in this environment"
+        return result
+
+    start = time.perf_counter()
+    if backend.name == 'face_recognition':
+        import face_recognition  # noqa: F401  (dlib loads its models on import)
+    else:
+        models._warm_up(embed_here=True)
+        if models.warm_up_error() is not None:
+            result['error'] = f"warm-up failed: {str(models.warm_up_error()).strip()}"
+            return result
+    result['warm_up_s'] = time.perf_counter() - start
+    result['rss_mb'] = _rss_mb()
+
+    import preprocess
+
+    frames = [open(path, 'rb').read() for path in image_paths] or [_synthetic_frame()]
+    latencies = []
+    embeddings = [None] * len(frames)
+    for _ in range(repeat):
+        for i, frame in enumerate(frames):
+            start = time.perf_counter()
+            embeddings[i] = backend.embed_image(preprocess.prepare_image(frame))
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    dims = {len(np.ravel(e)) for e in embeddings if e is not None}
+    result['images'] = len(image_paths)
+    result['embedded'] = sum(e is not None for e in embeddings)
+    result['embedding_dim'] = max(dims) if dims else None
+    result['image_p50_ms'] = float(np.percentile(latencies, 50))
+    result['image_p95_ms'] = float(np.percentile(latencies, 95))
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    if image_paths:
+        labels = [os.path.basename(os.path.dirname(path)) for path in image_paths]
+        result.update(verification_accuracy(backend, labels, embeddings))
+    return result
+
+
+def recommend(results, min_accuracy):
+    """The fastest backend meeting the accuracy bar (ties broken on memory), or None"""
+    eligible = [
+        r for r in results
+        if 'error' not in r and r.get('accuracy') is not None and r['accuracy'] >= min_accuracy
+    ]
+    if not eligible:
+        return None
+    return min(eligible, key=lambda r: (r['image_p50_ms'], r.get('peak_rss_mb', 0)))
+
+
+def run_backend(backend, args):
+    """Measure one backend in a fresh interpreter and return its result dict"""
+    command = [sys.executable, os.path.abspath(__file__), '--child', backend, '--repeat', str(args.repeat)]
+    if args.images:
+        command += ['--images', args.images]
+    completed = subprocess.run(command, env=backend_env(backend), capture_output=True, text=True)
+
+    # The result is the last line; models may print their own progress before it
+    lines = completed.stdout.strip().splitlines()
+    try:
+        return json.loads(lines[-1])
+    except (IndexError, json.JSONDecodeError):
+        return {'backend': backend, 'error': (completed.stderr.strip().splitlines() or ['no output'])[-1]}
+
+
+def print_table(results):
+    columns = [
+        ('backend', 'backend', '{}', 28),
+        ('import_s', 'import s', '{:.2f}', 9),
+        ('warm_up_s', 'warm-up s', '{:.2f}', 10),
+        ('rss_mb', 'RSS MB', '{:.0f}', 7),
+        ('peak_rss_mb', 'peak MB', '{:.0f}', 8),
+        ('image_p50_ms', 'p50 ms', '{:.1f}', 8),
+        ('image_p95_ms', 'p95 ms', '{:.1f}', 8),
+        ('embedding_dim', 'dim', '{}', 5),
+        ('accuracy', 'accuracy', '{:.3f}', 9),
+        ('tar', 'TAR', '{:.3f}', 6),
+        ('far', 'FAR', '{:.3f}', 6),
+        ('tensorflow_imported', 'TF', '{}', 6)
+    ]
+    print(' '.join(f"{title:>{width}}" for _, title, _, width in columns))
+    for result in results:
+        cells = [
+            (fmt.format(result[key]) if result.get(key) is not None else '-', width)
+            for key, _, fmt, width in columns
+        ]
+        print(' '.join(f"{cell:>{width}}" for cell, width in cells))
+        if 'error' in result:
+            print(f"{'':>28} ⚠️ {result['error']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", default=DEFAULT_BACKENDS, help="backend or backend:model")
+    parser.add_argument("--images", default="", help="labelled photos, one folder per person")
+    parser.add_argument("--min-accuracy", type=float, default=0.95, help="accuracy bar for the recommendation")
+    parser.add_argument("--repeat", type=int, default=5, help="passes over the photos")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    image_paths = find_images(args.images) if args.images else []
+
+    if args.child:
+        print(json.dumps(measure(image_paths, args.repeat, args.child)))
+        return
+
+    results = [run_backend(backend, args) for backend in args.backends]
+    choice = recommend(results, args.min_accuracy)
+    if args.json:
+        print(json.dumps({'results': results, 'recommended': choice and choice['backend']}, indent=2))
+        return
+
+    print_table(results)
+    if choice:
+        print(f"\n✅ Cheapest backend with accuracy >= {args.min_accuracy}: {choice['backend']}")
+    elif image_paths:
+        print(f"\n❌ No backend reached accuracy {args.min_accuracy}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+"""
+End-to-end latency of recognising a student as the school grows.
+
+Each gallery size runs in a fresh process against a local, in-memory
+stand-in for Dropbox. It holds N synthetic students: photo listing entries
+with content hashes, and a gallery sidecar of synthetic embeddings that
+agrees with them. The app's own code then runs against it. Every stage of a
+login is timed separately:
+
+    listing    list_user_image_hashes (paged like Dropbox, 2000 per page)
+    download   fetching the gallery sidecar
+    load       parsing it into a Gallery (cold start)
+    decode     decoding the probe photo
+    detect     face detection
+    embed      embedding the probe face
+    match      search_gallery, with the configured index/quantization/shards
+    end_to_end compare_face_with_dropbox, which runs decode to match
+
+detect, embed and end_to_end need the recognition model. Without it, the
+probe is a noisy copy of an enrolled embedding, and only storage, decoding
+and matching are measured. --storage-ms adds a fixed delay to every storage
+call to model the Dropbox round trip.
+
+Results (p50/p95/p99 per stage, peak RSS per size, plus the commit and the
+settings) are written as JSON with --output, so runs can be compared across
+commits.
+
+Usage:
+    python bench_recognition.py --images test_photos/ --output bench/$(git rev-parse --short HEAD).json
+    python bench_recognition.py --sizes 100 1000 --repeat 50 --storage-ms 40
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+from bench_ann import synthetic_gallery
+from bench_backends import find_images, _synthetic_frame
+
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+STAGES = ['listing', 'download', 'load', 'decode', 'detect', 'embed', 'match', 'end_to_end']
+
+# Entries per listing page, as the Dropbox API returns them
+PAGE_SIZE = 2000
+
+
+class LocalDropbox:
+    """
+    In-memory stand-in for the few dropbox.Dropbox calls the app makes.
+    Files are (content, content_hash) pairs; listing entries are real SDK
+    metadata objects, so dropbox_utils runs unchanged.
+    """
+
+    def __init__(self, latency_ms=0.0):
+        self.latency = latency_ms / 1000.0
+        self.files = {}
+        self._cursors = {}
+        self._sessions = {}
+
+    def _call(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    @staticmethod
+    def _not_found(error_type):
+        import dropbox
+        from dropbox.exceptions import ApiError
+        return ApiError(None, error_type.path(dropbox.files.LookupError.not_found), None, None)
+
+    def put(self, path, content=b'', content_hash=None):
+        """Store a file without the simulated round trip (benchmark set-up)"""
+        self.files[path] = (content, content_hash or hashlib.sha256(content + path.encode()).hexdigest())
+
+    def users_get_current_account(self):
+        self._call()
+
+    def files_upload(self, content, path, mode=None):
+        self._call()
+        self.put(path, content)
+
+    def files_upload_session_start(self, content):
+        self._call()
+        session_id = str(len(self._sessions))
+        self._sessions[session_id] = [content]
+
+        class Session:
+            pass
+
+        session = Session()
+        session.session_id = session_id
+        return session
+
+    def files_upload_session_append_v2(self, content, cursor):
+        self._call()
+        self._sessions[cursor.session_id].append(content)
+
+    def files_upload_session_finish(self, content, cursor, commit):
+        self._call()
+        self.put(commit.path, b''.join(self._sessions.pop(cursor.session_id) + [content]))
+
+    def files_download(self, path):
+        import dropbox
+
+        self._call()
+        if path not in self.files:
+            raise self._not_found(dropbox.files.DownloadError)
+        content, content_hash = self.files[path]
+
+        class Response:
+            pass
+
+        response = Response()
+        response.content = content
+        return dropbox.files.FileMetadata(name=path.rsplit('/', 1)[-1], path_display=path,
+                                          content_hash=content_hash), response
+
+    def files_delete_v2(self, path):
+        self._call()
+        for key in [key for key in self.files if key == path or key.startswith(path + '/')]:
+            del self.files[key]
+
+    def files_create_folder_v2(self, path):
+        self._call()
+
+    def files_list_folder(self, path, recursive=False):
+        import dropbox
+
+        self._call()
+        prefix = path.rstrip('/') + '/'
+        paths = sorted(
+            key for key in self.files
+            if key.startswith(prefix) and (recursive or '/' not in key[len(prefix):])
+        )
+        if not paths:
+            raise self._not_found(dropbox.files.ListFolderError)
+        cursor = str(len(self._cursors))
+        self._cursors[cursor] = paths
+        return self._page(cursor, 0)
+
+    def files_list_folder_continue(self, cursor):
+        self._call()
+        position, _, cursor = cursor.partition(':')
+        return self._page(cursor, int(position))
+
+    def _page(self, cursor, position):
+        import dropbox
+
+        paths = self._cursors[cursor]
+        page = paths[position:position + PAGE_SIZE]
+        entries = [
+            dropbox.files.FileMetadata(name=p.rsplit('/', 1)[-1], path_display=p, content_hash=self.files[p][1])
+            for p in page
+        ]
+        next_position = position + len(page)
+        if next_position >= len(paths):
+            del self._cursors[cursor]
+
+        class Result:
+            pass
+
+        result = Result()
+        result.entries = entries
+        result.has_more = next_position < len(paths)
+        result.cursor = f"{next_position}:{cursor}"
+        return result
+
+
+def _timed(samples, stage, function, *args):
+    start = time.perf_counter()
+    value = function(*args)
+    samples.setdefault(stage, []).append((time.perf_counter() - start) * 1000)
+    return value
+
+
+def _percentiles(values):
+    return {
+        'n': len(values),
+        'p50_ms': float(np.percentile(values, 50)),
+        'p95_ms': float(np.percentile(values, 95)),
+        'p99_ms': float(np.percentile(values, 99)),
+        'mean_ms': float(np.mean(values))
+    }
+
+
+def measure(size, args, image_paths):
+    """Runs inside the child process: build the stand-in for `size` students and time every stage"""
+    import config
+    import dropbox_utils
+    import image
+    from gallery import Gallery
+
+    result = {'size': size, 'backend': f"{image.BACKEND.name}:{image.MODEL_NAME}"}
+    probes = [open(path, 'rb').read() for path in image_paths] or [_synthetic_frame()]
+
+    # The probe's own embedding tells the gallery's width when the model can run here
+    model = image.BACKEND.available()
+    if model:
+        try:
+            dim = len(np.ravel(image.embed_face(image.decode_image(probes[0]))))
+        except Exception as e:
+            model, result['model_error'] = False, str(e).strip()
+    if not model:
+        dim = args.dim
+    result.update(model=model, dim=dim)
+
+    storage = LocalDropbox(args.storage_ms)
+    vectors = synthetic_gallery(size, dim)
+    ids = [str(i) for i in range(1, size + 1)]
+    hashes = [hashlib.sha256(uid.encode()).hexdigest() for uid in ids]
+    for uid, content_hash in zip(ids, hashes):
+        storage.put(f"{config.IMAGES_FOLDER}/{uid}.jpg", content_hash=content_hash)
+    gallery = Gallery.from_arrays(image.MODEL_NAME, image.DISTANCE_METRIC, ids, vectors, hashes, image.PREPROCESSING)
+    storage.put(config.GALLERY_FILE, gallery.to_bytes())
+    image.get_dropbox_client = lambda: storage
+    result['setup_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    # Cold start: sidecar load and listing on the first search; the index builds in the background
+    start = time.perf_counter()
+    image.search_gallery(storage, vectors[0], k=1)
+    result['cold_start_ms'] = (time.perf_counter() - start) * 1000
+    image.wait_for_gallery_builds()
+    result['build_ms'] = (time.perf_counter() - start) * 1000 - result['cold_start_ms']
+
+    rng = np.random.default_rng(1)
+    samples = {}
+    for i in range(args.repeat):
+        probe_bytes = probes[i % len(probes)]
+        _timed(samples, 'listing', dropbox_utils.list_user_image_hashes, storage)
+        gallery_bytes = _timed(samples, 'download', dropbox_utils.download_gallery_from_dropbox, storage)
+        _timed(samples, 'load', Gallery.from_bytes, gallery_bytes)
+        frame = _timed(samples, 'decode', image.decode_image, probe_bytes)
+
+        if model:
+            faces = _timed(samples, 'detect', image.detect_faces, frame)
+            face = max(faces, key=lambda f: f['facial_area']['w'] * f['facial_area']['h']) if faces else {'face': frame.astype(np.float32) / 255.0}
+            probe = _timed(samples, 'embed', image.embed_face_crops, [face])[0]
+            _timed(samples, 'end_to_end', image.compare_face_with_dropbox, probe_bytes)
+        else:
+            probe = vectors[rng.integers(0, size)] + 0.8 * rng.standard_normal(dim).astype(np.float32) / np.sqrt(dim)
+
+        if probe is not None:
+            _timed(samples, 'match', image.search_gallery, storage, probe, 1)
+
+    result['stages'] = {stage: _percentiles(samples[stage]) for stage in STAGES if samples.get(stage)}
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return result
+
+
+def run_size(size, args):
+    """Measure one gallery size in a fresh interpreter, so peak RSS is its own"""
+    command = [sys.executable, os.path.abspath(__file__), '--child', '--sizes', str(size),
+               '--repeat', str(args.repeat), '--dim', str(args.dim), '--storage-ms', str(args.storage_ms)]
+    if args.images:
+        command += ['--images', args.images]
+    completed = subprocess.run(command, capture_output=True, text=True)
+
+    # The result is the last line; Streamlit and the models may log before it
+    lines = completed.stdout.strip().splitlines()
+    try:
+        return json.loads(lines[-1])
+    except (IndexError, json.JSONDecodeError):
+        return {'size': size, 'error': (completed.stderr.strip().splitlines() or ['no output'])[-1]}
+
+
+def run_info():
+    """Commit, machine and settings of this run, for comparing result files"""
+    import config
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'settings': {
+            key: getattr(config, key) for key in [
+                'RECOGNITION_BACKEND', 'RECOGNITION_MODEL', 'ANN_INDEX', 'GALLERY_QUANTIZE',
+                'GALLERY_SHARDS', 'INFERENCE_WORKER', 'QUALITY_GATE', 'GALLERY_SYNC_SECONDS'
+            ]
+        }
+    }
+
+
+def print_table(results):
+    print(f"{'size':>7} {'stage':>11} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'peak MB':>8}")
+    for result in results:
+        if 'error' in result:
+            print(f"{result['size']:>7} ⚠️ {result['error']}")
+            continue
+        print(f"{result['size']:>7} {'cold start':>11} {result['cold_start_ms']:>9.1f} {'':>9} {'':>9} {result['peak_rss_mb']:>8.0f}")
+        if result.get('build_ms', 0) >= 1:
+            print(f"{'':>7} {'bg build':>11} {result['build_ms']:>9.1f}")
+        for stage, stats in result['stages'].items():
+            print(f"{'':>7} {stage:>11} {stats['p50_ms']:>9.2f} {stats['p95_ms']:>9.2f} {stats['p99_ms']:>9.2f}")
+        if not result['model']:
+            print(f"{'':>7} (no model here: detect/embed skipped, synthetic {result['dim']}-d probes)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--images", default="", help="probe photos (any layout); a noise frame without")
+    parser.add_argument("--repeat", type=int, default=30, help="logins timed per size")
+    parser.add_argument("--dim", type=int, default=512, help="embedding size when the model can't run here")
+    parser.add_argument("--storage-ms", type=float, default=0.0, help="simulated round trip per storage call")
+    parser.add_argument("--output", default="", help="write the results as JSON to this file")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    image_paths = find_images(args.images) if args.images else []
+
+    if args.child:
+        print(json.dumps(measure(args.sizes[0], args, image_paths)))
+        return
+
+    report = dict(run_info(), storage_ms=args.storage_ms, repeat=args.repeat,
+                  results=[run_size(size, args) for size in args.sizes])
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print_table(report['results'])
+    if args.output:
+        print(f"\n📄 Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
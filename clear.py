@@ -1,7 +1,8 @@
 import os
 import streamlit as st
 import encdec
-from dropbox_utils import get_dropbox_client, clear_all_data
+from config import MAX_EXTRA_PHOTOS, IMAGES_FOLDER, TEMPLATES_FOLDER, ARCHIVE_IMAGES_FOLDER, ARCHIVE_TEMPLATES_FOLDER
+from dropbox_utils import get_dropbox_client, clear_all_data, list_student_template_hashes
 
 
 def clear():
@@ -29,3 +30,96 @@ def clear():
     
     elif clearbtn and password != encdec.encdec():
         st.error("❌ Password entered is incorrect")
+
+    st.divider()
+    add_enrollment_photos(password)
+
+    st.divider()
+    archive_students_form(password)
+
+
+def add_enrollment_photos(password):
+    """Add extra photos to an already registered student, e.g. after a haircut or new glasses"""
+    import register  # imported here, only the admin tab needs it
+    from db import Database
+
+    st.markdown("#### 📷 Add enrollment photos")
+    user_id = st.text_input("Student ID", key="extraPhotosId")
+    pictures = st.file_uploader(
+        "Photos", type=["jpg", "jpeg", "png"], accept_multiple_files=True, key="extraPhotosUpload"
+    )
+    if not st.button("Add Photos"):
+        return
+    if password != encdec.encdec():
+        st.error("❌ Password entered is incorrect")
+        return
+    user_id = user_id.strip()
+    if not user_id.isdigit() or not pictures:
+        st.error("Enter a student ID and choose at least one photo")
+        return
+    if not Database().get_user_detail(user_id):
+        st.error(f"No registered student with ID {user_id}")
+        return
+
+    dbx = get_dropbox_client()
+    if not dbx:
+        st.error("Could not connect to Dropbox")
+        return
+    existing = list_student_template_hashes(dbx, user_id)
+    if existing is None:
+        st.error("Could not check the student's existing photos, try again")
+        return
+    room = MAX_EXTRA_PHOTOS - len(existing)
+    if room <= 0:
+        st.error(f"Student {user_id} already has {len(existing)} additional photos (the limit is {MAX_EXTRA_PHOTOS})")
+        return
+
+    with st.spinner("Checking and saving photos..."):
+        register.save_extra_photos(register.usable_extra_photos(pictures, room, 'extraPhotosCheck'), user_id)
+
+
+def archive_students_form(password):
+    """Move graduated or inactive students out of the hot gallery and records"""
+    import archive  # imported here, only the admin tab needs it
+    from db import Database
+
+    st.markdown("#### 📦 Archive students")
+    st.caption("Archived students are left out of logins and reports, but can still be found from Reports.")
+    df = Database().get_all_students()
+    if df.empty:
+        st.info("No students to archive")
+        return
+
+    col1, col2 = st.columns(2)
+    with col1:
+        classes = st.multiselect("Class", sorted(df['class'].dropna().astype(str).unique()), key="archiveClasses")
+        years = st.multiselect("Admission year", archive.admission_years(df), key="archiveYears")
+    with col2:
+        listed = st.text_input("Student IDs (comma separated)", key="archiveIds")
+
+    user_ids = [part.strip() for part in listed.split(',') if part.strip().isdigit()]
+    selected = archive.select_students(df, classes, years, user_ids)
+    if not selected:
+        return
+
+    st.warning(f"⚠️ {len(selected)} students selected for archiving")
+    st.dataframe(df[df['id'].isin(selected)][['id', 'name', 'class', 'admission_date']], use_container_width=True, height=200)
+    if not st.button("Archive Selected"):
+        return
+    if password != encdec.encdec():
+        st.error("❌ Password entered is incorrect")
+        return
+
+    with st.spinner("Archiving students..."):
+        archived, failed, unrecorded = archive.archive_students(selected)
+    if archived:
+        st.success(f"✅ {len(archived)} students archived")
+    if failed:
+        st.error(f"Could not archive students: {', '.join(map(str, failed))}")
+    if unrecorded:
+        st.warning(
+            f"⚠️ The photos of students {', '.join(map(str, unrecorded))} are already in the archive, but their "
+            f"records could not be moved, so they no longer log in. Archive them again to finish, or move "
+            f"their photos back from {ARCHIVE_IMAGES_FOLDER} to {IMAGES_FOLDER} (and their extra photos from "
+            f"{ARCHIVE_TEMPLATES_FOLDER} to {TEMPLATES_FOLDER}) to keep them active."
+        )
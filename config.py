@@ -1,12 +1,20 @@
 import streamlit as st
 import os
+import tempfile
 
 # Dropbox Configuration
 # For local development, use environment variables
 # For Streamlit Cloud, use st.secrets
 
+# Set by the benchmark tools for their child processes: the environment then beats secrets.toml,
+# so a child measures the backend it was started for, whatever the host's secrets say
+ENV_OVERRIDES_SECRETS = os.getenv("ENV_OVERRIDES_SECRETS", "") == "1"
+
+
 def get_secret(key, default=None):
     """Get secret from Streamlit secrets or environment variable"""
+    if ENV_OVERRIDES_SECRETS and key in os.environ:
+        return os.environ[key]
     try:
         return st.secrets.get(key, os.getenv(key, default))
     except:
@@ -21,3 +29,92 @@ DROPBOX_REFRESH_TOKEN = get_secret("DROPBOX_REFRESH_TOKEN", "")
 IMAGES_FOLDER = "/AI_NANBAN/known_users"
 USER_DATA_FILE = "/AI_NANBAN/user_data.xlsx"
 LOG_FILE_PATH = "/AI_NANBAN/activity_log.xlsx"
+GALLERY_FILE = "/AI_NANBAN/gallery.npz"
+CROPS_FOLDER = "/AI_NANBAN/face_crops"
+TEMPLATES_FOLDER = "/AI_NANBAN/templates"  # extra enrollment photos, one subfolder per student
+
+# Cold partition for graduated/inactive students: kept out of logins, searched on demand from Reports
+ARCHIVE_FOLDER = "/AI_NANBAN/archive"
+ARCHIVE_IMAGES_FOLDER = f"{ARCHIVE_FOLDER}/known_users"
+ARCHIVE_TEMPLATES_FOLDER = f"{ARCHIVE_FOLDER}/templates"
+ARCHIVE_USER_DATA_FILE = f"{ARCHIVE_FOLDER}/user_data.xlsx"
+ARCHIVE_GALLERY_FILE = f"{ARCHIVE_FOLDER}/gallery.npz"
+
+# Extra enrollment photos allowed per student, and students re-scored on their templates per search
+MAX_EXTRA_PHOTOS = int(get_secret("MAX_EXTRA_PHOTOS", 4))
+TEMPLATE_REFINE = int(get_secret("TEMPLATE_REFINE", 10))
+
+# Seconds between checks of the Dropbox photo listing for changes made elsewhere
+GALLERY_SYNC_SECONDS = int(get_secret("GALLERY_SYNC_SECONDS", 30))
+# Gallery changes within this many seconds of each other are saved to Dropbox in one sidecar write
+GALLERY_SAVE_DELAY_SECONDS = float(get_secret("GALLERY_SAVE_DELAY_SECONDS", 5))
+
+# Approximate nearest-neighbour search for large galleries
+# Set ANN_INDEX to "ivf" to enable; smaller galleries are always scanned exactly
+ANN_INDEX = get_secret("ANN_INDEX", "")
+ANN_MIN_GALLERY_SIZE = int(get_secret("ANN_MIN_GALLERY_SIZE", 20000))
+ANN_NLIST = int(get_secret("ANN_NLIST", 0))  # 0 picks sqrt(gallery size)
+ANN_NPROBE = int(get_secret("ANN_NPROBE", 8))
+
+# Memory-mapped gallery with PCA-reduced int8 codes for small (1 GB) instances
+# Set GALLERY_QUANTIZE to "true" to enable once the gallery reaches GALLERY_QUANTIZE_MIN_SIZE
+GALLERY_QUANTIZE = str(get_secret("GALLERY_QUANTIZE", "")).lower() in ("1", "true", "yes")
+GALLERY_QUANTIZE_MIN_SIZE = int(get_secret("GALLERY_QUANTIZE_MIN_SIZE", 2000))
+GALLERY_PCA_COMPONENTS = int(get_secret("GALLERY_PCA_COMPONENTS", 256))
+GALLERY_RERANK = int(get_secret("GALLERY_RERANK", 32))
+GALLERY_CACHE_DIR = get_secret("GALLERY_CACHE_DIR", os.path.join(tempfile.gettempdir(), "ai_nanban_gallery"))
+
+# Scatter-gather search over gallery shards in worker processes (0 or 1 = search in-process)
+GALLERY_SHARDS = int(get_secret("GALLERY_SHARDS", 0))
+SHARD_MIN_GALLERY_SIZE = int(get_secret("SHARD_MIN_GALLERY_SIZE", 20000))
+SHARD_TIMEOUT_MS = float(get_secret("SHARD_TIMEOUT_MS", 2000))  # shards slower than this are left out
+
+# Class searched first at this kiosk (the login page can change it); empty searches everyone
+KIOSK_CLASS = get_secret("KIOSK_CLASS", "")
+
+# Cheap image-quality gate run before the embedding model
+QUALITY_GATE = str(get_secret("QUALITY_GATE", "true")).lower() in ("1", "true", "yes")
+QUALITY_MIN_SHARPNESS = float(get_secret("QUALITY_MIN_SHARPNESS", 40))  # variance of the Laplacian
+QUALITY_MIN_BRIGHTNESS = float(get_secret("QUALITY_MIN_BRIGHTNESS", 40))  # mean gray level, 0-255
+QUALITY_MAX_BRIGHTNESS = float(get_secret("QUALITY_MAX_BRIGHTNESS", 220))
+QUALITY_MIN_FACE_FRACTION = float(get_secret("QUALITY_MIN_FACE_FRACTION", 0.15))  # face width / short side
+
+# Recognition backend (see backends.py): "deepface" (TensorFlow, RECOGNITION_MODEL one of
+# VGG-Face, Facenet512, ArcFace, SFace), "opencv_dnn" (YuNet detection and SFace recognition
+# ONNX models run by OpenCV's DNN module; TensorFlow is never imported) or "face_recognition"
+RECOGNITION_BACKEND = get_secret("RECOGNITION_BACKEND", "deepface")
+RECOGNITION_MODEL = get_secret("RECOGNITION_MODEL", "VGG-Face")
+# Match distance cut-off; empty uses the backend's default (tune it with evaluate_threshold.py)
+MATCH_THRESHOLD = get_secret("MATCH_THRESHOLD", "")
+ONNX_MODELS_DIR = get_secret("ONNX_MODELS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "onnx_models"))
+YUNET_MODEL_PATH = get_secret("YUNET_MODEL_PATH", os.path.join(ONNX_MODELS_DIR, "face_detection_yunet_2023mar.onnx"))
+SFACE_MODEL_PATH = get_secret("SFACE_MODEL_PATH", os.path.join(ONNX_MODELS_DIR, "face_recognition_sface_2021dec.onnx"))
+YUNET_MIN_CONFIDENCE = float(get_secret("YUNET_MIN_CONFIDENCE", 0.8))
+
+# Local inference worker process that embeds face crops in micro-batches
+# Set INFERENCE_WORKER to "true" to route every embedding through it
+INFERENCE_WORKER = str(get_secret("INFERENCE_WORKER", "")).lower() in ("1", "true", "yes")
+INFERENCE_BATCH_SIZE = int(get_secret("INFERENCE_BATCH_SIZE", 16))
+INFERENCE_BATCH_WAIT_MS = float(get_secret("INFERENCE_BATCH_WAIT_MS", 10))  # how long a batch waits to fill
+INFERENCE_QUEUE_DEPTH = int(get_secret("INFERENCE_QUEUE_DEPTH", 256))  # queued crops before submit blocks
+# Longest a caller waits for the worker's answer; past it the request is turned away and a worker
+# that has returned nothing for that long is restarted
+INFERENCE_TIMEOUT_MS = int(get_secret("INFERENCE_TIMEOUT_MS", 15000))
+# Longest the warm-up waits for the worker to load its model before reporting a warm-up error
+INFERENCE_START_TIMEOUT_S = float(get_secret("INFERENCE_START_TIMEOUT_S", 300))
+
+# Admission control for logins and face searches: recognitions run at once, how many more may
+# wait for a slot and for how long; beyond that a request is told to retry (see admission.py)
+RECOGNITION_CONCURRENCY = int(get_secret("RECOGNITION_CONCURRENCY", 2))
+RECOGNITION_QUEUE_LENGTH = int(get_secret("RECOGNITION_QUEUE_LENGTH", 8))
+RECOGNITION_QUEUE_DEADLINE_MS = int(get_secret("RECOGNITION_QUEUE_DEADLINE_MS", 3000))
+
+# Face detection cascade: Haar on a downscaled frame first, the DeepFace
+# backend (DETECTOR_BACKEND, e.g. "opencv", "yunet", "retinaface") only on a miss
+DETECTOR_BACKEND = get_secret("DETECTOR_BACKEND", "opencv")
+FAST_DETECTOR_SIZE = int(get_secret("FAST_DETECTOR_SIZE", 480))  # longest side in pixels
+FAST_DETECTOR_MIN_CONFIDENCE = float(get_secret("FAST_DETECTOR_MIN_CONFIDENCE", 2.0))  # Haar level weight
+
+# Camera and upload frames are decoded straight to at most this many pixels on the long side
+# (960 lets a 1080p JPEG decode at exactly half scale)
+MAX_FRAME_SIDE = int(get_secret("MAX_FRAME_SIDE", 960))
@@ -5,6 +5,7 @@ from dropbox_utils import (
     read_user_data_from_dropbox,
     save_user_data_to_dropbox
 )
+from config import ARCHIVE_USER_DATA_FILE
 
 
 class Database:
@@ -50,11 +51,7 @@ class Database:
         user_data should be a dictionary with all user fields
         """
         try:
-            # Generate new user ID
-            if len(self.df) == 0:
-                user_id = 1
-            else:
-                user_id = int(self.df['id'].max()) + 1
+            user_id = self._next_user_id()
             
             # Create new user record
             new_user = {
@@ -94,6 +91,15 @@ class Database:
             st.error(f"Error inserting user: {e}")
             return None
 
+    def _next_user_id(self):
+        """One past the highest ID ever issued, archived students included, so IDs are never reused"""
+        ids = pd.to_numeric(self.df['id'], errors='coerce')
+        if self.dbx:
+            archived = read_user_data_from_dropbox(self.dbx, ARCHIVE_USER_DATA_FILE)
+            ids = pd.concat([ids, pd.to_numeric(archived['id'], errors='coerce')])
+        ids = ids.dropna()
+        return int(ids.max()) + 1 if len(ids) else 1
+
     def get_user_detail(self, user_id):
         """Get user details by user ID - returns dictionary"""
         try:
@@ -164,3 +170,31 @@ class Database:
                 result = result[result[key].str.contains(str(value), case=False, na=False)]
         
         return result
+
+    def get_archived_students(self):
+        """Archived (graduated/inactive) students as DataFrame, read on demand"""
+        if not self.dbx:
+            return self._get_empty_dataframe()
+        return read_user_data_from_dropbox(self.dbx, ARCHIVE_USER_DATA_FILE)
+
+    def archive_users(self, user_ids):
+        """Move the records of the given students into the archive file"""
+        try:
+            user_ids = {int(user_id) for user_id in user_ids}
+            moving = self.df['id'].isin(user_ids)
+            if not moving.any():
+                return True
+
+            archived = pd.concat([self.get_archived_students(), self.df[moving]], ignore_index=True)
+            archived = archived.drop_duplicates(subset='id', keep='last')
+
+            # Write the archive first: a failure in between leaves a duplicate, never a lost record
+            if self.dbx and not save_user_data_to_dropbox(self.dbx, archived, ARCHIVE_USER_DATA_FILE):
+                return False
+            self.df = self.df[~moving]
+            if self.dbx:
+                return save_user_data_to_dropbox(self.dbx, self.df)
+            return True
+        except Exception as e:
+            st.error(f"Error archiving users: {e}")
+            return False
@@ -0,0 +1,239 @@
+import threading
+import time
+from collections import Counter, deque
+import cv2
+import numpy as np
+import models
+from config import FAST_DETECTOR_SIZE, FAST_DETECTOR_MIN_CONFIDENCE
+
+# Most recent detections, newest last, for the stats panel
+RECENT_LIMIT = 200
+
+# Bump whenever the way faces are cut changes: galleries, stored crops and
+# checkpoints made with another version are rebuilt rather than mixed
+CROP_VERSION = 'crop-v2'
+
+_cascade = None
+_eye_cascade = None
+_cascade_lock = threading.Lock()
+_stats = Counter()
+_recent = deque(maxlen=RECENT_LIMIT)
+_stats_lock = threading.Lock()
+
+
+def get_face_cascade():
+    """OpenCV Haar frontal-face cascade shared by the whole process"""
+    global _cascade
+
+    with _cascade_lock:
+        if _cascade is None:
+            _cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+        return _cascade
+
+
+def get_eye_cascade():
+    """OpenCV Haar eye cascade shared by the whole process"""
+    global _eye_cascade
+
+    with _cascade_lock:
+        if _eye_cascade is None:
+            _eye_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_eye.xml')
+        return _eye_cascade
+
+
+def downscale_gray(image, max_side):
+    """Grayscale copy of an RGB array with its longest side at most max_side, and the scale used"""
+    scale = min(1.0, max_side / max(image.shape[:2]))
+    if scale < 1:
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY) if image.ndim == 3 else image
+    return gray, scale
+
+
+def haar_faces(gray, min_fraction=0.05):
+    """Run the Haar cascade; returns (boxes, confidences) in gray-image coordinates"""
+    min_side = max(int(min(gray.shape[:2]) * min_fraction), 12)
+    boxes, _, weights = get_face_cascade().detectMultiScale3(
+        gray, scaleFactor=1.1, minNeighbors=5, minSize=(min_side, min_side), outputRejectLevels=True
+    )
+    if len(boxes) == 0:
+        return np.empty((0, 4), dtype=np.int32), np.empty(0)
+    return np.asarray(boxes), np.asarray(weights).ravel()
+
+
+def haar_eyes(gray, x, y, w, h):
+    """
+    Eye centres inside a face box, searched in its upper half.
+    Returns ((x, y), (x, y)) ordered left to right in the image, or None.
+    """
+    roi = gray[y:y + h // 2, x:x + w]
+    min_side = max(w // 8, 5)
+    eyes = get_eye_cascade().detectMultiScale(roi, scaleFactor=1.1, minNeighbors=5, minSize=(min_side, min_side))
+    if len(eyes) < 2:
+        return None
+
+    largest = sorted(eyes, key=lambda e: e[2] * e[3], reverse=True)[:2]
+    centres = sorted((x + ex + ew / 2.0, y + ey + eh / 2.0) for ex, ey, ew, eh in largest)
+    return centres[0], centres[1]
+
+
+def _crop(image, x, y, w, h, eyes=None, margin=0.1):
+    """
+    Face crop with a small margin, as RGB floats in [0, 1] like DeepFace.extract_faces.
+    When eye centres are known the face is rotated so the eyes are level.
+    """
+    if eyes is not None:
+        (lx, ly), (rx, ry) = eyes
+        angle = np.degrees(np.arctan2(ry - ly, rx - lx))
+        if abs(angle) > 1:
+            # Rotate a padded window around the face only, not the whole frame
+            pad = int(max(w, h) * 0.5)
+            top, left = max(y - pad, 0), max(x - pad, 0)
+            window = image[top:min(y + h + pad, image.shape[0]), left:min(x + w + pad, image.shape[1])]
+            centre = (x - left + w / 2.0, y - top + h / 2.0)
+            rotation = cv2.getRotationMatrix2D(centre, angle, 1.0)
+            window = cv2.warpAffine(window, rotation, (window.shape[1], window.shape[0]), flags=cv2.INTER_LINEAR)
+            image, x, y = window, x - left, y - top
+
+    pad_w, pad_h = int(w * margin), int(h * margin)
+    top, left = max(y - pad_h, 0), max(x - pad_w, 0)
+    bottom, right = min(y + h + pad_h, image.shape[0]), min(x + w + pad_w, image.shape[1])
+    return image[top:bottom, left:right].astype(np.float32) / 255.0
+
+
+def _fast_stage(image):
+    """Haar cascade on a downscaled frame; only confident detections count"""
+    gray, scale = downscale_gray(image, FAST_DETECTOR_SIZE)
+    boxes, weights = haar_faces(gray)
+
+    faces = []
+    for (x, y, w, h), weight in zip(boxes, weights):
+        if weight < FAST_DETECTOR_MIN_CONFIDENCE:
+            continue
+
+        facial_area = {}
+        eyes = haar_eyes(gray, x, y, w, h)
+        if eyes is not None:
+            eyes = tuple((ex / scale, ey / scale) for ex, ey in eyes)
+            # Same convention as DeepFace: the person's left eye is on the image's right
+            facial_area['right_eye'] = tuple(int(round(v)) for v in eyes[0])
+            facial_area['left_eye'] = tuple(int(round(v)) for v in eyes[1])
+
+        x, y, w, h = (int(round(v / scale)) for v in (x, y, w, h))
+        facial_area.update({'x': x, 'y': y, 'w': w, 'h': h})
+        faces.append({
+            'facial_area': facial_area,
+            'confidence': float(weight),
+            'face': _crop(image, x, y, w, h, eyes)
+        })
+    return faces
+
+
+def _yunet_stage(image):
+    """
+    YuNet (OpenCV DNN backend) on a downscaled frame. Faces are aligned on
+    the five landmarks to SFace's template, from the full-resolution frame.
+    """
+    image_bgr = np.ascontiguousarray(image[:, :, ::-1])
+    scale = min(1.0, FAST_DETECTOR_SIZE / max(image.shape[:2]))
+    small = image_bgr
+    if scale < 1:
+        small = cv2.resize(image_bgr, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    faces = []
+    for row in models.yunet_detect(small):
+        row = row.copy()
+        row[:14] /= scale
+        x, y, w, h = (int(round(v)) for v in row[:4])
+        aligned = models.sface_align(image_bgr, row)
+        faces.append({
+            'facial_area': {
+                'x': max(x, 0), 'y': max(y, 0), 'w': w, 'h': h,
+                'right_eye': (int(round(row[4])), int(round(row[5]))),
+                'left_eye': (int(round(row[6])), int(round(row[7])))
+            },
+            'confidence': float(row[14]),
+            'face': aligned[:, :, ::-1].astype(np.float32) / 255.0
+        })
+    return faces
+
+
+def _heavy_stage(image):
+    """
+    DeepFace detector backend on the full-resolution frame. Only its boxes
+    and eyes are used: the crop is cut by _crop() exactly as for a Haar
+    detection, so an enrollment and a login agree whichever stage found the face.
+    """
+    models.get_detector()
+    face_objs = models.DeepFace.extract_faces(
+        img_path=np.ascontiguousarray(image[:, :, ::-1]),
+        detector_backend=models.DETECTOR_BACKEND,
+        enforce_detection=False
+    )
+
+    faces = []
+    # Without a detection DeepFace returns the whole frame at confidence 0
+    for obj in face_objs:
+        if obj.get('confidence', 0) <= 0:
+            continue
+        area = obj['facial_area']
+        x, y, w, h = (int(area[key]) for key in ('x', 'y', 'w', 'h'))
+        eyes = None
+        if area.get('right_eye') is not None and area.get('left_eye') is not None:
+            # The person's right eye is on the image's left
+            eyes = (tuple(area['right_eye']), tuple(area['left_eye']))
+        faces.append({'facial_area': area, 'confidence': obj['confidence'], 'face': _crop(image, x, y, w, h, eyes)})
+    return faces
+
+
+def detect(image):
+    """
+    Detect faces in a decoded RGB array with a two-stage cascade: the Haar
+    cascade on a downscaled frame first, the heavier DeepFace backend only
+    when that finds nothing confident. With the OpenCV DNN backend YuNet
+    runs alone, since SFace needs its landmarks for alignment. Returns a
+    list of {'facial_area', 'confidence', 'face', 'backend'} dicts.
+    """
+    record = {'backend': 'yunet' if models.USE_OPENCV_DNN else 'haar'}
+
+    start = time.perf_counter()
+    faces = _yunet_stage(image) if models.USE_OPENCV_DNN else _fast_stage(image)
+    record['fast_ms'] = (time.perf_counter() - start) * 1000
+
+    if not faces and not models.USE_OPENCV_DNN:
+        record['backend'] = models.DETECTOR_BACKEND
+        start = time.perf_counter()
+        faces = _heavy_stage(image)
+        record['heavy_ms'] = (time.perf_counter() - start) * 1000
+
+    for face in faces:
+        face['backend'] = record['backend']
+    record['faces'] = len(faces)
+
+    with _stats_lock:
+        _stats['requests'] += 1
+        _stats['heavy_runs' if 'heavy_ms' in record else 'fast_hits'] += 1
+        _recent.append(record)
+
+    return faces
+
+
+def detection_stats():
+    """Fast-path hit rate and mean per-stage timings over recent requests"""
+    with _stats_lock:
+        stats = dict(_stats)
+        recent = list(_recent)
+
+    requests = stats.get('requests', 0)
+    stats['fast_hit_rate'] = stats.get('fast_hits', 0) / requests if requests else None
+    fast = [r['fast_ms'] for r in recent]
+    heavy = [r['heavy_ms'] for r in recent if 'heavy_ms' in r]
+    stats['mean_fast_ms'] = float(np.mean(fast)) if fast else None
+    stats['mean_heavy_ms'] = float(np.mean(heavy)) if heavy else None
+    return stats
+
+
+def recent_detections():
+    """Per-request records (backend, fast_ms, heavy_ms, faces), newest last"""
+    with _stats_lock:
+        return list(_recent)
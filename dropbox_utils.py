@@ -1,3 +1,6 @@
+import json
+import os
+import time
 import streamlit as st
 import dropbox
 from dropbox.exceptions import AuthError, ApiError
@@ -10,9 +13,17 @@ from config import (
     DROPBOX_REFRESH_TOKEN, 
     LOG_FILE_PATH,
     IMAGES_FOLDER,
-    USER_DATA_FILE
+    USER_DATA_FILE,
+    GALLERY_FILE,
+    CROPS_FOLDER,
+    TEMPLATES_FOLDER,
+    ARCHIVE_IMAGES_FOLDER,
+    ARCHIVE_TEMPLATES_FOLDER
 )
 
+# Upload session chunk size for the gallery sidecar (Dropbox wants multiples of 4 MB)
+UPLOAD_CHUNK_BYTES = 8 * 2**20
+
 
 def get_dropbox_client():
     """Initializes and returns the Dropbox client using a refresh token."""
@@ -60,21 +71,28 @@ def upload_image_to_dropbox(dbx, image_content, user_id):
         dropbox_path = f"{IMAGES_FOLDER}/{user_id}.jpg"
         
         # Upload the image
-        dbx.files_upload(
+        metadata = dbx.files_upload(
             image_content, 
             dropbox_path, 
             mode=dropbox.files.WriteMode('overwrite')
         )
-        return True
     except ApiError as e:
         st.error(f"Error uploading image to Dropbox: {e}")
         return False
 
+    # Keep the embedding sidecar in step with the new photo
+    try:
+        import image  # imported here to avoid a circular import
+        image.update_gallery_entry(dbx, user_id, image_content, metadata.content_hash)
+    except Exception as e:
+        st.warning(f"Photo saved, but the face gallery could not be updated: {e}")
+    return True
+
 
-def download_image_from_dropbox(dbx, user_id):
-    """Downloads a user image from Dropbox."""
+def download_image_from_dropbox(dbx, user_id, folder=IMAGES_FOLDER):
+    """Downloads a user image from Dropbox (from ARCHIVE_IMAGES_FOLDER for archived students)."""
     try:
-        dropbox_path = f"{IMAGES_FOLDER}/{user_id}.jpg"
+        dropbox_path = f"{folder}/{user_id}.jpg"
         _, res = dbx.files_download(path=dropbox_path)
         return res.content
     except ApiError as e:
@@ -84,17 +102,156 @@ def download_image_from_dropbox(dbx, user_id):
         return None
 
 
+def upload_template_to_dropbox(dbx, image_content, user_id, refresh=True):
+    """
+    Uploads an extra enrollment photo of a student (kept next to the main photo).
+    Pass refresh=False when uploading several, and refresh the gallery once after.
+    """
+    try:
+        create_folder(dbx, f"{TEMPLATES_FOLDER}/{user_id}")
+        dbx.files_upload(
+            image_content,
+            f"{TEMPLATES_FOLDER}/{user_id}/{int(time.time() * 1000)}.jpg",
+            mode=dropbox.files.WriteMode('add')
+        )
+    except ApiError as e:
+        st.error(f"Error uploading enrollment photo to Dropbox: {e}")
+        return False
+
+    if not refresh:
+        return True
+    try:
+        import image  # imported here to avoid a circular import
+        image.refresh_gallery(dbx)
+    except Exception as e:
+        st.warning(f"Photo saved, but the face gallery could not be updated: {e}")
+    return True
+
+
+def download_template_from_dropbox(dbx, path):
+    """Downloads an extra enrollment photo by its Dropbox path."""
+    try:
+        _, res = dbx.files_download(path=path)
+        return res.content
+    except ApiError as e:
+        st.error(f"Error downloading enrollment photo from Dropbox: {e}")
+        return None
+
+
+def list_template_hashes(dbx):
+    """
+    Returns {user_id: {path: content_hash}} for every extra enrollment photo in Dropbox,
+    or None if the listing failed (not the same as no extra photos).
+    """
+    try:
+        result = dbx.files_list_folder(TEMPLATES_FOLDER, recursive=True)
+        templates = {}
+
+        while True:
+            for entry in result.entries:
+                if isinstance(entry, dropbox.files.FileMetadata):
+                    user_id = entry.path_display.rstrip('/').split('/')[-2]
+                    templates.setdefault(user_id, {})[entry.path_display] = entry.content_hash
+
+            if not result.has_more:
+                break
+            result = dbx.files_list_folder_continue(result.cursor)
+
+        return templates
+    except ApiError as e:
+        if e.error.is_path() and e.error.get_path().is_not_found():
+            # No student has extra photos yet
+            return {}
+        st.error(f"Error listing enrollment photos from Dropbox: {e}")
+        return None
+
+
+def list_student_template_hashes(dbx, user_id):
+    """
+    Returns {path: content_hash} of one student's extra enrollment photos,
+    or None if the listing failed (not the same as no extra photos).
+    """
+    try:
+        result = dbx.files_list_folder(f"{TEMPLATES_FOLDER}/{user_id}")
+        templates = {}
+
+        while True:
+            for entry in result.entries:
+                if isinstance(entry, dropbox.files.FileMetadata):
+                    templates[entry.path_display] = entry.content_hash
+
+            if not result.has_more:
+                break
+            result = dbx.files_list_folder_continue(result.cursor)
+
+        return templates
+    except ApiError as e:
+        if e.error.is_path() and e.error.get_path().is_not_found():
+            return {}
+        st.error(f"Error listing enrollment photos from Dropbox: {e}")
+        return None
+
+
+def upload_face_crop_to_dropbox(dbx, user_id, crop_bytes, landmarks):
+    """Uploads a student's aligned, model-ready face crop and its landmarks."""
+    try:
+        create_folder(dbx, CROPS_FOLDER)
+        dbx.files_upload(
+            crop_bytes,
+            f"{CROPS_FOLDER}/{user_id}.jpg",
+            mode=dropbox.files.WriteMode('overwrite')
+        )
+        dbx.files_upload(
+            json.dumps(landmarks).encode('utf-8'),
+            f"{CROPS_FOLDER}/{user_id}.json",
+            mode=dropbox.files.WriteMode('overwrite')
+        )
+        return True
+    except ApiError as e:
+        st.error(f"Error uploading face crop to Dropbox: {e}")
+        return False
+
+
+def download_face_crop_from_dropbox(dbx, user_id):
+    """Downloads a student's face crop and landmarks; (None, None) if there is none."""
+    try:
+        _, res = dbx.files_download(path=f"{CROPS_FOLDER}/{user_id}.json")
+        landmarks = json.loads(res.content)
+        _, res = dbx.files_download(path=f"{CROPS_FOLDER}/{user_id}.jpg")
+        return res.content, landmarks
+    except ApiError as e:
+        if isinstance(e.error, dropbox.files.DownloadError):
+            return None, None
+        st.error(f"Error downloading face crop from Dropbox: {e}")
+        return None, None
+
+
+def delete_face_crop_from_dropbox(dbx, user_id):
+    """Deletes a student's face crop and landmarks, if present."""
+    for extension in ('jpg', 'json'):
+        try:
+            dbx.files_delete_v2(f"{CROPS_FOLDER}/{user_id}.{extension}")
+        except ApiError:
+            pass  # Never created, nothing to delete
+
+
 def list_all_user_images(dbx):
     """Lists all user image IDs stored in Dropbox."""
     try:
         result = dbx.files_list_folder(IMAGES_FOLDER)
         user_ids = []
         
-        for entry in result.entries:
-            if isinstance(entry, dropbox.files.FileMetadata):
-                # Extract user_id from filename (remove .jpg extension)
-                user_id = entry.name.replace('.jpg', '')
-                user_ids.append(user_id)
+        while True:
+            for entry in result.entries:
+                if isinstance(entry, dropbox.files.FileMetadata):
+                    # Extract user_id from filename (remove .jpg extension)
+                    user_id = entry.name.replace('.jpg', '')
+                    user_ids.append(user_id)
+
+            # Large schools span several listing pages
+            if not result.has_more:
+                break
+            result = dbx.files_list_folder_continue(result.cursor)
         
         return user_ids
     except ApiError as e:
@@ -105,10 +262,86 @@ def list_all_user_images(dbx):
         return []
 
 
-def read_user_data_from_dropbox(dbx):
+def list_user_image_hashes(dbx, folder=IMAGES_FOLDER):
+    """
+    Returns a {user_id: content_hash} mapping for all user images in Dropbox,
+    or None if the listing failed (not the same as no images).
+    """
+    try:
+        result = dbx.files_list_folder(folder)
+        hashes = {}
+
+        while True:
+            for entry in result.entries:
+                if isinstance(entry, dropbox.files.FileMetadata):
+                    user_id = entry.name.replace('.jpg', '')
+                    hashes[user_id] = entry.content_hash
+
+            if not result.has_more:
+                break
+            result = dbx.files_list_folder_continue(result.cursor)
+
+        return hashes
+    except ApiError as e:
+        if e.error.is_path() and e.error.get_path().is_not_found():
+            # Folder doesn't exist yet
+            return {}
+        st.error(f"Error listing images from Dropbox: {e}")
+        return None
+
+
+def download_gallery_from_dropbox(dbx, path=GALLERY_FILE):
+    """Downloads the serialized embedding gallery, or None if there isn't one yet."""
+    try:
+        _, res = dbx.files_download(path=path)
+        return res.content
+    except ApiError as e:
+        if isinstance(e.error, dropbox.files.DownloadError):
+            return None
+        st.error(f"Error downloading face gallery from Dropbox: {e}")
+        return None
+
+
+def upload_gallery_to_dropbox(dbx, gallery, path=GALLERY_FILE):
+    """
+    Uploads the serialized embedding gallery (bytes, or the path of a file
+    written by Gallery.write) next to the user data file. Anything over one
+    chunk goes up in an upload session, which Dropbox's 150 MB limit on a
+    single upload doesn't apply to, and only a chunk is in memory at a time.
+    """
+    try:
+        if isinstance(gallery, (bytes, bytearray)):
+            f, size = BytesIO(gallery), len(gallery)
+        else:
+            f, size = open(gallery, 'rb'), os.path.getsize(gallery)
+        with f:
+            _upload_file(dbx, f, size, path)
+        return True
+    except Exception as e:
+        # Connection errors and oversized payloads are not ApiErrors, but the gallery is unsaved all the same
+        st.error(f"Error uploading face gallery to Dropbox: {e}")
+        return False
+
+
+def _upload_file(dbx, f, size, path, chunk_bytes=UPLOAD_CHUNK_BYTES):
+    """Overwrite `path` with the contents of an open binary file, in one call or an upload session"""
+    mode = dropbox.files.WriteMode('overwrite')
+    if size <= chunk_bytes:
+        dbx.files_upload(f.read(), path, mode=mode)
+        return
+
+    session = dbx.files_upload_session_start(f.read(chunk_bytes))
+    cursor = dropbox.files.UploadSessionCursor(session_id=session.session_id, offset=f.tell())
+    while size - f.tell() > chunk_bytes:
+        dbx.files_upload_session_append_v2(f.read(chunk_bytes), cursor)
+        cursor.offset = f.tell()
+    dbx.files_upload_session_finish(f.read(), cursor, dropbox.files.CommitInfo(path=path, mode=mode))
+
+
+def read_user_data_from_dropbox(dbx, path=USER_DATA_FILE):
     """Reads user data Excel file from Dropbox."""
     try:
-        _, res = dbx.files_download(path=USER_DATA_FILE)
+        _, res = dbx.files_download(path=path)
         return pd.read_excel(BytesIO(res.content))
     except ApiError as e:
         if isinstance(e.error, dropbox.files.DownloadError):
@@ -118,7 +351,7 @@ def read_user_data_from_dropbox(dbx):
         return pd.DataFrame(columns=['id', 'name', 'dob', 'class'])
 
 
-def save_user_data_to_dropbox(dbx, df):
+def save_user_data_to_dropbox(dbx, df, path=USER_DATA_FILE):
     """Saves user data DataFrame to Dropbox as Excel file."""
     try:
         output = BytesIO()
@@ -129,7 +362,7 @@ def save_user_data_to_dropbox(dbx, df):
         
         dbx.files_upload(
             processed_data, 
-            USER_DATA_FILE, 
+            path, 
             mode=dropbox.files.WriteMode('overwrite')
         )
         return True
@@ -175,22 +408,61 @@ def log_activity(dbx, username, role="Student"):
         return False
 
 
+def archive_user_files_in_dropbox(dbx, user_id):
+    """
+    Moves a student's photo and extra enrollment photos into the archive
+    folder. The face crop is deleted: it is cut again from the photo if the
+    student is ever restored.
+    """
+    moves = [
+        (f"{IMAGES_FOLDER}/{user_id}.jpg", f"{ARCHIVE_IMAGES_FOLDER}/{user_id}.jpg"),
+        (f"{TEMPLATES_FOLDER}/{user_id}", f"{ARCHIVE_TEMPLATES_FOLDER}/{user_id}")
+    ]
+    for from_path, to_path in moves:
+        try:
+            dbx.files_move_v2(from_path, to_path)
+        except ApiError as e:
+            if e.error.is_from_lookup() and e.error.get_from_lookup().is_not_found():
+                continue  # No extra enrollment photos
+            st.error(f"Error archiving {from_path} in Dropbox: {e}")
+            return False
+    delete_face_crop_from_dropbox(dbx, user_id)
+    return True
+
+
 def delete_user_from_dropbox(dbx, user_id):
     """Deletes a user's image from Dropbox."""
     try:
         dropbox_path = f"{IMAGES_FOLDER}/{user_id}.jpg"
         dbx.files_delete_v2(dropbox_path)
-        return True
     except ApiError as e:
         st.error(f"Error deleting image from Dropbox: {e}")
         return False
 
+    delete_face_crop_from_dropbox(dbx, user_id)
+    try:
+        dbx.files_delete_v2(f"{TEMPLATES_FOLDER}/{user_id}")
+    except ApiError:
+        pass  # No extra enrollment photos
+
+    # Drop the student from the embedding sidecar as well
+    try:
+        import image  # imported here to avoid a circular import
+        image.remove_gallery_entry(dbx, user_id)
+    except Exception as e:
+        st.warning(f"Photo deleted, but the face gallery could not be updated: {e}")
+    return True
+
 
 def clear_all_data(dbx):
     """Clears all user data from Dropbox (use with caution!)"""
     try:
-        # Delete the entire AI_NANBAN folder
+        # Delete the entire AI_NANBAN folder (including the face gallery)
         dbx.files_delete_v2("/AI_NANBAN")
+
+        # Forget the in-memory gallery too
+        import image  # imported here to avoid a circular import
+        image.reset_gallery()
         
         # Recreate empty folders
         create_folder(dbx, "/AI_NANBAN")
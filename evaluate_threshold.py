@@ -0,0 +1,286 @@
+"""
+Offline verification evaluation: ROC, FAR and FRR curves and a recommended
+match threshold per recognition backend, from a labelled photo set.
+
+The photos are laid out one folder per person, as for bench_backends.py:
+
+    test_photos/
+        alice/1.jpg, alice/2.jpg, ...
+        bob/1.jpg, ...
+
+Each backend embeds every photo once, in a fresh process. The embeddings are
+cached in --cache, so reruns and threshold experiments skip the model. All
+pairs are then scored in blocks of rows. Each block's distances go straight
+into fixed-width histograms of genuine (same person) and impostor distances.
+Memory stays at about --block-mb, however many photos there are; only the
+histograms are kept.
+
+FAR(t) is the share of impostor pairs closer than t (wrongly accepted).
+FRR(t) is the share of genuine pairs at t or further (wrongly rejected, i.e.
+a retry at the camera). The recommended threshold is the largest one whose
+FAR stays at or under --target-far. The equal-error threshold is reported too.
+Apply the result with the MATCH_THRESHOLD setting.
+
+Usage:
+    python evaluate_threshold.py --images test_photos/
+    python evaluate_threshold.py --images test_photos/ --backends opencv_dnn deepface:Facenet512 --target-far 0.0001
+    python evaluate_threshold.py --images test_photos/ --curves curves/ --json
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+from bench_backends import DEFAULT_BACKENDS, backend_env, create_requested_backend, find_images
+
+# Histogram resolution; thresholds are reported to this many steps over the distance range
+BINS = 4000
+
+
+def _cache_path(cache_dir, backend, image_paths):
+    """Embedding cache file for a backend and photo set"""
+    digest = hashlib.sha256('\n'.join(image_paths).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(cache_dir, f"{backend.replace(':', '_')}-{digest}.npz")
+
+
+def embed_images(image_paths, requested):
+    """Runs inside the child process: embed every photo with the requested backend ("name" or "name:model")"""
+    import preprocess
+
+    backend = create_requested_backend(requested)
+    if not backend.available():
+        raise RuntimeError(f"{backend.name} is not available in this environment")
+
+    embeddings, kept = [], []
+    for i, path in enumerate(image_paths):
+        with open(path, 'rb') as f:
+            embedding = backend.embed_image(preprocess.prepare_image(f.read()))
+        if embedding is not None:
+            embeddings.append(np.asarray(embedding, dtype=np.float32).ravel())
+            kept.append(i)
+    return backend, kept, np.stack(embeddings) if embeddings else np.empty((0, 0), dtype=np.float32)
+
+
+def pair_histograms(embeddings, labels, metric, block_mb=256):
+    """
+    Histograms of genuine and impostor distances over every unordered pair,
+    computed block by block. Returns (edges, genuine_counts, impostor_counts).
+    """
+    n = len(embeddings)
+    x = embeddings.astype(np.float32)
+    if metric == 'cosine':
+        x = x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+        upper = 2.0
+    else:
+        upper = 2.0 * float(np.linalg.norm(x, axis=1).max()) if n else 1.0
+    squared_norms = np.einsum('ij,ij->i', x, x)
+    labels = np.asarray(labels)
+
+    # About 32 bytes per pair in a block: distances, bin numbers, masks and their copies
+    rows_per_block = max(1, int(block_mb * 2**20 / (32 * max(n, 1))))
+    scale = BINS / upper
+    genuine = np.zeros(BINS, dtype=np.int64)
+    impostor = np.zeros(BINS, dtype=np.int64)
+
+    for start in range(0, n, rows_per_block):
+        stop = min(start + rows_per_block, n)
+        # Only columns after each row, so every pair is counted once
+        columns = slice(start + 1, n)
+        if start + 1 >= n:
+            break
+
+        products = x[start:stop] @ x[columns].T
+        if metric == 'cosine':
+            distances = 1.0 - products
+        else:
+            distances = np.sqrt(np.maximum(
+                squared_norms[start:stop, np.newaxis] + squared_norms[np.newaxis, columns] - 2.0 * products, 0.0
+            ))
+
+        row_index = np.arange(start, stop)[:, np.newaxis]
+        column_index = np.arange(start + 1, n)[np.newaxis, :]
+        valid = column_index > row_index
+        same = labels[start:stop, np.newaxis] == labels[np.newaxis, columns]
+
+        bins = np.clip((distances * scale).astype(np.int64), 0, BINS - 1)
+        genuine += np.bincount(bins[valid & same], minlength=BINS)
+        impostor += np.bincount(bins[valid & ~same], minlength=BINS)
+
+    edges = np.linspace(0.0, upper, BINS + 1)
+    return edges, genuine, impostor
+
+
+def error_curves(edges, genuine, impostor):
+    """
+    FAR and FRR at every histogram edge t (accept when distance < t).
+    Returns (thresholds, far, frr); entries are NaN when a pair kind is missing.
+    """
+    accepted_genuine = np.concatenate([[0], np.cumsum(genuine)])
+    accepted_impostor = np.concatenate([[0], np.cumsum(impostor)])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        far = accepted_impostor / impostor.sum()
+        frr = 1.0 - accepted_genuine / genuine.sum()
+    return edges, far, frr
+
+
+def summarise(thresholds, far, frr, target_far, current_threshold):
+    """Recommended threshold, equal error point and the rates at the current threshold"""
+    summary = {'target_far': target_far}
+
+    within = np.flatnonzero(far <= target_far)
+    if len(within) and not np.isnan(frr).all():
+        best = within[-1]
+        summary.update(recommended_threshold=float(thresholds[best]), far=float(far[best]), frr=float(frr[best]))
+
+    if not np.isnan(far).all() and not np.isnan(frr).all():
+        eer = int(np.nanargmin(np.abs(far - frr)))
+        summary.update(eer_threshold=float(thresholds[eer]), eer=float((far[eer] + frr[eer]) / 2))
+
+    if current_threshold is not None:
+        current = min(int(np.searchsorted(thresholds, current_threshold)), len(thresholds) - 1)
+        summary.update(current_threshold=current_threshold, current_far=float(far[current]), current_frr=float(frr[current]))
+    return summary
+
+
+def write_curve(path, thresholds, far, frr):
+    """CSV of threshold, FAR, FRR and TAR (1 - FRR); plot FAR against TAR for the ROC"""
+    with open(path, 'w') as f:
+        f.write("threshold,far,frr,tar\n")
+        for t, a, r in zip(thresholds, far, frr):
+            f.write(f"{t:.5f},{a:.6g},{r:.6g},{1 - r:.6g}\n")
+
+
+def run_child(args, image_paths):
+    """Embed the photos and write them to the cache file named by --output"""
+    start = time.perf_counter()
+    backend, kept, embeddings = embed_images(image_paths, args.child)
+    np.savez(
+        args.output,
+        embeddings=embeddings,
+        kept=np.array(kept, dtype=np.int64),
+        metric=np.array(backend.metric),
+        threshold=np.array(backend.threshold),
+        backend=np.array(f"{backend.name}:{backend.model_name}")
+    )
+    print(json.dumps({'embed_s': time.perf_counter() - start}))
+
+
+def load_embeddings(backend, args, image_paths):
+    """Cached embeddings of a backend, computed in a fresh process when missing"""
+    path = _cache_path(args.cache, backend, image_paths)
+    if not os.path.exists(path) or args.refresh:
+        os.makedirs(args.cache, exist_ok=True)
+        command = [sys.executable, os.path.abspath(__file__), '--child', backend, '--images', args.images, '--output', path]
+        completed = subprocess.run(command, env=backend_env(backend), capture_output=True, text=True)
+        if completed.returncode != 0 or not os.path.exists(path):
+            raise RuntimeError((completed.stderr.strip().splitlines() or ['no output'])[-1])
+
+    with np.load(path, allow_pickle=False) as payload:
+        embedded_with = str(payload['backend'])
+        if embedded_with.partition(':')[0] != backend.partition(':')[0]:
+            raise RuntimeError(f"{path} holds {embedded_with} embeddings, not {backend}; rerun with --refresh")
+        return (
+            embedded_with,
+            payload['embeddings'],
+            payload['kept'],
+            str(payload['metric']),
+            float(payload['threshold'])
+        )
+
+
+def evaluate(backend, args, image_paths, labels):
+    """Result dict for one backend"""
+    try:
+        name, embeddings, kept, metric, default_threshold = load_embeddings(backend, args, image_paths)
+    except Exception as e:
+        return {'backend': backend, 'error': str(e)}
+
+    start = time.perf_counter()
+    edges, genuine, impostor = pair_histograms(embeddings, labels[kept], metric, args.block_mb)
+    thresholds, far, frr = error_curves(edges, genuine, impostor)
+
+    result = {
+        'backend': name,
+        'metric': metric,
+        'images': len(image_paths),
+        'embedded': len(kept),
+        'genuine_pairs': int(genuine.sum()),
+        'impostor_pairs': int(impostor.sum()),
+        'scoring_s': time.perf_counter() - start
+    }
+    result.update(summarise(thresholds, far, frr, args.target_far, default_threshold))
+
+    if args.curves:
+        os.makedirs(args.curves, exist_ok=True)
+        result['curve'] = os.path.join(args.curves, f"{backend.replace(':', '_')}.csv")
+        write_curve(result['curve'], thresholds, far, frr)
+    return result
+
+
+def print_table(results):
+    columns = [
+        ('backend', 'backend', '{}', 26),
+        ('embedded', 'photos', '{}', 7),
+        ('genuine_pairs', 'genuine', '{}', 9),
+        ('impostor_pairs', 'impostor', '{}', 10),
+        ('current_threshold', 'current', '{:.3f}', 8),
+        ('current_far', 'FAR', '{:.4f}', 7),
+        ('current_frr', 'FRR', '{:.4f}', 7),
+        ('recommended_threshold', 'recommend', '{:.3f}', 10),
+        ('far', 'FAR', '{:.4f}', 7),
+        ('frr', 'FRR', '{:.4f}', 7),
+        ('eer', 'EER', '{:.4f}', 7),
+        ('scoring_s', 'score s', '{:.2f}', 8)
+    ]
+    print(' '.join(f"{title:>{width}}" for _, title, _, width in columns))
+    for result in results:
+        cells = [
+            (fmt.format(result[key]) if result.get(key) is not None else '-', width)
+            for key, _, fmt, width in columns
+        ]
+        print(' '.join(f"{cell:>{width}}" for cell, width in cells))
+        if 'error' in result:
+            print(f"{'':>26} ⚠️ {result['error']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", required=True, help="labelled photos, one folder per person")
+    parser.add_argument("--backends", nargs="+", default=DEFAULT_BACKENDS, help="backend or backend:model")
+    parser.add_argument("--target-far", type=float, default=0.001, help="highest acceptable false-accept rate")
+    parser.add_argument("--block-mb", type=int, default=256, help="memory budget of one scoring block")
+    parser.add_argument("--cache", default=".eval_cache", help="directory for cached embeddings")
+    parser.add_argument("--refresh", action="store_true", help="re-embed even if cached")
+    parser.add_argument("--curves", default="", help="directory to write per-backend FAR/FRR CSV curves")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    image_paths = find_images(args.images)
+    if args.child:
+        run_child(args, image_paths)
+        return
+    if not image_paths:
+        parser.error(f"no photos found under {args.images}")
+
+    labels = np.array([os.path.basename(os.path.dirname(path)) for path in image_paths])
+    results = [evaluate(backend, args, image_paths, labels) for backend in args.backends]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print_table(results)
+    for result in results:
+        if result.get('recommended_threshold') is not None:
+            print(f"\n✅ {result['backend']}: MATCH_THRESHOLD={result['recommended_threshold']:.3f} "
+                  f"(FAR {result['far']:.4f}, FRR {result['frr']:.4f} at target FAR {args.target_far})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import numpy as np
+from io import BytesIO
+from PIL import Image
+import detection
+import models
+
+# Crops are small and re-embedded often, keep them close to lossless
+CROP_JPEG_QUALITY = 95
+
+
+def make_face_crop(image, content_hash=None, model_name=None):
+    """
+    Aligned, model-ready crop of the most prominent face in a decoded RGB array.
+
+    The face is eye-levelled by the detector and padded/resized to the
+    recognition model's input size, so re-embedding it later needs no
+    detection. Like embed_face(), a frame without a detectable face falls
+    back to the whole frame. Returns (uint8 RGB crop, landmarks) where the
+    landmarks record the facial area, the detector backend, the model the
+    crop was sized for, the crop version and the content hash of the photo
+    it was cut from.
+    """
+    faces = detection.detect(image)
+    if faces:
+        face = max(faces, key=lambda f: f['facial_area']['w'] * f['facial_area']['h'])
+        face_array, facial_area, backend = face['face'], face['facial_area'], face['backend']
+    else:
+        face_array, facial_area, backend = image.astype(np.float32) / 255.0, None, None
+
+    crop = np.clip(models.model_ready_face(face_array) * 255.0, 0, 255).astype(np.uint8)
+    landmarks = {
+        'facial_area': {key: _plain(value) for key, value in facial_area.items()} if facial_area else None,
+        'backend': backend,
+        'model_name': model_name or models.RECOGNITION_MODEL,
+        'preprocessing': detection.CROP_VERSION,
+        'source_hash': content_hash
+    }
+    return crop, landmarks
+
+
+def _plain(value):
+    """JSON-friendly copy of a facial_area value (ints or (x, y) eye points)"""
+    if isinstance(value, (tuple, list)):
+        return [int(v) for v in value]
+    return int(value) if value is not None else None
+
+
+def encode_crop(crop):
+    """JPEG bytes of a uint8 RGB crop"""
+    buffer = BytesIO()
+    Image.fromarray(crop).save(buffer, format='JPEG', quality=CROP_JPEG_QUALITY)
+    return buffer.getvalue()
+
+
+def decode_crop(crop_bytes):
+    """Stored crop back to RGB floats in [0, 1], ready for models.embed_face_batch"""
+    return np.asarray(Image.open(BytesIO(crop_bytes)).convert('RGB'), dtype=np.float32) / 255.0
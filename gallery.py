@@ -0,0 +1,630 @@
+import os
+import zipfile
+from contextlib import nullcontext
+import numpy as np
+from io import BytesIO
+from quantized import QuantizedCodes, open_memmap
+
+
+class Gallery:
+    """
+    In-memory gallery holding one face embedding per registered student.
+    Rows of `embeddings` line up with `ids`, so a login is a single
+    matrix-vector product instead of one model call per student.
+
+    Students enrolled with several photos keep all of them as templates,
+    and their row holds the templates' centroid. Searches score centroids
+    first (through the index, if any) and then refine the top `refine_top`
+    students on their individual templates.
+    """
+
+    def __init__(self, model_name, metric='cosine', preprocessing=None):
+        self.model_name = model_name
+        self.metric = metric
+        # Face-cutting version the embeddings were made with (see backends.RecognitionBackend)
+        self.preprocessing = preprocessing
+        self.ids = []
+        self.hashes = {}
+        self.index = None
+        self.index_min_size = 0
+        # IDs added or moved while a replacement index trains, None when no build is running
+        self._index_changes = None
+        # Likewise while the quantized store is built
+        self._quantize_changes = None
+        self.quantized = None
+        self.quantize_min_size = 0
+        self.rerank = 0
+        # user_id -> (template keys, (m, d) prepared templates), only for m >= 2
+        self.templates = {}
+        # user_id -> content hash of photos that gave no embedding, so syncs skip them until they change
+        self.failures = {}
+        self.refine_top = 10
+        self._components = 256
+        self._directory = None
+        self._matrix = None
+        self._positions = {}
+        # Bumped on every row change, so a writer reading rows in blocks can tell it raced one
+        self.version = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, user_id):
+        return str(user_id) in self._positions
+
+    @property
+    def embeddings(self):
+        """(N, d) view of the stored embeddings, or None when empty"""
+        if self._matrix is None:
+            return None
+        return self._matrix[:len(self.ids)]
+
+    def _prepare(self, embedding):
+        """Convert an embedding to a float32 row (unit length for cosine)"""
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        if self.metric == 'cosine':
+            norm = np.linalg.norm(vector)
+            if norm > 0:
+                vector = vector / norm
+        return vector
+
+    def set_templates(self, user_id, embeddings, keys, content_hash=None):
+        """
+        Store every enrollment embedding of a student (keys name them, e.g. by
+        photo content hash) and index their centroid. A single embedding is
+        stored as a plain row. Returns the row that was indexed.
+        """
+        user_id = str(user_id)
+        if len(embeddings) == 1:
+            self.add(user_id, embeddings[0], content_hash)
+            return embeddings[0]
+
+        templates = np.stack([self._prepare(embedding) for embedding in embeddings])
+        centroid = templates.mean(axis=0)
+        self.add(user_id, centroid, content_hash)
+        self.templates[user_id] = (list(keys), templates)
+        return centroid
+
+    def templates_of(self, user_id):
+        """{key: embedding} of a student's stored templates (empty for single-photo students)"""
+        keys, templates = self.templates.get(str(user_id), ([], []))
+        return dict(zip(keys, templates))
+
+    def entry(self, user_id):
+        """A student's (embeddings, keys, content_hash) as set_templates() takes them, or None"""
+        user_id = str(user_id)
+        if user_id not in self._positions:
+            return None
+        content_hash = self.hashes.get(user_id)
+        if user_id in self.templates:
+            keys, templates = self.templates[user_id]
+            return list(templates), list(keys), content_hash
+        return [np.array(self.embeddings[self._positions[user_id]])], [content_hash], content_hash
+
+    def add(self, user_id, embedding, content_hash=None):
+        """Add or replace the embedding stored for a student (replacing any templates)"""
+        user_id = str(user_id)
+        vector = self._prepare(embedding)
+
+        if self._matrix is None:
+            self._matrix = np.empty((16, vector.shape[0]), dtype=np.float32)
+        elif vector.shape[0] != self._matrix.shape[1]:
+            raise ValueError(
+                f"Embedding size {vector.shape[0]} does not match gallery size {self._matrix.shape[1]}"
+            )
+
+        self.hashes[user_id] = content_hash
+        self.templates.pop(user_id, None)
+        self.failures.pop(user_id, None)
+        if user_id in self._positions:
+            row = self._positions[user_id]
+        else:
+            # Grow geometrically so registrations don't copy the whole matrix
+            if len(self.ids) == len(self._matrix):
+                self._grow()
+
+            row = len(self.ids)
+            self._positions[user_id] = row
+            self.ids.append(user_id)
+
+        self._matrix[row] = vector
+        if self.quantized is not None:
+            self.quantized.set_row(row, vector)
+
+        if self.index is not None:
+            self.index.add(user_id, vector)
+        self._note_change(user_id)
+
+    def mark_failed(self, user_id, content_hash):
+        """Record that a student's photos at this content hash gave no embedding (no usable face)"""
+        self.failures[str(user_id)] = content_hash
+
+    def has_failed(self, user_id, content_hash):
+        """True if the student's photos at this content hash are known to give no embedding"""
+        return self.failures.get(str(user_id)) == content_hash
+
+    def remove(self, user_id):
+        """Remove a student from the gallery; returns False if not present"""
+        user_id = str(user_id)
+        self.failures.pop(user_id, None)
+        position = self._positions.pop(user_id, None)
+        if position is None:
+            return False
+
+        self.hashes.pop(user_id, None)
+        self.templates.pop(user_id, None)
+
+        # Move the last row into the freed slot so removal is O(d)
+        last = len(self.ids) - 1
+        if position != last:
+            moved = self.ids[last]
+            self._matrix[position] = self._matrix[last]
+            if self.quantized is not None:
+                self.quantized.copy_row(position, last)
+            self.ids[position] = moved
+            self._positions[moved] = position
+            self._note_change(moved)
+        self.ids.pop()
+
+        if self.index is not None:
+            self.index.remove(user_id)
+        self._note_change(user_id)
+        return True
+
+    def _note_change(self, user_id):
+        """Remember a rewritten row for the builds and writers running off the lock"""
+        self.version += 1
+        for changes in (self._index_changes, self._quantize_changes):
+            if changes is not None:
+                changes.add(user_id)
+
+    def _grow(self):
+        """Double the row capacity, on disk when the gallery is memory-mapped"""
+        capacity = 2 * len(self._matrix)
+        if not isinstance(self._matrix, np.memmap):
+            grown = np.empty((capacity, self._matrix.shape[1]), dtype=np.float32)
+            grown[:len(self.ids)] = self._matrix[:len(self.ids)]
+            self._matrix = grown
+            return
+
+        self._matrix = self._open_full_matrix(capacity)
+        if self.quantized is not None:
+            self.quantized.allocate(capacity)
+
+    def _open_full_matrix(self, capacity):
+        """Write the embeddings to a memory-mapped file with room for `capacity` rows"""
+        path = os.path.join(self._directory, 'embeddings.npy')
+        matrix = open_memmap(path + '.tmp', (capacity, self._matrix.shape[1]), np.float32,
+                             copy_from=self._matrix[:len(self.ids)])
+        matrix.flush()
+        del matrix
+        os.replace(path + '.tmp', path)
+        return np.load(path, mmap_mode='r+')
+
+    def enable_quantization(self, directory, components=256, rerank=32, min_size=0):
+        """
+        Keep full-precision embeddings in a memory-mapped file under `directory`
+        and shortlist rows with PCA-reduced int8 codes (see quantized.py).
+        Only the `rerank` best coarse rows are scored at full precision.
+        Takes effect once the gallery holds `min_size` students and the store
+        has been built, with build_quantized() or begin/finish_quantize_build().
+        """
+        self._directory = directory
+        self.quantized = None
+        self._quantize_changes = None
+        self.quantize_min_size = max(min_size, rerank + 1)
+        self.rerank = rerank
+        self._components = components
+
+    def _quantized_ready(self):
+        """True if searches can shortlist on the quantized codes; never builds them"""
+        return self.quantized is not None
+
+    def quantize_due(self):
+        """True if quantization is enabled, not built yet, and the gallery is large enough"""
+        return (
+            self.quantized is None and self._directory is not None and self.metric == 'cosine'
+            and len(self.ids) >= self.quantize_min_size
+        )
+
+    def build_quantized(self):
+        """Build the quantized store now if it is due (blocks searches; for scripts and benchmarks)"""
+        job = self.begin_quantize_build()
+        if job is not None:
+            self.finish_quantize_build(*self.prepare_quantized(*job))
+
+    def begin_quantize_build(self):
+        """
+        Start building the quantized store away from the caller's lock.
+        Returns arguments for prepare_quantized(), or None if no build is due
+        or one is already running.
+        """
+        if self._quantize_changes is not None or not self.quantize_due():
+            return None
+        self._quantize_changes = set()
+        os.makedirs(self._directory, exist_ok=True)
+        codes = QuantizedCodes(os.path.join(self._directory, 'codes.npy'), self._components)
+        return codes, self.embeddings, len(self._matrix), isinstance(self._matrix, np.memmap)
+
+    def prepare_quantized(self, codes, rows, capacity, mapped):
+        """
+        The slow part of quantizing, safe to run without the caller's lock:
+        fit and write the codes and, unless the rows are already memory-mapped,
+        write them to a file. Returns arguments for finish_quantize_build().
+        """
+        codes.fit(rows)
+        codes.allocate(capacity, rows)
+        if mapped:
+            return codes, None, capacity
+
+        path = os.path.join(self._directory, 'embeddings.npy.building')
+        matrix = open_memmap(path, (capacity, rows.shape[1]), np.float32, copy_from=rows)
+        matrix.flush()
+        return codes, path, capacity
+
+    def finish_quantize_build(self, codes, matrix_path, capacity):
+        """Swap in a store from prepare_quantized(), catching up on rows rewritten since begin_quantize_build()"""
+        if self._quantize_changes is None:
+            return  # enable_quantization() or abort_quantize_build() since; this build is stale
+
+        if matrix_path is not None:
+            if len(self._matrix) != capacity:
+                # Grown in RAM meanwhile; the next begin_quantize_build() starts over
+                self.abort_quantize_build()
+                os.remove(matrix_path)
+                return
+            matrix = np.load(matrix_path, mmap_mode='r+')
+            for user_id in self._quantize_changes:
+                if user_id in self._positions:
+                    row = self._positions[user_id]
+                    matrix[row] = self._matrix[row]
+            matrix.flush()
+            os.replace(matrix_path, os.path.join(self._directory, 'embeddings.npy'))
+            self._matrix = matrix
+        elif len(self._matrix) > capacity:
+            codes.allocate(len(self._matrix))
+
+        for user_id in self._quantize_changes:
+            if user_id in self._positions:
+                row = self._positions[user_id]
+                codes.set_row(row, self._matrix[row])
+        self._quantize_changes = None
+        self.quantized = codes
+
+    def abort_quantize_build(self):
+        """Give up on a begin_quantize_build(); searches keep scanning the full rows"""
+        self._quantize_changes = None
+
+    def set_index(self, index, min_size=0):
+        """
+        Serve searches through an approximate index (see ann_index.IVFIndex)
+        once the gallery holds at least `min_size` students and the index
+        has been trained, with build_index() or begin/finish_index_build().
+        Until then searches scan exactly.
+        """
+        self.index = index
+        self.index_min_size = min_size
+        self._index_changes = None
+
+    def _index_ready(self):
+        """True if searches can go through the index; never trains it"""
+        return (
+            self.index is not None and self.index.is_trained and self.metric == 'cosine'
+            and len(self.ids) >= max(self.index_min_size, 1)
+        )
+
+    def index_stale(self):
+        """True if the index is due for (re)training: never trained, or the gallery has doubled since"""
+        if self.index is None or self.metric != 'cosine' or len(self.ids) < max(self.index_min_size, 1):
+            return False
+        # Retrain once the gallery has doubled, bucket balance degrades otherwise
+        return not self.index.is_trained or len(self.ids) > 2 * self.index.trained_size
+
+    def build_index(self):
+        """Train the index in place if it is stale (blocks searches; for scripts and benchmarks)"""
+        if self.index_stale():
+            self.index.train(list(self.ids), self.embeddings)
+
+    def begin_index_build(self):
+        """
+        Start training a replacement index away from the caller's lock.
+        Returns (untrained index, ids, rows) to pass to index.train(), or
+        None if no training is due or one is already running. Rows may be
+        rewritten meanwhile; finish_index_build() re-inserts those IDs.
+        """
+        if self._index_changes is not None or not self.index_stale():
+            return None
+        self._index_changes = set()
+        return self.index.fresh(), list(self.ids), self.embeddings
+
+    def finish_index_build(self, index):
+        """Swap in an index trained from begin_index_build(), catching up on the changes since"""
+        if self._index_changes is None:
+            return  # set_index() or abort_index_build() since; this build is stale
+        for user_id in self._index_changes:
+            if user_id in self._positions:
+                index.add(user_id, self._matrix[self._positions[user_id]])
+            else:
+                index.remove(user_id)
+        self._index_changes = None
+        self.index = index
+
+    def abort_index_build(self):
+        """Give up on a begin_index_build(); the current index keeps serving"""
+        self._index_changes = None
+
+    def _candidate_rows(self, query, k=1):
+        """Row positions worth scoring exactly, or None to score every row"""
+        if self._index_ready():
+            keys = self.index.candidates(query)
+            return np.fromiter((self._positions[key] for key in keys), dtype=np.int64, count=len(keys))
+
+        if self._quantized_ready():
+            rows = self.quantized.shortlist(query, len(self.ids), max(self.rerank, k))
+            # Sorted rows keep the memory-mapped reads sequential
+            return np.sort(rows)
+
+        return None
+
+    def _score(self, query, rows=None):
+        """Exact distances from the query to the given rows (all rows if None)"""
+        matrix = self.embeddings if rows is None else self.embeddings[rows]
+        if self.metric == 'cosine':
+            return 1.0 - matrix @ query
+
+        diff = matrix - query
+        return np.sqrt(np.einsum('ij,ij->i', diff, diff))
+
+    def distances(self, probe):
+        """Distance from the probe embedding to every row of the gallery"""
+        if not self.ids:
+            return np.empty(0, dtype=np.float32)
+        return self._score(self._prepare(probe))
+
+    def distance_matrix(self, probes):
+        """(len(probes), N) distances from several probes to every row"""
+        if not self.ids or len(probes) == 0:
+            return np.empty((len(probes), len(self.ids)), dtype=np.float32)
+
+        queries = np.stack([self._prepare(probe) for probe in probes])
+        distances = self._pairwise(queries, self.embeddings)
+
+        # Multi-photo students score on their closest template
+        for user_id, (_, templates) in self.templates.items():
+            column = self._positions[user_id]
+            distances[:, column] = self._pairwise(queries, templates).min(axis=1)
+        return distances
+
+    def _pairwise(self, queries, rows):
+        if self.metric == 'cosine':
+            return 1.0 - queries @ rows.T
+
+        # |a - b|^2 = |a|^2 + |b|^2 - 2ab, clipped against rounding below zero
+        squared = (
+            np.einsum('ij,ij->i', queries, queries)[:, np.newaxis]
+            + np.einsum('ij,ij->i', rows, rows)[np.newaxis, :]
+            - 2.0 * queries @ rows.T
+        )
+        return np.sqrt(np.maximum(squared, 0.0))
+
+    def search(self, probe, k=5, within=None):
+        """
+        Return the k closest students as a list of (user_id, distance).
+        `within` optionally limits the search to a set of user IDs (scanned exactly).
+        """
+        if not self.ids:
+            return []
+
+        query = self._prepare(probe)
+        # Centroids only shortlist; the final order comes from the templates
+        fetch = max(k, self.refine_top) if self.templates else k
+        if within is not None:
+            rows = np.array(sorted(self._positions[uid] for uid in map(str, within) if uid in self._positions), dtype=np.int64)
+            if len(rows) == 0:
+                return []
+        else:
+            rows = self._candidate_rows(query, fetch)
+            if rows is not None and len(rows) == 0:
+                rows = None
+        dists = self._score(query, rows)
+
+        fetch = min(fetch, dists.size)
+        top = np.argpartition(dists, fetch - 1)[:fetch]
+        top = top[np.argsort(dists[top])]
+        if rows is not None:
+            results = [(self.ids[rows[i]], float(dists[i])) for i in top]
+        else:
+            results = [(self.ids[i], float(dists[i])) for i in top]
+        return self.refine(query, results, k) if self.templates else results[:k]
+
+    def _template_distances(self, query, templates):
+        if self.metric == 'cosine':
+            return 1.0 - templates @ query
+        diff = templates - query
+        return np.sqrt(np.einsum('ij,ij->i', diff, diff))
+
+    def refine(self, probe, candidates, k):
+        """
+        Re-score centroid candidates [(user_id, distance)] on each student's
+        closest template and return the best k
+        """
+        query = self._prepare(probe)
+        refined = []
+        for user_id, distance in candidates:
+            if user_id in self.templates:
+                distance = float(self._template_distances(query, self.templates[user_id][1]).min())
+            refined.append((user_id, distance))
+        refined.sort(key=lambda result: result[1])
+        return refined[:k]
+
+    def match(self, probe, threshold):
+        """
+        Return (user_id, distance) for the best match under the threshold.
+        user_id is None when nobody is close enough.
+        """
+        best = self.search(probe, k=1)
+        if not best:
+            return None, None
+
+        user_id, distance = best[0]
+        if distance < threshold:
+            return user_id, distance
+        return None, distance
+
+    def to_bytes(self):
+        """Serialize the gallery to a compressed .npz payload"""
+        buffer = BytesIO()
+        self.write(buffer)
+        return buffer.getvalue()
+
+    def write(self, file, lock=None, block_bytes=8 * 2**20):
+        """
+        Write the to_bytes() payload to a file (a path or a writable binary
+        file), a block of rows at a time, so the matrix is never copied or
+        compressed whole in memory. With a lock, it is held only to take the
+        small columns and then each block, so searches go on meanwhile.
+        Returns False if rows changed under the writer; the file is then
+        incomplete and should be written again.
+        """
+        lock = lock or nullcontext()
+        with lock:
+            version = self.version
+            ids = list(self.ids)
+            hashes = [self.hashes.get(uid) or '' for uid in ids]
+            failures = dict(self.failures)
+            # Templates are replaced whole, never edited in place, so the arrays can be read later
+            templates = dict(self.templates)
+            dim = self._matrix.shape[1] if self._matrix is not None else 0
+
+        with zipfile.ZipFile(file, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+            def put(name, array):
+                with archive.open(name + '.npy', 'w', force_zip64=True) as f:
+                    np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
+
+            put('ids', np.array(ids, dtype=str))
+            put('hashes', np.array(hashes, dtype=str))
+            put('model_name', np.array(self.model_name))
+            put('metric', np.array(self.metric))
+            put('preprocessing', np.array(self.preprocessing or ''))
+            put('failed_ids', np.array(list(failures), dtype=str))
+            put('failed_hashes', np.array(list(failures.values()), dtype=str))
+
+            def matrix_blocks():
+                rows_per_block = max(1, block_bytes // max(dim * 4, 1))
+                for start in range(0, len(ids), rows_per_block):
+                    with lock:
+                        current = self.version == version
+                        rows = np.array(self._matrix[start:start + rows_per_block], dtype=np.float32) if current else None
+                    # Yielded with the lock released: compressing a block holds up no search
+                    yield rows
+                    if rows is None:
+                        return
+
+            if not _write_rows(archive, 'embeddings', len(ids), dim, matrix_blocks()):
+                return False
+
+            owners, keys, blocks = [], [], []
+            for user_id, (template_keys, rows) in templates.items():
+                owners.extend([user_id] * len(rows))
+                keys.extend(template_keys)
+                blocks.append(rows)
+            put('template_owners', np.array(owners, dtype=str))
+            put('template_keys', np.array(keys, dtype=str))
+            _write_rows(archive, 'templates', len(owners), blocks[0].shape[1] if blocks else 0, blocks)
+        return True
+
+    @classmethod
+    def from_arrays(cls, model_name, metric, ids, embeddings, hashes=None, preprocessing=None):
+        """Gallery over already prepared rows (e.g. another gallery's), without per-row copies"""
+        gallery = cls(model_name, metric=metric, preprocessing=preprocessing)
+        ids = [str(uid) for uid in ids]
+        if ids:
+            gallery.ids = ids
+            # asanyarray keeps a memory-mapped matrix mapped
+            gallery._matrix = np.asanyarray(embeddings, dtype=np.float32)
+            gallery.hashes = dict(zip(ids, hashes)) if hashes is not None else dict.fromkeys(ids)
+            gallery._positions = {uid: i for i, uid in enumerate(ids)}
+        return gallery
+
+    @classmethod
+    def from_bytes(cls, data, directory=None):
+        """
+        Rebuild a gallery from a payload written by to_bytes(). With a
+        directory, the embeddings are streamed into a memory-mapped file
+        there (see enable_quantization) instead of being unpacked into RAM.
+        """
+        with np.load(BytesIO(data), allow_pickle=False) as payload:
+            if directory is not None:
+                embeddings = _stream_to_memmap(payload.zip, 'embeddings.npy', directory)
+            else:
+                embeddings = payload['embeddings']
+            gallery = cls.from_arrays(
+                str(payload['model_name']),
+                str(payload['metric']),
+                payload['ids'],
+                embeddings,
+                [str(h) or None for h in payload['hashes']],
+                # Sidecars written before the crop version was recorded have none
+                (str(payload['preprocessing']) or None) if 'preprocessing' in payload.files else None
+            )
+            # Sidecars written before multi-photo enrollment have no templates
+            if 'templates' in payload.files and len(payload['template_owners']):
+                owners = [str(uid) for uid in payload['template_owners']]
+                keys = [str(key) for key in payload['template_keys']]
+                templates = payload['templates'].astype(np.float32)
+                for user_id in dict.fromkeys(owners):
+                    rows = [i for i, owner in enumerate(owners) if owner == user_id]
+                    gallery.templates[user_id] = ([keys[i] for i in rows], templates[rows])
+            if 'failed_ids' in payload.files:
+                gallery.failures = dict(zip(map(str, payload['failed_ids']), map(str, payload['failed_hashes'])))
+        return gallery
+
+
+def _stream_to_memmap(archive, member, directory, block_bytes=8 * 2**20):
+    """
+    Copy a 2-D .npy member of an .npz archive into a float32 memory-mapped
+    file in `directory`, a block at a time, so the array is never whole in RAM
+    """
+    with archive.open(member) as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        if fortran_order or len(shape) != 2 or shape[0] == 0:
+            # Empty, or not as to_bytes() writes it: small enough, or rare enough, to read whole
+            return np.frombuffer(f.read(), dtype=dtype).reshape(shape, order='F' if fortran_order else 'C')
+
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, 'embeddings.npy')
+        matrix = open_memmap(path + '.tmp', shape, np.float32)
+        rows_per_block = max(1, block_bytes // max(shape[1] * dtype.itemsize, 1))
+        for start in range(0, shape[0], rows_per_block):
+            count = min(rows_per_block, shape[0] - start)
+            block = np.frombuffer(f.read(count * shape[1] * dtype.itemsize), dtype=dtype)
+            matrix[start:start + count] = block.reshape(count, shape[1])
+        matrix.flush()
+        del matrix
+    # A fresh file, so mappings of the previous one (e.g. a gallery being replaced) stay valid
+    os.replace(path + '.tmp', path)
+    return np.load(path, mmap_mode='r+')
+
+
+def _write_rows(archive, name, count, dim, blocks):
+    """
+    Write a (count, dim) float32 .npy member to a zip archive from an
+    iterable of row blocks, never holding more than one block. Returns False,
+    leaving the member short, if a block is None.
+    """
+    header = {
+        'descr': np.lib.format.dtype_to_descr(np.dtype(np.float32)),
+        'fortran_order': False,
+        'shape': (count, dim) if count else (0, 0)
+    }
+    with archive.open(name + '.npy', 'w', force_zip64=True) as f:
+        np.lib.format.write_array_header_2_0(f, header)
+        for rows in blocks:
+            if rows is None:
+                return False
+            f.write(np.ascontiguousarray(rows, dtype=np.float32).tobytes())
+    return True
@@ -1,22 +1,126 @@
+import atexit
+import hashlib
+import math
 import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
 import streamlit as st
+import quality
+import preprocess
+import face_crops
+import backends
+import inference_worker
+import shard_pool
+import admission
 from dropbox_utils import (
     get_dropbox_client,
     upload_image_to_dropbox,
     download_image_from_dropbox,
-    list_all_user_images
+    upload_face_crop_to_dropbox,
+    download_face_crop_from_dropbox,
+    list_user_image_hashes,
+    list_template_hashes,
+    download_template_from_dropbox,
+    download_gallery_from_dropbox,
+    upload_gallery_to_dropbox,
+    read_user_data_from_dropbox
+)
+from gallery import Gallery
+from ann_index import IVFIndex
+from config import (
+    ANN_INDEX,
+    ANN_MIN_GALLERY_SIZE,
+    ANN_NLIST,
+    ANN_NPROBE,
+    GALLERY_QUANTIZE,
+    GALLERY_QUANTIZE_MIN_SIZE,
+    GALLERY_PCA_COMPONENTS,
+    GALLERY_RERANK,
+    GALLERY_CACHE_DIR,
+    GALLERY_SYNC_SECONDS,
+    GALLERY_SAVE_DELAY_SECONDS,
+    QUALITY_GATE,
+    INFERENCE_WORKER,
+    INFERENCE_TIMEOUT_MS,
+    GALLERY_SHARDS,
+    SHARD_MIN_GALLERY_SIZE,
+    TEMPLATE_REFINE,
+    ARCHIVE_IMAGES_FOLDER,
+    ARCHIVE_GALLERY_FILE,
+    RECOGNITION_CONCURRENCY,
+    RECOGNITION_QUEUE_LENGTH,
+    RECOGNITION_QUEUE_DEADLINE_MS,
+    MATCH_THRESHOLD as MATCH_THRESHOLD_OVERRIDE
 )
 from io import BytesIO
 from PIL import Image
 
-# Use DeepFace instead of face_recognition (faster on Streamlit Cloud)
-try:
-    from deepface import DeepFace
-    USE_DEEPFACE = True
-except ImportError:
-    # Fallback to face_recognition if available
-    import face_recognition as fr
-    USE_DEEPFACE = False
+# Detection, embedding and matching come from the configured backend (see backends.py)
+BACKEND = backends.get_backend()
+MODEL_NAME = BACKEND.model_name
+DISTANCE_METRIC = BACKEND.metric
+PREPROCESSING = BACKEND.preprocessing
+MATCH_THRESHOLD = float(MATCH_THRESHOLD_OVERRIDE) if MATCH_THRESHOLD_OVERRIDE else BACKEND.threshold
+
+# compare_face_with_dropbox's user_id when recognition was at capacity (it has asked to retry)
+BUSY = -2
+
+# find_similar_students statuses
+SEARCHED = 'searched'
+NO_FACE = 'no_face'
+UNREACHABLE = 'unreachable'
+
+# Bounds the recognitions all Streamlit sessions run at once
+_admission = admission.AdmissionController(
+    RECOGNITION_CONCURRENCY, RECOGNITION_QUEUE_LENGTH, RECOGNITION_QUEUE_DEADLINE_MS
+)
+# Marks a thread holding a recognition slot, which must not wait for the worker to start
+_slot_state = threading.local()
+
+# Process-wide gallery shared by every Streamlit session
+_gallery = None
+_gallery_lock = threading.Lock()
+_last_sync = 0.0
+# One sync at a time; held while listing, downloading and embedding, never inside _gallery_lock
+_sync_lock = threading.Lock()
+# Bumped by reset_gallery(), so a sync that started before it doesn't write its rows back
+_generation = 0
+# Shard processes mirroring _gallery once it is large enough (GALLERY_SHARDS)
+_shards = None
+# Builds the ANN index and quantized store off the lock; searches scan exactly until they are swapped in
+_build_thread = None
+# Memory-mapped gallery files of this process (see _cache_dir)
+_cache_dir_path = None
+
+# Sidecar saves are coalesced onto one background thread (see _schedule_gallery_save)
+_save_lock = threading.Lock()
+_save_thread = None
+_save_requested = False
+_save_dbx = None
+# Held while a sidecar is written and uploaded, so two saves never overlap
+_save_run_lock = threading.Lock()
+_save_stats = {'saves': 0, 'failures': 0, 'raced': 0, 'last_ms': None, 'last_mb': None, 'error': None}
+# Longest wait before retrying a failed save
+SAVE_RETRY_MAX_SECONDS = 300
+
+# Serialises read-modify-write of the archive sidecar within this process
+_archive_lock = threading.Lock()
+
+# Class -> student IDs, refreshed from the user data at most every GALLERY_SYNC_SECONDS
+_partitions = {}
+_partitions_at = 0.0
+_partitions_lock = threading.Lock()
+# Per-class hit/fallback counters and search timings for the stats panel
+_partition_stats = defaultdict(lambda: {'requests': 0, 'hits': 0, 'fallbacks': 0,
+                                        'partition_ms': deque(maxlen=500), 'fallback_ms': deque(maxlen=500)})
+_global_ms = deque(maxlen=500)
+_stats_lock = threading.Lock()
 
 
 def save_image_locally(picture, directory, filename):
@@ -63,10 +167,821 @@ def get_all_images(directory):
     return [file for file in os.listdir(directory) if file.endswith('.jpg') or file.endswith('.png')]
 
 
-def compare_face_with_dropbox(unknown_image):
+def decode_image(image_bytes):
+    """Decode image bytes once into a bounded-size, upright RGB array (see preprocess.py)"""
+    return preprocess.prepare_image(image_bytes)
+
+
+def embed_face(image):
+    """
+    Return the embedding of the most prominent face in an image, or None if there is none.
+    Accepts raw image bytes or an RGB array from decode_image().
+    """
+    if isinstance(image, (bytes, bytearray)):
+        image = decode_image(image)
+
+    if not INFERENCE_WORKER:
+        return BACKEND.embed_image(image)
+
+    face = BACKEND.primary_face(image)
+    return embed_face_crops([face])[0] if face is not None else None
+
+
+def detect_faces(image):
+    """
+    Detect every face in a decoded RGB array (see detection.detect for the cascade).
+    Returns a list of {'facial_area', 'confidence', 'face'} dicts where 'face'
+    is the crop the embedding model expects.
+    """
+    return BACKEND.detect(image)
+
+
+def embed_face_crops(faces):
+    """
+    Embed the crops returned by detect_faces(), as one batch where the backend allows.
+    With INFERENCE_WORKER they go through the shared micro-batching worker
+    process; if it can't load its model or dies, they are embedded here. A
+    worker still starting, or not answering within INFERENCE_TIMEOUT_MS, raises
+    admission.Busy rather than holding the caller; one that has returned
+    nothing for that long is killed and restarted on the next call. Inside a
+    recognition slot it doesn't wait for the worker to start at all.
+    """
+    if INFERENCE_WORKER and faces:
+        timeout = INFERENCE_TIMEOUT_MS / 1000.0
+        worker = inference_worker.get_worker()
+        error = worker.wait_ready(0 if getattr(_slot_state, 'held', False) else timeout)
+        if not worker.ready():
+            raise admission.Busy(math.ceil(timeout), "models loading")
+        if error is None:
+            try:
+                return worker.embed(faces, timeout)
+            except inference_worker.WorkerTimeout:
+                if worker.stalled(timeout):
+                    worker.terminate()
+                raise admission.Busy(math.ceil(timeout), "inference worker not answering")
+            except inference_worker.WorkerDied:
+                pass
+    return BACKEND.embed(faces)
+
+
+def embed_all_faces(image):
+    """
+    Detect every face in a decoded RGB array and embed them as one batch.
+    Returns a list of {'facial_area', 'confidence', 'embedding'} dicts.
+    """
+    faces = detect_faces(image)
+    embeddings = embed_face_crops(faces)
+    return [
+        {'facial_area': face['facial_area'], 'confidence': face['confidence'], 'embedding': embedding}
+        for face, embedding in zip(faces, embeddings) if embedding is not None
+    ]
+
+
+def _compatible(gallery):
+    """
+    True if a stored gallery's embeddings compare with this process's: same
+    model and metric, and faces cut the same way (detection.CROP_VERSION)
+    """
+    return (
+        gallery.model_name == MODEL_NAME
+        and gallery.metric == DISTANCE_METRIC
+        and gallery.preprocessing == PREPROCESSING
+    )
+
+
+def _new_gallery():
+    return Gallery(MODEL_NAME, metric=DISTANCE_METRIC, preprocessing=PREPROCESSING)
+
+
+def _cache_dir():
+    """
+    This process's directory under GALLERY_CACHE_DIR (the memory-mapped files
+    are rewritten in place, so processes can't share one). Directories left by
+    processes that have exited are removed first, and this one on exit.
+    """
+    global _cache_dir_path
+
+    if _cache_dir_path is None:
+        if os.path.isdir(GALLERY_CACHE_DIR):
+            for name in os.listdir(GALLERY_CACHE_DIR):
+                if name.isdigit() and int(name) != os.getpid() and not _process_alive(int(name)):
+                    shutil.rmtree(os.path.join(GALLERY_CACHE_DIR, name), ignore_errors=True)
+        _cache_dir_path = os.path.join(GALLERY_CACHE_DIR, str(os.getpid()))
+        atexit.register(shutil.rmtree, _cache_dir_path, True)
+    return _cache_dir_path
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # Someone else's process
+    return True
+
+
+def _load_gallery(dbx):
+    """Load the stored gallery sidecar, or start an empty one if it is missing or stale"""
+    gallery = None
+    gallery_bytes = download_gallery_from_dropbox(dbx)
+    if gallery_bytes:
+        try:
+            # With quantization the full-precision rows go straight to disk
+            gallery = Gallery.from_bytes(gallery_bytes, _cache_dir() if GALLERY_QUANTIZE else None)
+            # Embeddings from another model or crop version are not comparable, start over
+            if not _compatible(gallery):
+                gallery = None
+        except Exception as e:
+            st.warning(f"Face gallery could not be read, rebuilding it: {e}")
+            gallery = None
+
+    if gallery is None:
+        gallery = _new_gallery()
+    gallery.refine_top = TEMPLATE_REFINE
+
+    if ANN_INDEX == "ivf":
+        gallery.set_index(IVFIndex(nlist=ANN_NLIST or None, nprobe=ANN_NPROBE), min_size=ANN_MIN_GALLERY_SIZE)
+    if GALLERY_QUANTIZE:
+        gallery.enable_quantization(
+            _cache_dir(),
+            components=GALLERY_PCA_COMPONENTS,
+            rerank=GALLERY_RERANK,
+            min_size=GALLERY_QUANTIZE_MIN_SIZE
+        )
+    return gallery
+
+
+def _embed_and_store_crop(dbx, user_id, image, content_hash):
+    """Cut the aligned face crop of a student's photo, store it and embed it"""
+    crop, landmarks = face_crops.make_face_crop(image, content_hash, MODEL_NAME)
+    crop_bytes = face_crops.encode_crop(crop)
+    upload_face_crop_to_dropbox(dbx, user_id, crop_bytes, landmarks)
+    # Embed the stored JPEG, not the raw crop, so later re-embeds agree exactly
+    return embed_face_crops([{'face': face_crops.decode_crop(crop_bytes)}])[0]
+
+
+def _embed_stored_image(dbx, user_id, content_hash=None):
+    """
+    Embed a registered student's photo. Returns (embedding, final): embedding
+    is None on failure, and final is False when the failure may be transient
+    (download or model error) rather than the photo itself (unreadable, no face).
+    A stored face crop cut from the same photo version is embedded directly,
+    skipping download of the full photo and detection; otherwise the crop is
+    (re)built from the photo and stored for next time.
+    """
+    if BACKEND.stores_crops and content_hash is not None:
+        crop_bytes, landmarks = download_face_crop_from_dropbox(dbx, user_id)
+        if (crop_bytes and landmarks.get('source_hash') == content_hash
+                and landmarks.get('model_name') == MODEL_NAME
+                and landmarks.get('preprocessing') == PREPROCESSING):
+            try:
+                return embed_face_crops([{'face': face_crops.decode_crop(crop_bytes)}])[0], True
+            except Exception:
+                pass  # Unreadable crop, rebuild it from the photo
+
+    known_image_bytes = download_image_from_dropbox(dbx, user_id)
+    if not known_image_bytes:
+        return None, False
+
+    try:
+        known_image = decode_image(known_image_bytes)
+    except Exception:
+        return None, True
+
+    try:
+        if BACKEND.stores_crops:
+            return _embed_and_store_crop(dbx, user_id, known_image, content_hash), True
+        return embed_face(known_image), True
+    except Exception:
+        return None, False
+
+
+def _gallery_add(user_id, embedding, content_hash):
+    """Add to the gallery and its shards (caller holds the lock)"""
+    _gallery.add(user_id, embedding, content_hash)
+    if _shards is not None:
+        _shards.add(user_id, embedding)
+
+
+def _gallery_set_templates(user_id, embeddings, keys, content_hash):
+    """Store a student's templates in the gallery, and their centroid in its shards (caller holds the lock)"""
+    row = _gallery.set_templates(user_id, embeddings, keys, content_hash)
+    if _shards is not None:
+        _shards.add(user_id, row)
+
+
+def enrollment_key(content_hash, template_hashes):
+    """
+    Gallery hash of a student's enrollment: the photo's content hash, or for
+    students with extra photos a digest of all of their hashes
+    """
+    if not template_hashes:
+        return content_hash
+    return hashlib.sha256('|'.join([content_hash] + sorted(template_hashes.values())).encode('utf-8')).hexdigest()
+
+
+def _embed_enrollment(dbx, user_id, content_hash, template_hashes, known):
+    """
+    Embeddings and keys of a student's main photo and extra photos.
+    Templates the gallery already holds (`known`, from Gallery.templates_of)
+    are reused by content hash, so adding one photo embeds just that photo.
+    Empty when the main photo has no usable face, None when it or an extra
+    photo could not be embedded for now (a failed download, a busy or broken
+    model), so the stored key never covers a photo that was skipped only for
+    now. Extra photos that can't be decoded or show no face are left out.
+    """
+    embeddings, keys = [], []
+
+    embedding = known.get(content_hash)
+    if embedding is None:
+        embedding, final = _embed_stored_image(dbx, user_id, content_hash)
+        if embedding is None:
+            return ([], []) if final else None
+    embeddings.append(embedding)
+    keys.append(content_hash)
+
+    for path, template_hash in sorted(template_hashes.items()):
+        embedding = known.get(template_hash)
+        if embedding is None:
+            template_bytes = download_template_from_dropbox(dbx, path)
+            if not template_bytes:
+                return None
+            try:
+                template = decode_image(template_bytes)
+            except Exception:
+                continue  # Unreadable file, left out until it is replaced
+            try:
+                embedding = embed_face(template)
+            except Exception:
+                return None
+        if embedding is not None:
+            embeddings.append(embedding)
+            keys.append(template_hash)
+    return embeddings, keys
+
+
+def _gallery_remove(user_id):
+    """Remove from the gallery and its shards (caller holds the lock)"""
+    removed = _gallery.remove(user_id)
+    if removed and _shards is not None:
+        _shards.remove(user_id)
+    return removed
+
+
+def _sync_gallery(dbx, force=False):
+    """
+    Bring the gallery in line with the photos in Dropbox. Call it without
+    holding the gallery lock: listing, downloads and embedding run outside
+    it, then the new rows are swapped in under it at once, so searches (and
+    the shards) keep being served from the current rows meanwhile.
+    Only photos whose content hash changed are downloaded and re-embedded;
+    students with extra enrollment photos are stored as templates.
+    Listings are skipped for GALLERY_SYNC_SECONDS after the last one so a
+    burst of logins doesn't queue up behind Dropbox calls, and a sync that
+    is already running is left to finish, unless forced or the gallery has
+    not loaded yet. Photos without a usable face are remembered by content
+    hash and skipped until replaced. If either listing fails the gallery is
+    left as it is, rather than taken for an empty school.
+    """
+    global _gallery, _last_sync
+
+    with _gallery_lock:
+        loaded = _gallery is not None
+        if loaded and not force and time.monotonic() - _last_sync < GALLERY_SYNC_SECONDS:
+            return
+    if not _sync_lock.acquire(blocking=force or not loaded):
+        return
+
+    try:
+        with _gallery_lock:
+            gallery, generation = _gallery, _generation
+            if gallery is not None and not force and time.monotonic() - _last_sync < GALLERY_SYNC_SECONDS:
+                return  # The sync we waited for has just run
+            _last_sync = time.monotonic()
+
+        if gallery is None:
+            # Published only once synced, so nobody searches a half-built gallery
+            gallery = _load_gallery(dbx)
+
+        image_hashes = list_user_image_hashes(dbx)
+        template_hashes = list_template_hashes(dbx)
+        if image_hashes is None or template_hashes is None:
+            image_hashes = template_hashes = None
+
+        todo, removed, forgotten = [], [], []
+        if image_hashes is not None:
+            with _gallery_lock:
+                removed = [uid for uid in gallery.ids if uid not in image_hashes]
+                forgotten = [uid for uid in gallery.failures if uid not in image_hashes]
+                for user_id, content_hash in image_hashes.items():
+                    extras = template_hashes.get(user_id, {})
+                    key = enrollment_key(content_hash, extras)
+                    if user_id in gallery and gallery.hashes.get(user_id) == key:
+                        continue
+                    if gallery.has_failed(user_id, key):
+                        continue
+                    todo.append((user_id, content_hash, extras, key, gallery.hashes.get(user_id),
+                                 gallery.templates_of(user_id)))
+
+        # The slow part, with no lock held
+        enrollments = [
+            _embed_enrollment(dbx, user_id, content_hash, extras, known)
+            for user_id, content_hash, extras, _, _, known in todo
+        ]
+
+        with _gallery_lock:
+            if _generation != generation or _gallery not in (None, gallery):
+                return  # Reset meanwhile, this listing may predate it
+            _gallery = gallery
+            changed = False
+
+            # Drop students whose photos were removed
+            for user_id in removed:
+                changed |= _gallery_remove(user_id)
+            for user_id in forgotten:
+                changed |= gallery.failures.pop(user_id, None) is not None
+
+            # Swap in new or replaced photos
+            for (user_id, _, _, key, previous, _), enrollment in zip(todo, enrollments):
+                if enrollment is None or gallery.hashes.get(user_id) != previous:
+                    continue  # Retried on the next sync, or updated by a registration meanwhile
+                embeddings, keys = enrollment
+                if embeddings:
+                    _gallery_set_templates(user_id, embeddings, keys, key)
+                else:
+                    # Left in the gallery under an older photo, if any, until a usable one is uploaded
+                    gallery.mark_failed(user_id, key)
+                changed = True
+
+        if changed:
+            _schedule_gallery_save(dbx)
+    finally:
+        _sync_lock.release()
+
+
+def _schedule_gallery_save(dbx):
+    """
+    Ask for the gallery sidecar to be saved to Dropbox. Changes made within
+    GALLERY_SAVE_DELAY_SECONDS of each other go out in one write, on a
+    background thread that serializes the rows a block at a time to a local
+    file, holding the gallery lock only per block, then uploads the file in
+    chunks. The photos stay the source of truth: a change lost to a crash
+    before its save is picked up again by the next sync.
+    """
+    global _save_thread, _save_requested, _save_dbx
+
+    with _save_lock:
+        _save_requested = True
+        _save_dbx = dbx
+        if _save_thread is None:
+            _save_thread = threading.Thread(target=_run_gallery_saves, name="gallery-save", daemon=True)
+            _save_thread.start()
+
+
+def _run_gallery_saves():
+    global _save_thread, _save_requested
+
+    delay = GALLERY_SAVE_DELAY_SECONDS
+    while True:
+        time.sleep(delay)
+        with _save_lock:
+            if not _save_requested:
+                _save_thread = None
+                return
+            _save_requested = False
+            dbx = _save_dbx
+
+        if _save_gallery(dbx):
+            delay = GALLERY_SAVE_DELAY_SECONDS
+            continue
+        with _save_lock:
+            _save_requested = True
+        # Back off while Dropbox keeps failing
+        delay = min(max(delay, 1.0) * 2, SAVE_RETRY_MAX_SECONDS)
+
+
+def _save_gallery(dbx):
+    """Write the gallery sidecar and upload it; returns False if it should be tried again"""
+    with _save_run_lock:
+        with _gallery_lock:
+            gallery, generation = _gallery, _generation
+        if gallery is None:
+            return True  # Reset meanwhile; the next load rebuilds it
+
+        directory = _cache_dir()
+        os.makedirs(directory, exist_ok=True)
+        handle, path = tempfile.mkstemp(prefix='sidecar-', suffix='.npz', dir=directory)
+        os.close(handle)
+        start = time.perf_counter()
+        error = None
+        try:
+            if not gallery.write(path, _gallery_lock):
+                with _save_lock:
+                    _save_stats['raced'] += 1
+                return False  # Rows changed under the writer, write them again
+            with _gallery_lock:
+                if _generation != generation:
+                    return True
+            size = os.path.getsize(path)
+            if not upload_gallery_to_dropbox(dbx, path):
+                error = "upload to Dropbox failed"
+        except Exception as e:
+            error = str(e)
+        finally:
+            os.remove(path)
+
+        with _save_lock:
+            if error is None:
+                _save_stats.update(saves=_save_stats['saves'] + 1, error=None,
+                                   last_ms=(time.perf_counter() - start) * 1000, last_mb=size / 2**20)
+            else:
+                _save_stats.update(failures=_save_stats['failures'] + 1, error=error)
+        return error is None
+
+
+def flush_gallery_save():
+    """Run a pending sidecar save now, e.g. before exiting or timing a benchmark; returns False if it failed"""
+    global _save_requested
+
+    with _save_lock:
+        requested, dbx = _save_requested, _save_dbx
+        _save_requested = False
+    if not requested:
+        return True
+    if _save_gallery(dbx):
+        return True
+    with _save_lock:
+        _save_requested = True
+    return False
+
+
+def gallery_save_metrics():
+    """Saves, failures and the last save's time and size, for the stats panel"""
+    with _save_lock:
+        stats = dict(_save_stats)
+        stats['pending'] = _save_requested
+    return stats
+
+
+atexit.register(flush_gallery_save)
+
+
+def _start_gallery_builds():
+    """
+    Train a due ANN index and build a due quantized store on a background
+    thread, so no search waits for them (caller holds the lock)
+    """
+    global _build_thread
+
+    if _build_thread is not None and _build_thread.is_alive():
+        return
+    index_job = _gallery.begin_index_build()
+    quantize_job = _gallery.begin_quantize_build()
+    if index_job is None and quantize_job is None:
+        return
+    _build_thread = threading.Thread(
+        target=_run_gallery_builds, args=(_gallery, index_job, quantize_job), name="gallery-build", daemon=True
+    )
+    _build_thread.start()
+
+
+def _run_gallery_builds(gallery, index_job, quantize_job):
+    if index_job is not None:
+        index, ids, rows = index_job
+        try:
+            index.train(ids, rows)
+        except Exception:
+            with _gallery_lock:
+                gallery.abort_index_build()
+        else:
+            with _gallery_lock:
+                gallery.finish_index_build(index)
+
+    if quantize_job is not None:
+        try:
+            prepared = gallery.prepare_quantized(*quantize_job)
+        except Exception:
+            with _gallery_lock:
+                gallery.abort_quantize_build()
+        else:
+            with _gallery_lock:
+                gallery.finish_quantize_build(*prepared)
+
+
+def wait_for_gallery_builds(timeout=None):
+    """Block until the background index and quantization builds have finished, e.g. before timing searches"""
+    thread = _build_thread
+    if thread is not None:
+        thread.join(timeout)
+
+
+def class_partitions(dbx):
+    """Student IDs (as gallery IDs) per class, from the user data in Dropbox"""
+    global _partitions, _partitions_at
+
+    with _partitions_lock:
+        if _partitions and time.monotonic() - _partitions_at < GALLERY_SYNC_SECONDS:
+            return _partitions
+
+        df = read_user_data_from_dropbox(dbx)
+        partitions = defaultdict(set)
+        if 'class' in df.columns:
+            for user_id, class_name in zip(df['id'], df['class']):
+                if pd.notna(user_id) and pd.notna(class_name) and str(class_name).strip():
+                    partitions[str(class_name).strip()].add(str(int(user_id)))
+        _partitions = dict(partitions)
+        _partitions_at = time.monotonic()
+        return _partitions
+
+
+def search_gallery(dbx, probe, k=5, partition=None, sync=True):
+    """
+    Return the k closest students to a probe embedding as (user_id, distance).
+    The search runs under the gallery lock, so a concurrent registration
+    can never move rows while another session is scanning them; the sync
+    before it only takes the lock to swap rows in (see _sync_gallery).
+    Pass sync=False when the caller has just run prepare_search(), e.g.
+    before taking a recognition slot it shouldn't hold through Dropbox calls.
+
+    With a partition hint (a class name) only that class is searched first;
+    the whole gallery is searched only if it has no match under MATCH_THRESHOLD.
+    """
+    if sync:
+        prepare_search(dbx, partition)
+    members = class_partitions(dbx).get(partition) if partition else None
+
+    with _gallery_lock:
+        if _gallery is None:
+            return []  # Reset since the sync
+        _start_gallery_builds()
+
+        if members:
+            start = time.perf_counter()
+            results = _gallery.search(probe, k, within=members)
+            partition_ms = (time.perf_counter() - start) * 1000
+            hit = bool(results) and results[0][1] < MATCH_THRESHOLD
+            if not hit:
+                results = _search(probe, k)
+            fallback_ms = (time.perf_counter() - start) * 1000
+
+            with _stats_lock:
+                stats = _partition_stats[partition]
+                stats['requests'] += 1
+                stats['hits' if hit else 'fallbacks'] += 1
+                (stats['partition_ms'] if hit else stats['fallback_ms']).append(partition_ms if hit else fallback_ms)
+            return results
+
+        start = time.perf_counter()
+        results = _search(probe, k)
+        with _stats_lock:
+            _global_ms.append((time.perf_counter() - start) * 1000)
+        return results
+
+
+def prepare_search(dbx, partition=None):
+    """
+    The Dropbox work before a search: the gallery sync (a full load and
+    embed on a cold start) and the class lists for a partition hint
+    """
+    _sync_gallery(dbx)
+    if partition:
+        class_partitions(dbx)
+
+
+def partition_stats():
+    """
+    Per-class hit rate and timings of partition-first searches, with the
+    mean saving of a partition hit over a full-gallery search
+    """
+    with _stats_lock:
+        global_ms = float(np.mean(_global_ms)) if _global_ms else None
+        report = {}
+        for partition, stats in _partition_stats.items():
+            partition_ms = float(np.mean(stats['partition_ms'])) if stats['partition_ms'] else None
+            report[partition] = {
+                'requests': stats['requests'],
+                'hit_rate': stats['hits'] / stats['requests'],
+                'fallbacks': stats['fallbacks'],
+                'mean_partition_ms': partition_ms,
+                'mean_fallback_ms': float(np.mean(stats['fallback_ms'])) if stats['fallback_ms'] else None,
+                'saved_ms_per_hit': global_ms - partition_ms if global_ms is not None and partition_ms is not None else None
+            }
+    return report, global_ms
+
+
+def _search(probe, k):
+    """
+    In-process search, or a scatter-gather over the shard processes once the
+    gallery reaches SHARD_MIN_GALLERY_SIZE (caller holds the lock)
+    """
+    global _shards
+
+    if GALLERY_SHARDS < 2 or (_shards is None and len(_gallery) < SHARD_MIN_GALLERY_SIZE):
+        return _gallery.search(probe, k)
+
+    if _shards is None:
+        _shards = shard_pool.ShardPool(_gallery, GALLERY_SHARDS)
+
+    # Shards hold centroids only; multi-photo students are re-scored on their templates here
+    fetch = max(k, _gallery.refine_top) if _gallery.templates else k
+    results, complete = _shards.search(probe, fetch)
+    if not complete:
+        st.warning("⚠️ Part of the face gallery did not answer in time, results may be incomplete.")
+    return _gallery.refine(probe, results, k) if _gallery.templates else results[:k]
+
+
+def admission_metrics():
+    """Queue-wait, rejection and load metrics of the recognition limiter"""
+    return _admission.metrics()
+
+
+def shard_metrics():
+    """Scatter-gather metrics, or None when the gallery isn't sharded"""
+    shards = _shards
+    return shards.metrics() if shards is not None else None
+
+
+def check_inference_ready():
+    """Raise admission.Busy if the inference worker is still loading its model, without waiting"""
+    if INFERENCE_WORKER and not inference_worker.get_worker().ready():
+        raise admission.Busy(math.ceil(INFERENCE_TIMEOUT_MS / 1000.0), "models loading")
+
+
+@contextmanager
+def recognition_slot():
+    """
+    A slot from the recognition limiter the logins use, for the other heavy
+    paths (class photos, the kiosk). Raises admission.Busy past its limits,
+    or at once while the models are loading, so a slot is never held
+    waiting for them. Run prepare_search() before taking it.
+    """
+    check_inference_ready()
+    with _admission.slot() as waited:
+        _slot_state.held = True
+        try:
+            yield waited
+        finally:
+            _slot_state.held = False
+
+
+def gallery_distance_matrix(dbx, probes, sync=True):
+    """
+    Distances from several probe embeddings to every student in one matrix operation.
+    Returns (user_ids, distances) with distances shaped (len(probes), len(user_ids)).
+    Pass sync=False after prepare_search(), as for search_gallery().
+    """
+    if sync:
+        _sync_gallery(dbx)
+    with _gallery_lock:
+        if _gallery is None:
+            return [], np.empty((len(probes), 0), dtype=np.float32)
+        return list(_gallery.ids), _gallery.distance_matrix(probes)
+
+
+def update_gallery_entry(dbx, user_id, image_bytes, content_hash):
+    """Embed a newly uploaded photo and schedule a save of the updated gallery"""
+    # Embed outside the lock so logins keep flowing meanwhile
+    if BACKEND.stores_crops:
+        embedding = _embed_and_store_crop(dbx, user_id, decode_image(image_bytes), content_hash)
+    else:
+        embedding = embed_face(image_bytes)
+
+    with _gallery_lock:
+        # Loading syncs against Dropbox, which already holds the new photo
+        loaded = _gallery is not None
+        # A new main photo changes a multi-photo student's centroid, resync their templates
+        resync = loaded and str(user_id) in _gallery.templates
+        added = loaded and not resync and embedding is not None
+        if added:
+            _gallery_add(user_id, embedding, content_hash)
+
+    if added:
+        _schedule_gallery_save(dbx)
+    elif not loaded or resync:
+        _sync_gallery(dbx, force=resync)
+
+
+def refresh_gallery(dbx):
+    """Resync the gallery with Dropbox now, e.g. after extra enrollment photos were added"""
+    _sync_gallery(dbx, force=True)
+
+
+def remove_gallery_entry(dbx, user_id):
+    """Remove a deleted student from the gallery and schedule a save"""
+    remove_gallery_entries(dbx, [user_id])
+
+
+def remove_gallery_entries(dbx, user_ids):
+    """Remove several students from the gallery and schedule one save"""
+    with _gallery_lock:
+        loaded = _gallery is not None
+        removed = loaded and [user_id for user_id in user_ids if _gallery_remove(str(user_id))]
+
+    if removed:
+        _schedule_gallery_save(dbx)
+    elif not loaded:
+        _sync_gallery(dbx)
+
+
+def _load_archive(dbx):
+    """The archive's gallery sidecar, or an empty one if missing or from another model or crop version"""
+    archive_bytes = download_gallery_from_dropbox(dbx, ARCHIVE_GALLERY_FILE)
+    if archive_bytes:
+        try:
+            archive = Gallery.from_bytes(archive_bytes)
+            if _compatible(archive):
+                return archive
+        except Exception as e:
+            st.warning(f"Archive gallery could not be read, rebuilding it: {e}")
+    return _new_gallery()
+
+
+def archive_gallery_entries(dbx, user_ids):
+    """
+    Copy students' embeddings, templates included, into the archive sidecar.
+    Call before their photos move to the archive, then remove_gallery_entries().
+    Returns False if the archive sidecar could not be written.
+    """
+    _sync_gallery(dbx)
+    with _gallery_lock:
+        if _gallery is None:
+            return False
+        entries = {str(user_id): _gallery.entry(user_id) for user_id in user_ids}
+
+    with _archive_lock:
+        archive = _load_archive(dbx)
+        for user_id, entry in entries.items():
+            if entry is not None:
+                archive.set_templates(user_id, *entry)
+        return upload_gallery_to_dropbox(dbx, archive.to_bytes(), ARCHIVE_GALLERY_FILE)
+
+
+def search_archive(dbx, probe, k=5):
+    """
+    The k closest archived students to a probe embedding, as (user_id, distance).
+    The slow path, for Reports only: the archive sidecar is downloaded and
+    scanned exactly on every call, and archived students it lacks (e.g. after
+    a model switch) are embedded from their archived photos first, each in a
+    recognition slot. Photos that can't be decoded or show no face are
+    remembered; any other failure is retried on the next call. Busy
+    propagates to the caller, after the progress so far is saved.
+    """
+    with _archive_lock:
+        archive = _load_archive(dbx)
+        changed = False
+        try:
+            for user_id, content_hash in (list_user_image_hashes(dbx, ARCHIVE_IMAGES_FOLDER) or {}).items():
+                if user_id in archive or archive.has_failed(user_id, content_hash):
+                    continue
+                image_bytes = download_image_from_dropbox(dbx, user_id, ARCHIVE_IMAGES_FOLDER)
+                if not image_bytes:
+                    continue
+                try:
+                    archived_image = decode_image(image_bytes)
+                except Exception:
+                    archive.mark_failed(user_id, content_hash)
+                    changed = True
+                    continue
+                with recognition_slot():
+                    try:
+                        embedding = embed_face(archived_image)
+                    except admission.Busy:
+                        raise
+                    except Exception:
+                        continue  # Model error, retried on the next call
+                if embedding is not None:
+                    archive.add(user_id, embedding, content_hash)
+                else:
+                    archive.mark_failed(user_id, content_hash)
+                changed = True
+        finally:
+            if changed:
+                upload_gallery_to_dropbox(dbx, archive.to_bytes(), ARCHIVE_GALLERY_FILE)
+    return archive.search(probe, k)
+
+
+def reset_gallery():
+    """Forget the in-memory gallery, e.g. after all data was cleared"""
+    global _gallery, _last_sync, _shards, _generation
+
+    with _gallery_lock:
+        if _shards is not None:
+            _shards.shutdown()
+        _gallery = None
+        _shards = None
+        _last_sync = 0.0
+        _generation += 1
+
+
+def compare_face_with_dropbox(unknown_image, partition=None):
     """
     Compare an unknown face with all faces stored in Dropbox.
-    Uses DeepFace for better cloud compatibility.
+    Embeds the probe once and scores it against the whole gallery in one pass.
+    Everything runs on in-memory arrays, so concurrent sessions never share files.
+    `partition` is an optional class to search first (see search_gallery).
+    Embedding and search wait for a recognition slot; when none frees up
+    in time the user is asked to retry and user_id is BUSY.
     Returns (is_match, user_id) tuple.
     """
     dbx = get_dropbox_client()
@@ -75,151 +990,87 @@ def compare_face_with_dropbox(unknown_image):
         return False, -1
     
     try:
-        # Get all user IDs from Dropbox
-        user_ids = list_all_user_images(dbx)
-        
-        if not user_ids:
-            st.warning("No registered users found in Dropbox")
-            return False, -1
-        
-        # Save unknown image temporarily
         if hasattr(unknown_image, 'getvalue'):
             unknown_image_bytes = unknown_image.getvalue()
         else:
             unknown_image_bytes = unknown_image
-        
-        temp_unknown = "temp_unknown.jpg"
-        with open(temp_unknown, 'wb') as f:
-            f.write(unknown_image_bytes)
-        
-        if USE_DEEPFACE:
-            # Use DeepFace for comparison
-            return compare_with_deepface(dbx, user_ids, temp_unknown)
-        else:
-            # Fallback to face_recognition
-            return compare_with_face_recognition(dbx, user_ids, unknown_image_bytes, temp_unknown)
-        
-    except Exception as e:
-        st.error(f"Error during face comparison: {e}")
-        # Clean up
-        if os.path.exists(temp_unknown):
-            os.remove(temp_unknown)
-        return False, -1
 
+        unknown_image_array = decode_image(unknown_image_bytes)
 
-def compare_with_deepface(dbx, user_ids, temp_unknown):
-    """Compare faces using DeepFace"""
-    try:
-        # Compare with each user
-        for user_id in user_ids:
-            known_image_bytes = download_image_from_dropbox(dbx, user_id)
-            
-            if not known_image_bytes:
-                continue
-            
-            # Save known image temporarily
-            temp_known = f"temp_known_{user_id}.jpg"
-            with open(temp_known, 'wb') as f:
-                f.write(known_image_bytes)
-            
-            try:
-                # Use DeepFace to verify
-                result = DeepFace.verify(
-                    temp_unknown, 
-                    temp_known,
-                    model_name='VGG-Face',  # Fast and accurate
-                    enforce_detection=False,  # More lenient
-                    distance_metric='cosine'
-                )
-                
-                # Clean up temp file
-                os.remove(temp_known)
-                
-                # If match found (threshold can be adjusted)
-                if result['verified'] or result['distance'] < 0.4:
-                    os.remove(temp_unknown)
-                    st.success(f"Match found! User ID: {user_id}")
-                    return True, user_id
-                    
-            except Exception as e:
-                # Clean up and continue to next user
-                if os.path.exists(temp_known):
-                    os.remove(temp_known)
-                continue
-        
-        # No match found
-        if os.path.exists(temp_unknown):
-            os.remove(temp_unknown)
-        return False, -1
-        
-    except Exception as e:
-        st.error(f"Error in DeepFace comparison: {e}")
-        if os.path.exists(temp_unknown):
-            os.remove(temp_unknown)
-        return False, -1
+        # Reject unusable frames before paying for the embedding model
+        if QUALITY_GATE:
+            ok, reason, _ = quality.check_quality(unknown_image_array)
+            if not ok:
+                st.warning(f"📸 {quality.RETAKE_MESSAGES[reason]}")
+                return False, -1
 
+        # Synced before taking a slot, so a cold or slow sync doesn't hold one
+        prepare_search(dbx, partition)
+        try:
+            with recognition_slot():
+                probe = embed_face(unknown_image_array)
+                results = search_gallery(dbx, probe, k=1, partition=partition, sync=False) if probe is not None else None
+        except admission.Busy as busy:
+            st.warning(f"⏳ Face recognition is busy, please try again in {busy.retry_after} s")
+            return False, BUSY
 
-def compare_with_face_recognition(dbx, user_ids, unknown_image_bytes, temp_unknown):
-    """Fallback: Compare faces using face_recognition library"""
-    try:
-        unknown_img = Image.open(BytesIO(unknown_image_bytes))
-        unknown_img_array = fr.load_image_file(BytesIO(unknown_image_bytes))
-        
-        # Find face encodings in unknown image
-        unknown_face_encodings = fr.face_encodings(unknown_img_array)
-        
-        if len(unknown_face_encodings) == 0:
+        if probe is None:
             st.error("No face detected in the uploaded image")
-            os.remove(temp_unknown)
             return False, -1
-        
-        unknown_face_encoding = unknown_face_encodings[0]
-        
-        # Compare with each user in Dropbox
-        for user_id in user_ids:
-            known_image_bytes = download_image_from_dropbox(dbx, user_id)
-            
-            if not known_image_bytes:
-                continue
-            
-            # Load and encode the known image
-            known_img_array = fr.load_image_file(BytesIO(known_image_bytes))
-            known_face_encodings = fr.face_encodings(known_img_array)
-            
-            if len(known_face_encodings) == 0:
-                continue
-            
-            known_face_encoding = known_face_encodings[0]
-            
-            # Calculate similarity
-            similarity = fr.face_distance([unknown_face_encoding], known_face_encoding)
-            
-            # Set threshold
-            threshold = 0.4
-            
-            if similarity[0] < threshold:
-                st.success(f"Match found! User ID: {user_id}")
-                os.remove(temp_unknown)
-                return True, user_id
-        
-        # No match found
-        os.remove(temp_unknown)
-        return False, -1
+
+        if not results:
+            st.warning("No registered users found in Dropbox")
+            return False, -1
+
+        user_id, distance = results[0]
+        if distance >= MATCH_THRESHOLD:
+            return False, -1
+
+        st.success(f"Match found! User ID: {user_id}")
+        return True, user_id
         
     except Exception as e:
-        st.error(f"Error in face_recognition comparison: {e}")
-        if os.path.exists(temp_unknown):
-            os.remove(temp_unknown)
+        st.error(f"Error during face comparison: {e}")
         return False, -1
 
 
+def find_similar_students(image_array, k=3, include_archived=False):
+    """
+    Closest registered students to the face in a decoded photo, for the
+    duplicate check at registration and the find-by-face panel in Reports.
+    Uses the same gallery search as login, without logging anything.
+    With include_archived, archived students are searched too (slower, see
+    search_archive); IDs are never reused, so the two sets don't collide.
+    Returns (status, results, search_ms) with results as (user_id, distance).
+    The status is SEARCHED, or NO_FACE when no face could be embedded, or
+    UNREACHABLE when Dropbox can't be reached; results are then empty.
+    """
+    dbx = get_dropbox_client()
+    if not dbx:
+        return UNREACHABLE, [], 0.0
+
+    # Shares the login's recognition slots, taken after the sync; Busy propagates to the caller
+    prepare_search(dbx)
+    with recognition_slot():
+        probe = embed_face(image_array)
+        if probe is None:
+            return NO_FACE, [], 0.0
+
+        start = time.perf_counter()
+        results = search_gallery(dbx, probe, k=k, sync=False)
+    if include_archived:
+        results = sorted(results + search_archive(dbx, probe, k), key=lambda result: result[1])[:k]
+    return SEARCHED, results, (time.perf_counter() - start) * 1000
+
+
 def compare_faces_in_directory(known_image_dir, unknown_image_dir):
     """
     Legacy function for local directory comparison.
     Kept for backward compatibility.
     """
-    if not USE_DEEPFACE:
-        # Use face_recognition if available
+    if BACKEND.name == 'face_recognition':
+        import face_recognition as fr
+
         known_image_files = get_all_images(known_image_dir)
         unknown_image_files = get_all_images(unknown_image_dir)
 
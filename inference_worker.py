@@ -0,0 +1,280 @@
+"""
+Local inference worker: one process owns the recognition model and embeds
+face crops in micro-batches.
+
+Callers (Streamlit sessions, bulk imports, the kiosk) submit crops and get a
+concurrent.futures.Future back. The worker takes the first queued crop, keeps
+collecting for up to INFERENCE_BATCH_WAIT_MS or until INFERENCE_BATCH_SIZE
+crops are waiting, and runs them as one forward pass. Concurrent logins then
+share a batch instead of competing for the same cores with single-image passes.
+"""
+
+import atexit
+import itertools
+import multiprocessing as mp
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+import numpy as np
+from config import INFERENCE_BATCH_SIZE, INFERENCE_BATCH_WAIT_MS, INFERENCE_QUEUE_DEPTH
+
+# Batch records kept for the metrics panel
+RECENT_LIMIT = 500
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+class WorkerDied(RuntimeError):
+    """The inference worker process exited with requests still pending"""
+
+
+class WorkerTimeout(RuntimeError):
+    """The inference worker did not answer in time (overloaded or hung)"""
+
+
+def _to_uint8(face):
+    """Crops are [0, 1] floats from uint8 pixels; send them as uint8, 4x smaller and lossless"""
+    if face.dtype == np.uint8:
+        return face
+    return np.clip(np.rint(face * 255.0), 0, 255).astype(np.uint8)
+
+
+def _worker_main(requests, results, batch_size, wait_seconds):
+    """Worker process loop: collect a micro-batch, embed it, send the results back"""
+    try:
+        import backends
+        import models
+
+        backend = backends.get_backend()
+        if backend.stores_crops:
+            models._warm_up(embed_here=True)
+            if models.warm_up_error() is not None:
+                raise models.warm_up_error()
+        results.put(('ready', None))
+    except Exception as e:
+        results.put(('ready', repr(e)))
+        return
+
+    while True:
+        item = requests.get()
+        if item is None:
+            return
+
+        batch = [item]
+        deadline = time.monotonic() + wait_seconds
+        while len(batch) < batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                requests.put(None)  # finish this batch, then stop
+                break
+            batch.append(item)
+
+        started = time.time()
+        request_ids = [request_id for request_id, _, _ in batch]
+        waits = [started - submitted for _, _, submitted in batch]
+        try:
+            # Model backends take [0, 1] floats, face_recognition the uint8 pixels
+            faces = [{'face': face.astype(np.float32) / 255.0 if backend.stores_crops else face} for _, face, _ in batch]
+            embeddings = [None if e is None else np.asarray(e, dtype=np.float32) for e in backend.embed(faces)]
+            error = None
+        except Exception as e:
+            embeddings, error = None, repr(e)
+        results.put(('batch', (request_ids, embeddings, error, waits, time.time() - started)))
+
+
+class InferenceWorker:
+    """Parent-side handle: submits crops to the worker process and resolves futures"""
+
+    def __init__(self, batch_size=INFERENCE_BATCH_SIZE, wait_ms=INFERENCE_BATCH_WAIT_MS,
+                 queue_depth=INFERENCE_QUEUE_DEPTH):
+        # Spawn, not fork: the model must not inherit a half-initialised TensorFlow
+        context = mp.get_context('spawn')
+        self.batch_size = batch_size
+        self.wait_ms = wait_ms
+        self.queue_depth = queue_depth
+        self._requests = context.Queue(maxsize=queue_depth)
+        self._results = context.Queue()
+        self._process = context.Process(
+            target=_worker_main,
+            args=(self._requests, self._results, batch_size, wait_ms / 1000.0),
+            name="inference-worker",
+            daemon=True
+        )
+        self._ids = itertools.count()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._error = None
+        self._dead = False
+        self._last_batch = time.monotonic()
+        self._batches = deque(maxlen=RECENT_LIMIT)
+        self._counters = {'requests': 0, 'batches': 0, 'errors': 0, 'max_queue_depth': 0}
+
+        self._process.start()
+        self._listener = threading.Thread(target=self._listen, name="inference-results", daemon=True)
+        self._listener.start()
+
+    def _listen(self):
+        """Resolve futures as batch results come back; fail them all if the worker dies"""
+        while True:
+            try:
+                kind, payload = self._results.get(timeout=1.0)
+            except queue.Empty:
+                if self._process.is_alive():
+                    continue
+                self._fail_pending(WorkerDied(f"inference worker exited with code {self._process.exitcode}"))
+                self._ready.set()
+                return
+
+            if kind == 'ready':
+                self._error = payload
+                self._ready.set()
+                continue
+
+            request_ids, embeddings, error, waits, seconds = payload
+            with self._lock:
+                futures = [self._pending.pop(request_id, None) for request_id in request_ids]
+                self._last_batch = time.monotonic()
+                self._counters['batches'] += 1
+                self._counters['errors'] += error is not None
+                self._batches.append({'size': len(request_ids), 'wait_ms': max(waits) * 1000, 'inference_ms': seconds * 1000})
+
+            for i, future in enumerate(futures):
+                if future is None:
+                    continue
+                if error is not None:
+                    future.set_exception(RuntimeError(error))
+                else:
+                    future.set_result(embeddings[i])
+
+    def _fail_pending(self, error):
+        with self._lock:
+            self._dead = True
+            futures = list(self._pending.values())
+            self._pending.clear()
+        for future in futures:
+            future.set_exception(error)
+
+    def is_alive(self):
+        return self._process.is_alive()
+
+    def ready(self):
+        """True once the worker has loaded its model (or failed to)"""
+        return self._ready.is_set()
+
+    def wait_ready(self, timeout=None):
+        """Block until the worker has loaded its model; returns its start-up error, or None"""
+        self._ready.wait(timeout)
+        return self._error
+
+    def stalled(self, seconds):
+        """True if requests are pending and no batch has come back for `seconds`"""
+        with self._lock:
+            return bool(self._pending) and time.monotonic() - self._last_batch >= seconds
+
+    def submit(self, face, timeout=None):
+        """
+        Queue one face crop (RGB [0, 1] floats or uint8); returns a Future of
+        its embedding. Raises WorkerTimeout if the queue stays full for `timeout` seconds.
+        """
+        future = Future()
+        request_id = next(self._ids)
+        with self._lock:
+            if self._dead:
+                raise WorkerDied("inference worker is not running")
+            self._pending[request_id] = future
+            self._counters['requests'] += 1
+            self._counters['max_queue_depth'] = max(self._counters['max_queue_depth'], len(self._pending))
+        try:
+            self._requests.put((request_id, _to_uint8(face), time.time()), timeout=timeout)
+        except queue.Full:
+            with self._lock:
+                self._pending.pop(request_id, None)
+            raise WorkerTimeout("inference queue full") from None
+        return future
+
+    def embed(self, faces, timeout=None):
+        """
+        Embed detect() results through the worker; same contract as
+        RecognitionBackend.embed. Raises WorkerTimeout if the whole batch
+        isn't back within `timeout` seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def remaining():
+            return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+        futures = [self.submit(face['face'], remaining()) for face in faces]
+        try:
+            return [future.result(remaining()) for future in futures]
+        except FutureTimeout:
+            raise WorkerTimeout(f"no answer from the inference worker in {timeout} s") from None
+
+    def metrics(self):
+        """Batch size, queueing wait and inference time over recent batches, plus queue depth"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['queue_depth'] = len(self._pending)
+            batches = list(self._batches)
+
+        stats['alive'] = self.is_alive()
+        if batches:
+            sizes = [b['size'] for b in batches]
+            waits = [b['wait_ms'] for b in batches]
+            stats['mean_batch_size'] = float(np.mean(sizes))
+            stats['max_batch_size'] = max(sizes)
+            stats['mean_wait_ms'] = float(np.mean(waits))
+            stats['p95_wait_ms'] = float(np.percentile(waits, 95))
+            stats['mean_inference_ms'] = float(np.mean([b['inference_ms'] for b in batches]))
+        return stats
+
+    def terminate(self):
+        """
+        Kill a hung worker. Its pending requests fail with WorkerDied and the
+        next get_worker() call starts a fresh one.
+        """
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join(1)
+
+    def shutdown(self, timeout=5):
+        """Stop the worker after the requests already queued"""
+        if self._process.is_alive():
+            try:
+                self._requests.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+            self._process.join(timeout)
+            if self._process.is_alive():
+                self._process.terminate()
+
+
+def get_worker():
+    """
+    The process-wide inference worker, restarted if it has died. A worker
+    that failed to load its model is kept (check wait_ready()) rather than
+    respawned on every call.
+    """
+    global _worker
+
+    with _worker_lock:
+        if _worker is None or (not _worker.is_alive() and _worker.wait_ready(0) is None):
+            _worker = InferenceWorker()
+            atexit.register(_worker.shutdown)
+        return _worker
+
+
+def worker_metrics():
+    """Metrics of the running worker, or None if it was never started"""
+    with _worker_lock:
+        worker = _worker
+    return worker.metrics() if worker is not None else None
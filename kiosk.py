@@ -0,0 +1,265 @@
+"""
+Streaming gate-kiosk recognition over a video source.
+
+Faces are detected every `--detect-every` frames and followed by an OpenCV
+tracker in between. Each track is embedded only until `--consensus` matches
+agree on the same student (or it has been tried `--max-attempts` times),
+after which it is left alone. A student is logged through log_activity at
+most once per `--window` minutes. With `--class` that class is searched
+first and the full gallery only when it has no match.
+
+Usage:
+    python kiosk.py --source 0                      # first camera
+    python kiosk.py --source recorded_gate.mp4      # recorded file
+"""
+
+import argparse
+import json
+import time
+from collections import Counter
+import cv2
+import numpy as np
+import admission
+import image
+import preprocess
+from db import Database
+from dropbox_utils import get_dropbox_client, log_activity
+from config import KIOSK_CLASS
+
+
+def _iou(a, b):
+    """Intersection over union of two (x, y, w, h) boxes"""
+    ax2, ay2 = a[0] + a[2], a[1] + a[3]
+    bx2, by2 = b[0] + b[2], b[1] + b[3]
+    inter_w = max(0, min(ax2, bx2) - max(a[0], b[0]))
+    inter_h = max(0, min(ay2, by2) - max(a[1], b[1]))
+    inter = inter_w * inter_h
+    union = a[2] * a[3] + b[2] * b[3] - inter
+    return inter / union if union > 0 else 0.0
+
+
+def _create_tracker():
+    """A lightweight OpenCV tracker, or None if this OpenCV build has none"""
+    for name in ('TrackerMIL_create', 'TrackerKCF_create'):
+        if hasattr(cv2, name):
+            return getattr(cv2, name)()
+    return None
+
+
+class Track:
+    """One face followed across frames until its identity is agreed on"""
+
+    def __init__(self, track_id, box, frame_bgr, started):
+        self.track_id = track_id
+        self.box = box
+        self.started = started
+        self.votes = Counter()
+        self.distances = {}
+        self.user_id = None
+        self.identified_at = None
+        self.missed = 0
+        self.tracker = None
+        self.reset(box, frame_bgr)
+
+    def reset(self, box, frame_bgr):
+        """Snap the track to a fresh detection so the tracker doesn't drift"""
+        self.box = box
+        self.missed = 0
+        self.tracker = _create_tracker()
+        if self.tracker is not None:
+            self.tracker.init(frame_bgr, tuple(int(v) for v in box))
+
+    def update(self, frame_bgr):
+        """Follow the face into a frame without running detection"""
+        if self.tracker is None:
+            return True
+        found, box = self.tracker.update(frame_bgr)
+        if found:
+            self.box = tuple(box)
+        return found
+
+    def vote(self, user_id, distance, consensus):
+        """Record one recognition result; returns True once consensus is reached"""
+        self.votes[user_id] += 1
+        self.distances.setdefault(user_id, []).append(distance)
+        if user_id is not None and self.votes[user_id] >= consensus:
+            self.user_id = user_id
+            return True
+        return False
+
+
+class KioskRecognizer:
+    """Detect, track and identify faces frame by frame"""
+
+    def __init__(self, dbx, detect_every=5, consensus=3, window_minutes=30, log=True, max_attempts=10, partition=None):
+        self.dbx = dbx
+        self.partition = partition
+        self.detect_every = detect_every
+        self.consensus = consensus
+        self.max_attempts = max_attempts
+        self.window_seconds = window_minutes * 60
+        self.log = log
+        self.tracks = []
+        self.next_track_id = 1
+        self.last_logged = {}
+        self.identified = []
+        self.frames = 0
+        self.embeddings_run = 0
+        self.names = {}
+
+    def _student_name(self, user_id):
+        if user_id not in self.names:
+            detail = Database().get_user_detail(user_id) or {}
+            self.names[user_id] = detail.get('name', f"Student {user_id}")
+        return self.names[user_id]
+
+    def _log_once(self, user_id, now):
+        """Log a student at most once per window"""
+        last = self.last_logged.get(user_id)
+        if last is not None and now - last < self.window_seconds:
+            return False
+        self.last_logged[user_id] = now
+        if self.log and self.dbx:
+            log_activity(self.dbx, self._student_name(user_id), "Kiosk Login")
+        return True
+
+    def _associate(self, faces, frame_bgr, now):
+        """Match detections to existing tracks by IoU, opening tracks for new faces"""
+        matched = []
+        unclaimed = list(self.tracks)
+        for face in faces:
+            area = face['facial_area']
+            box = (area['x'], area['y'], area['w'], area['h'])
+            best = max(unclaimed, key=lambda t: _iou(t.box, box), default=None)
+            if best is not None and _iou(best.box, box) > 0.3:
+                unclaimed.remove(best)
+                best.reset(box, frame_bgr)
+                track = best
+            else:
+                track = Track(self.next_track_id, box, frame_bgr, now)
+                self.next_track_id += 1
+                self.tracks.append(track)
+            matched.append((track, face))
+
+        # Tracks the detector no longer sees are dropped after two misses
+        for track in unclaimed:
+            track.missed += 1
+        self.tracks = [t for t in self.tracks if t.missed < 2]
+        return matched
+
+    def process(self, frame_bgr, now=None):
+        """Handle one frame; returns the tracks identified on this frame"""
+        now = time.monotonic() if now is None else now
+        self.frames += 1
+        newly_identified = []
+
+        if (self.frames - 1) % self.detect_every != 0:
+            self.tracks = [t for t in self.tracks if t.update(frame_bgr)]
+            return newly_identified
+
+        faces = image.detect_faces(np.ascontiguousarray(frame_bgr[:, :, ::-1]))
+        pending = [
+            (track, face) for track, face in self._associate(faces, frame_bgr, now)
+            if track.user_id is None and sum(track.votes.values()) < self.max_attempts
+        ]
+        if not pending:
+            return newly_identified
+
+        # Only faces still without a consensus are embedded, in one batch, in a recognition slot
+        image.prepare_search(self.dbx, self.partition)
+        try:
+            with image.recognition_slot():
+                embeddings = image.embed_face_crops([face for _, face in pending])
+                matches = [
+                    image.search_gallery(self.dbx, embedding, k=1, partition=self.partition, sync=False)
+                    if embedding is not None else None
+                    for embedding in embeddings
+                ]
+        except admission.Busy:
+            return newly_identified  # the tracks are tried again on the next detection frame
+        self.embeddings_run += len(pending)
+
+        for (track, _), results in zip(pending, matches):
+            if results is None:
+                continue
+            user_id, distance = results[0] if results else (None, None)
+            if distance is None or distance >= image.MATCH_THRESHOLD:
+                user_id = None
+
+            if track.vote(user_id, distance, self.consensus):
+                track.identified_at = now
+                self.identified.append(track)
+                self._log_once(track.user_id, now)
+                newly_identified.append(track)
+
+        return newly_identified
+
+    def report(self, elapsed):
+        """Throughput and time-to-identify summary"""
+        times = [t.identified_at - t.started for t in self.identified]
+        return {
+            'frames': self.frames,
+            'seconds': round(elapsed, 2),
+            'fps': round(self.frames / elapsed, 2) if elapsed > 0 else None,
+            'embeddings_run': self.embeddings_run,
+            'identified': [t.user_id for t in self.identified],
+            'time_to_identify_p50_s': round(float(np.percentile(times, 50)), 2) if times else None,
+            'time_to_identify_max_s': round(max(times), 2) if times else None
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", default="0", help="camera index or video file path")
+    parser.add_argument("--detect-every", type=int, default=5, help="run the detector every k frames")
+    parser.add_argument("--consensus", type=int, default=3, help="matching votes needed to identify a track")
+    parser.add_argument("--max-attempts", type=int, default=10, help="embeddings tried per track before giving up")
+    parser.add_argument("--window", type=float, default=30, help="minutes before the same student is logged again")
+    parser.add_argument("--no-log", action="store_true", help="identify without writing to the activity log")
+    parser.add_argument("--class", dest="partition", default=KIOSK_CLASS or None,
+                        help="search this class first, everyone else only as a fallback")
+    parser.add_argument("--max-frames", type=int, default=0, help="stop after this many frames (0 = until the source ends)")
+    args = parser.parse_args()
+
+    source = int(args.source) if args.source.isdigit() else args.source
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        print(f"❌ Could not open video source: {args.source}")
+        return
+
+    dbx = get_dropbox_client()
+    if not dbx:
+        print("❌ Could not connect to Dropbox")
+        return
+
+    kiosk = KioskRecognizer(
+        dbx, args.detect_every, args.consensus, args.window,
+        log=not args.no_log, max_attempts=args.max_attempts, partition=args.partition
+    )
+    start = time.monotonic()
+
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            frame = preprocess.bound_frame(frame)
+
+            # Recorded files are replayed on their own timeline, cameras in real time
+            now = None if isinstance(source, int) else start + capture.get(cv2.CAP_PROP_POS_MSEC) / 1000
+            for track in kiosk.process(frame, now):
+                print(f"✅ Track {track.track_id}: student {track.user_id} "
+                      f"identified in {track.identified_at - track.started:.2f}s")
+
+            if args.max_frames and kiosk.frames >= args.max_frames:
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        capture.release()
+
+    print(json.dumps(kiosk.report(time.monotonic() - start), indent=2))
+
+
+if __name__ == "__main__":
+    main()
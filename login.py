@@ -1,7 +1,12 @@
 import streamlit as st
 import image
+import models
+import quality
+import detection
+import inference_worker
 from db import Database
 from dropbox_utils import log_activity, get_dropbox_client, download_image_from_dropbox
+from config import KIOSK_CLASS
 from PIL import Image
 from io import BytesIO
 
@@ -27,6 +32,27 @@ def login():
         </div>
     """, unsafe_allow_html=True)
     
+    if not models.models_ready():
+        st.info("⏳ Face recognition is starting up, this takes a minute after a restart.")
+        st.button("🔄 Check again", key="loginWarmUpCheck")
+        return
+
+    if models.warm_up_error():
+        st.warning(f"⚠️ Face recognition warm-up failed, the first login may be slow: {models.warm_up_error()}")
+
+    # A classroom kiosk searches its own class first, everyone else only as a fallback
+    dbx = get_dropbox_client()
+    classes = sorted(image.class_partitions(dbx)) if dbx else []
+    class_options = ["All classes"] + classes
+    selected_class = st.selectbox(
+        "🏫 Classroom",
+        class_options,
+        index=class_options.index(KIOSK_CLASS) if KIOSK_CLASS in class_options else 0,
+        key="loginClass",
+        help="Students of this class are searched first; other students are still recognised"
+    )
+    partition = None if selected_class == "All classes" else selected_class
+
     st.info("📸 Please position your face clearly in the camera frame")
     
     picture = st.camera_input("Capture your photo", key="loginCamera", label_visibility='collapsed')
@@ -34,7 +60,7 @@ def login():
     if picture:
         with st.spinner("🔍 Verifying your identity..."):
             # Compare face with images stored in Dropbox
-            is_match, user_id = image.compare_face_with_dropbox(picture)
+            is_match, user_id = image.compare_face_with_dropbox(picture, partition=partition)
 
             if is_match:
                 # Get user details from database
@@ -123,6 +149,75 @@ def login():
                     
                 else:
                     st.error("❌ User details not found in database")
+            elif user_id == image.BUSY:
+                pass  # Already asked to retry in a few seconds
             else:
                 st.error("❌ No matching face found. Please register first or try again.")
-                st.info("💡 Tip: Make sure you're registered and your face is clearly visible")
\ No newline at end of file
+                st.info("💡 Tip: Make sure you're registered and your face is clearly visible")
+
+    # Rejected-frame counters, useful when tuning kiosk lighting
+    with st.expander("📊 Camera quality stats"):
+        counts = quality.rejection_counts()
+        if not counts:
+            st.caption("No frames checked yet")
+        else:
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("Frames checked", counts.get('checked', 0))
+            with col2:
+                st.metric("Accepted", counts.get('accepted', 0))
+            with col3:
+                st.metric("Rejected", counts.get('checked', 0) - counts.get('accepted', 0))
+            st.markdown("**Rejected by reason:**")
+            for reason in quality.RETAKE_MESSAGES:
+                st.markdown(f"- **{reason.replace('_', ' ').title()}:** {counts.get(reason, 0)}")
+
+        stats = detection.detection_stats()
+        if stats.get('requests'):
+            st.markdown("**Face detection:**")
+            st.markdown(f"- **Fast path (Haar) hit rate:** {stats['fast_hit_rate']:.0%} of {stats['requests']} requests")
+            if stats['mean_fast_ms'] is not None:
+                st.markdown(f"- **Mean fast stage:** {stats['mean_fast_ms']:.1f} ms")
+            if stats['mean_heavy_ms'] is not None:
+                st.markdown(f"- **Mean heavy stage ({models.DETECTOR_BACKEND}):** {stats['mean_heavy_ms']:.1f} ms")
+        worker_stats = inference_worker.worker_metrics()
+        if worker_stats and worker_stats.get('batches'):
+            st.markdown("**Inference worker:**")
+            st.markdown(f"- **Status:** {'running' if worker_stats['alive'] else 'stopped'}")
+            st.markdown(f"- **Batches:** {worker_stats['batches']} for {worker_stats['requests']} faces "
+                        f"(mean size {worker_stats['mean_batch_size']:.1f}, max {worker_stats['max_batch_size']})")
+            st.markdown(f"- **Queue wait:** {worker_stats['mean_wait_ms']:.1f} ms mean, {worker_stats['p95_wait_ms']:.1f} ms p95")
+            st.markdown(f"- **Inference per batch:** {worker_stats['mean_inference_ms']:.1f} ms")
+            st.markdown(f"- **Queue depth:** {worker_stats['queue_depth']} now, {worker_stats['max_queue_depth']} max")
+
+        saves = image.gallery_save_metrics()
+        if saves['saves'] or saves['failures']:
+            st.markdown("**Gallery sidecar:**")
+            if saves['last_ms'] is not None:
+                st.markdown(f"- **Last save:** {saves['last_mb']:.1f} MB in {saves['last_ms']:.0f} ms "
+                            f"({saves['saves']} saves{', one pending' if saves['pending'] else ''})")
+            if saves['error']:
+                st.markdown(f"- **Not saved:** {saves['error']} ({saves['failures']} failures, retrying)")
+
+        load = image.admission_metrics()
+        if load['admitted'] or load['rejected_full'] or load['rejected_deadline']:
+            st.markdown("**Recognition load:**")
+            st.markdown(f"- **Running:** {load['running']} of {load['limit']}, {load['waiting']} waiting "
+                        f"(max {load['max_waiting']} of {load['queue_length']})")
+            if 'mean_wait_ms' in load:
+                st.markdown(f"- **Queue wait:** {load['mean_wait_ms']:.0f} ms mean, {load['p95_wait_ms']:.0f} ms p95")
+            st.markdown(f"- **Turned away:** {load['rejection_rate']:.0%} "
+                        f"({load['rejected_full']} queue full, {load['rejected_deadline']} waited too long)")
+
+        partitions, global_ms = image.partition_stats()
+        if partitions:
+            st.markdown("**Classroom-first search:**")
+            if global_ms is not None:
+                st.markdown(f"- **Full gallery search:** {global_ms:.1f} ms mean")
+            for name, stats in sorted(partitions.items()):
+                line = f"- **{name}:** {stats['hit_rate']:.0%} found in class of {stats['requests']} logins"
+                if stats['saved_ms_per_hit'] is not None:
+                    line += f", {stats['saved_ms_per_hit']:.1f} ms saved per hit"
+                if stats['mean_fallback_ms'] is not None:
+                    line += f", fallbacks {stats['mean_fallback_ms']:.1f} ms"
+                st.markdown(line)
@@ -0,0 +1,249 @@
+import os
+import threading
+import cv2
+import numpy as np
+from config import (
+    DETECTOR_BACKEND,
+    RECOGNITION_BACKEND,
+    RECOGNITION_MODEL,
+    YUNET_MODEL_PATH,
+    SFACE_MODEL_PATH,
+    YUNET_MIN_CONFIDENCE,
+    INFERENCE_WORKER,
+    INFERENCE_START_TIMEOUT_S
+)
+
+USE_OPENCV_DNN = RECOGNITION_BACKEND == 'opencv_dnn'
+
+# DeepFace (and with it TensorFlow) is only imported for the deepface backend;
+# backends.py falls back to face_recognition when it is not installed
+DeepFace = None
+DetectorWrapper = None
+preprocessing = None
+if RECOGNITION_BACKEND == 'deepface':
+    try:
+        from deepface import DeepFace
+        from deepface.detectors import DetectorWrapper
+        from deepface.modules import preprocessing
+    except ImportError:
+        pass
+
+if USE_OPENCV_DNN:
+    RECOGNITION_MODEL = 'SFace'
+
+# SFace embeds 112x112 crops aligned on YuNet's five landmarks
+SFACE_INPUT_SIZE = 112
+
+# input_shape of DeepFace's recognition models, so crops can be sized in a
+# process that never builds the model (the app, when the inference worker embeds)
+DEEPFACE_INPUT_SHAPES = {
+    'VGG-Face': (224, 224),
+    'Facenet': (160, 160),
+    'Facenet512': (160, 160),
+    'OpenFace': (96, 96),
+    'DeepFace': (152, 152),
+    'DeepID': (47, 55),
+    'Dlib': (150, 150),
+    'ArcFace': (112, 112),
+    'SFace': (112, 112),
+    'GhostFaceNet': (112, 112)
+}
+
+# Built once per process and shared by every Streamlit session
+_models = {}
+_build_lock = threading.Lock()
+_warm_up_lock = threading.Lock()
+_warm_up_thread = None
+_ready = threading.Event()
+_warm_up_error = None
+# OpenCV DNN models keep per-call state (input size, blobs), one caller at a time
+_dnn_lock = threading.Lock()
+
+
+def backend_available():
+    """True if the configured model backend (deepface or opencv_dnn) can run in this environment"""
+    if USE_OPENCV_DNN:
+        return (
+            hasattr(cv2, 'FaceDetectorYN') and hasattr(cv2, 'FaceRecognizerSF')
+            and os.path.exists(YUNET_MODEL_PATH) and os.path.exists(SFACE_MODEL_PATH)
+        )
+    return DeepFace is not None
+
+
+def get_recognition_model():
+    """Return the process-wide face recognition model, building it on first use"""
+    with _build_lock:
+        if 'recognition' not in _models:
+            if USE_OPENCV_DNN:
+                _models['recognition'] = cv2.FaceRecognizerSF.create(SFACE_MODEL_PATH, "")
+            else:
+                _models['recognition'] = DeepFace.build_model(RECOGNITION_MODEL)
+        return _models['recognition']
+
+
+def get_detector():
+    """Return the process-wide face detector, building it on first use"""
+    with _build_lock:
+        if 'detector' not in _models:
+            if USE_OPENCV_DNN:
+                _models['detector'] = cv2.FaceDetectorYN.create(
+                    YUNET_MODEL_PATH, "", (320, 320), YUNET_MIN_CONFIDENCE, 0.3, 5000
+                )
+            else:
+                _models['detector'] = DetectorWrapper.build_model(DETECTOR_BACKEND)
+        return _models['detector']
+
+
+def yunet_detect(image_bgr):
+    """
+    Run YuNet on a BGR uint8 array. Returns an (n, 15) float32 array of
+    x, y, w, h, five landmark points (right eye, left eye, nose tip, right and
+    left mouth corners) and the score, in image coordinates.
+    """
+    detector = get_detector()
+    with _dnn_lock:
+        detector.setInputSize((image_bgr.shape[1], image_bgr.shape[0]))
+        _, faces = detector.detect(image_bgr)
+    if faces is None:
+        return np.empty((0, 15), dtype=np.float32)
+    return faces
+
+
+def sface_align(image_bgr, face_row):
+    """Warp a YuNet detection to SFace's 112x112 template (BGR uint8)"""
+    recognizer = get_recognition_model()
+    with _dnn_lock:
+        return recognizer.alignCrop(image_bgr, face_row)
+
+
+def model_ready_face(face):
+    """
+    Resize and pad a face crop (RGB floats in [0, 1]) to the recognition
+    model's input size, exactly as DeepFace.represent would. Returns RGB
+    floats in [0, 1]; feeding the result back through embed_face_batch()
+    is a no-op resize.
+    """
+    if USE_OPENCV_DNN:
+        if face.shape[:2] == (SFACE_INPUT_SIZE, SFACE_INPUT_SIZE):
+            return face
+        return cv2.resize(face, (SFACE_INPUT_SIZE, SFACE_INPUT_SIZE), interpolation=cv2.INTER_AREA)
+
+    height, width = recognition_input_shape()
+    img = preprocessing.resize_image(img=face[:, :, ::-1], target_size=(width, height))
+    return img[0][:, :, ::-1]
+
+
+def recognition_input_shape():
+    """The DeepFace model's input_shape, from the table when known so the model isn't built for it"""
+    if RECOGNITION_MODEL in DEEPFACE_INPUT_SHAPES:
+        return DEEPFACE_INPUT_SHAPES[RECOGNITION_MODEL]
+    return get_recognition_model().input_shape
+
+
+def embed_face_batch(faces):
+    """
+    Embed aligned face crops (RGB, as returned by DeepFace.extract_faces)
+    with a single forward pass of the shared recognition model.
+    Returns an (n, d) float32 array.
+    """
+    if USE_OPENCV_DNN:
+        return _embed_sface_batch(faces)
+
+    model = get_recognition_model()
+    height, width = model.input_shape
+
+    batch = []
+    for face in faces:
+        # Same preparation DeepFace.represent applies to each face
+        img = preprocessing.resize_image(img=face[:, :, ::-1], target_size=(width, height))
+        batch.append(preprocessing.normalize_input(img=img, normalization='base'))
+    batch = np.concatenate(batch, axis=0)
+
+    if _is_keras_model(getattr(model, 'model', None)):
+        return np.asarray(model.model(batch, training=False), dtype=np.float32)
+
+    # Clients without a Keras model (e.g. DeepFace's SFace, whose .model wraps
+    # an OpenCV recognizer) only embed one face at a time
+    return np.array([model.find_embeddings(img[np.newaxis]) for img in batch], dtype=np.float32)
+
+
+def _is_keras_model(obj):
+    """True for a Keras model, whichever Keras package DeepFace built it with"""
+    return any(
+        cls.__name__ in ('Model', 'Functional', 'Sequential')
+        and cls.__module__.split('.')[0] in ('keras', 'tf_keras', 'tensorflow')
+        for cls in type(obj).__mro__
+    )
+
+
+def _embed_sface_batch(faces):
+    """SFace embeddings of RGB [0, 1] crops, already aligned by sface_align()"""
+    recognizer = get_recognition_model()
+    embeddings = []
+    for face in faces:
+        img = np.clip(model_ready_face(face) * 255.0, 0, 255).astype(np.uint8)
+        with _dnn_lock:
+            embeddings.append(recognizer.feature(np.ascontiguousarray(img[:, :, ::-1])).ravel())
+    return np.asarray(embeddings, dtype=np.float32)
+
+
+def _warm_up(embed_here=not INFERENCE_WORKER):
+    """
+    Build both models and run one dummy inference so the first login is fast.
+    With the inference worker, this process only needs the detector and the
+    recognition model is warmed in the worker instead.
+    """
+    global _warm_up_error
+
+    try:
+        if not embed_here:
+            import inference_worker  # imported here to avoid a circular import
+
+            if USE_OPENCV_DNN:
+                # alignCrop lives on the SFace recognizer, which is small without TensorFlow
+                yunet_detect(np.zeros((320, 320, 3), dtype=np.uint8))
+                get_recognition_model()
+            elif DeepFace is not None:
+                get_detector()
+            worker = inference_worker.get_worker()
+            error = worker.wait_ready(INFERENCE_START_TIMEOUT_S)
+            if not worker.ready():
+                raise RuntimeError(f"inference worker did not start within {INFERENCE_START_TIMEOUT_S:g} s")
+            if error is not None:
+                raise RuntimeError(f"inference worker failed to start: {error}")
+        elif USE_OPENCV_DNN:
+            yunet_detect(np.zeros((320, 320, 3), dtype=np.uint8))
+            embed_face_batch([np.zeros((SFACE_INPUT_SIZE, SFACE_INPUT_SIZE, 3), dtype=np.float32)])
+        elif DeepFace is not None:
+            get_recognition_model()
+            get_detector()
+            DeepFace.represent(
+                img_path=np.zeros((224, 224, 3), dtype=np.uint8),
+                model_name=RECOGNITION_MODEL,
+                detector_backend=DETECTOR_BACKEND,
+                enforce_detection=False
+            )
+    except Exception as e:
+        _warm_up_error = e
+    finally:
+        _ready.set()
+
+
+def start_warm_up():
+    """Start warming the models on a background thread (only once per process)"""
+    global _warm_up_thread
+
+    with _warm_up_lock:
+        if _warm_up_thread is None:
+            _warm_up_thread = threading.Thread(target=_warm_up, name="model-warm-up", daemon=True)
+            _warm_up_thread.start()
+
+
+def models_ready():
+    """True once the warm-up has finished (successfully or not)"""
+    return _ready.is_set()
+
+
+def warm_up_error():
+    """The exception raised during warm-up, or None"""
+    return _warm_up_error
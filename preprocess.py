@@ -0,0 +1,41 @@
+import numpy as np
+from io import BytesIO
+from PIL import Image, ImageOps
+from config import MAX_FRAME_SIDE
+
+
+def prepare_image(image_bytes, max_side=MAX_FRAME_SIDE):
+    """
+    Decode camera/upload bytes once into a bounded-size RGB uint8 array.
+
+    JPEGs are decoded directly at a reduced scale (libjpeg IDCT scaling via
+    Image.draft), so a 1080p frame is never materialised at full size. EXIF
+    orientation is applied so phone photos come out upright. The result is
+    meant to be reused for quality checks, detection and embedding.
+    """
+    img = Image.open(BytesIO(image_bytes))
+
+    # Ask for the final size so libjpeg can pick the largest 1/2, 1/4 or 1/8
+    # scale that still covers it; only JPEG supports draft mode
+    scale = min(1.0, max_side / max(img.size))
+    img.draft('RGB', (int(img.size[0] * scale), int(img.size[1] * scale)))
+    img = ImageOps.exif_transpose(img)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    if max(img.size) > max_side:
+        img.thumbnail((max_side, max_side), Image.BILINEAR)
+
+    return np.asarray(img)
+
+
+def bound_frame(frame, max_side=MAX_FRAME_SIDE):
+    """Downscale an already decoded frame (e.g. from a video source) to max_side"""
+    height, width = frame.shape[:2]
+    scale = max_side / max(height, width)
+    if scale >= 1:
+        return frame
+
+    img = Image.fromarray(frame)
+    img = img.resize((max(int(width * scale), 1), max(int(height * scale), 1)), Image.BILINEAR)
+    return np.asarray(img)
@@ -0,0 +1,76 @@
+import threading
+from collections import Counter
+import cv2
+import detection
+from config import (
+    QUALITY_MIN_SHARPNESS,
+    QUALITY_MIN_BRIGHTNESS,
+    QUALITY_MAX_BRIGHTNESS,
+    QUALITY_MIN_FACE_FRACTION
+)
+
+# Frames are checked at this size, the checks don't need more detail
+CHECK_SIZE = 320
+
+RETAKE_MESSAGES = {
+    'blurry': "The photo is blurry. Please hold still and try again.",
+    'too_dark': "The photo is too dark. Please face the light and try again.",
+    'too_bright': "The photo is overexposed. Please move away from direct light and try again.",
+    'no_face': "No face found. Please look straight at the camera and try again.",
+    'face_too_small': "Your face is too small in the frame. Please move closer and try again.",
+    'multiple_faces': "More than one face found. Please make sure only you are in the frame."
+}
+
+_counters = Counter()
+_counters_lock = threading.Lock()
+
+
+def check_quality(image, require_single_face=False):
+    """
+    Cheap pre-check of a decoded RGB array before running the embedding model.
+    Returns (ok, reason, metrics); reason is a key of RETAKE_MESSAGES or None.
+    """
+    gray, _ = detection.downscale_gray(image, CHECK_SIZE)
+    metrics = {
+        'sharpness': float(cv2.Laplacian(gray, cv2.CV_64F).var()),
+        'brightness': float(gray.mean())
+    }
+
+    reason = None
+    if metrics['brightness'] < QUALITY_MIN_BRIGHTNESS:
+        reason = 'too_dark'
+    elif metrics['brightness'] > QUALITY_MAX_BRIGHTNESS:
+        reason = 'too_bright'
+    elif metrics['sharpness'] < QUALITY_MIN_SHARPNESS:
+        reason = 'blurry'
+    else:
+        # Frontal cascade: turned-away faces are not found, which doubles as a pose check
+        min_side = min(gray.shape[:2])
+        faces, _ = detection.haar_faces(gray)
+        metrics['faces'] = len(faces)
+        if len(faces) == 0:
+            reason = 'no_face'
+        else:
+            largest = max(faces, key=lambda f: f[2] * f[3])
+            metrics['face_fraction'] = float(largest[2] / min_side)
+            if metrics['face_fraction'] < QUALITY_MIN_FACE_FRACTION:
+                reason = 'face_too_small'
+            elif require_single_face and len(faces) > 1:
+                reason = 'multiple_faces'
+
+    with _counters_lock:
+        _counters['checked'] += 1
+        _counters[reason or 'accepted'] += 1
+
+    return reason is None, reason, metrics
+
+
+def rejection_counts():
+    """Frames checked, accepted and rejected (by reason) since the process started"""
+    with _counters_lock:
+        return dict(_counters)
+
+
+def reset_counts():
+    with _counters_lock:
+        _counters.clear()
@@ -0,0 +1,89 @@
+import os
+import numpy as np
+
+
+def open_memmap(path, shape, dtype, copy_from=None):
+    """Create a memory-mapped array file, optionally seeded with existing rows"""
+    array = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+    if copy_from is not None and len(copy_from):
+        array[:len(copy_from)] = copy_from
+    return array
+
+
+class QuantizedCodes:
+    """
+    Coarse int8 codes for gallery embeddings, used to shortlist rows before
+    an exact re-rank. Embeddings are centred, projected onto their top PCA
+    components and scaled into int8, then kept in a memory-mapped file.
+
+    Scores are only used for ranking: for unit vectors x and q,
+    x.q = mean.q + (x - mean).q, and the first term is the same for every row.
+    """
+
+    def __init__(self, path, components=256):
+        self.path = path
+        self.components = components
+        self.mean = None
+        self.basis = None
+        self.scale = None
+        self.codes = None
+
+    def fit(self, embeddings, sample_size=4096, seed=0):
+        """Learn the PCA basis and int8 scale from (a sample of) the embeddings"""
+        rng = np.random.default_rng(seed)
+        count = len(embeddings)
+        rows = np.sort(rng.choice(count, size=min(count, sample_size), replace=False))
+        sample = np.asarray(embeddings[rows], dtype=np.float32)
+
+        self.mean = sample.mean(axis=0)
+        centred = sample - self.mean
+        components = min(self.components, centred.shape[0], centred.shape[1])
+
+        # Randomized SVD: a full SVD of a 4096-wide sample takes close to a minute
+        sketch = centred @ rng.standard_normal((centred.shape[1], components + 16)).astype(np.float32)
+        for _ in range(2):
+            sketch, _ = np.linalg.qr(sketch)
+            sketch = centred @ (centred.T @ sketch)
+        sketch, _ = np.linalg.qr(sketch)
+        _, _, vt = np.linalg.svd(sketch.T @ centred, full_matrices=False)
+        self.basis = np.ascontiguousarray(vt[:components].T)
+
+        projected = centred @ self.basis
+        self.scale = np.maximum(np.abs(projected).max(axis=0), 1e-6) / 127.0
+
+    def encode(self, vectors):
+        """Project and quantize rows to int8 codes"""
+        projected = (np.atleast_2d(vectors) - self.mean) @ self.basis
+        return np.clip(np.rint(projected / self.scale), -127, 127).astype(np.int8)
+
+    def allocate(self, capacity, embeddings=None):
+        """(Re)create the code file with room for `capacity` rows"""
+        previous = self.codes
+        self.codes = open_memmap(self.path + '.tmp', (capacity, self.basis.shape[1]), np.int8)
+        if embeddings is not None:
+            for start in range(0, len(embeddings), 8192):
+                block = self.encode(embeddings[start:start + 8192])
+                self.codes[start:start + len(block)] = block
+        elif previous is not None:
+            self.codes[:len(previous)] = previous
+        self.codes.flush()
+        del previous
+        os.replace(self.path + '.tmp', self.path)
+        self.codes = np.load(self.path, mmap_mode='r+')
+
+    def set_row(self, row, vector):
+        self.codes[row] = self.encode(vector)[0]
+
+    def copy_row(self, dst, src):
+        self.codes[dst] = self.codes[src]
+
+    def shortlist(self, query, count, k, block_size=65536):
+        """Rows among the first `count` with the k best coarse scores"""
+        weights = (self.basis.T @ query) * self.scale
+        scores = np.empty(count, dtype=np.float32)
+        for start in range(0, count, block_size):
+            block = self.codes[start:min(start + block_size, count)]
+            scores[start:start + len(block)] = block.astype(np.float32) @ weights
+
+        k = min(k, count)
+        return np.argpartition(-scores, k - 1)[:k]
@@ -1,13 +1,16 @@
 import streamlit as st
-from deepface import DeepFace
 import numpy as np
 from PIL import Image
 from io import BytesIO
 from UserDetail import UserDetail
 from db import Database
 import datetime
+import hashlib
+import admission
 import image
-from dropbox_utils import log_activity, get_dropbox_client
+import quality
+from config import QUALITY_GATE, MAX_EXTRA_PHOTOS
+from dropbox_utils import log_activity, get_dropbox_client, upload_template_to_dropbox
 
 
 def register():
@@ -59,12 +62,18 @@ def register():
                 else:
                     image_bytes = picture.read()
                 
-                img = Image.open(BytesIO(image_bytes))
-                img_array = np.array(img)
+                img_array = image.decode_image(image_bytes)
+
+                # Cheap checks first, the detector only runs on usable photos
+                if QUALITY_GATE:
+                    ok, reason, _ = quality.check_quality(img_array)
+                    if not ok:
+                        st.error(f"⚠️ {quality.RETAKE_MESSAGES[reason]}")
+                        return
                 
                 with st.spinner("Validating photo..."):
                     try:
-                        faces = DeepFace.extract_faces(img_path=img_array, enforce_detection=False)
+                        faces = image.detect_faces(img_array)
                         
                         if len(faces) == 0:
                             st.error("⚠️ No face detected! Please upload a clear photo.")
@@ -75,11 +84,26 @@ def register():
                             st.success("✅ Face detected successfully!")
                     except Exception as e:
                         st.warning(f"⚠️ Face validation uncertain. You may proceed.")
+
+                possible_duplicates = check_duplicate_enrollment(image_bytes, img_array)
+                if possible_duplicates is None:
+                    # Recognition was busy; the check runs again on the rerun the button triggers
+                    st.button("🔄 Check again", key="regDuplicateRetry")
+                    return
                         
             except Exception as e:
                 st.error(f"Error processing image: {e}")
                 return
         
+        # Extra photos (other angles/lighting) are kept as templates and improve matching
+        extra_photos = st.file_uploader(
+            f"Additional photos (optional, up to {MAX_EXTRA_PHOTOS})",
+            type=["jpg", "jpeg", "png"],
+            accept_multiple_files=True,
+            key="regExtraUpload"
+        )
+        extra_photos = usable_extra_photos(extra_photos or [])
+
         st.divider()
         
         # Registration Form
@@ -169,6 +193,13 @@ def register():
                 height=80
             )
             
+            confirm_new = False
+            if possible_duplicates:
+                confirm_new = st.checkbox(
+                    "I have checked the matches above, this is a different student",
+                    key="regConfirmNew"
+                )
+
             # Submit Button (INSIDE THE FORM)
             st.markdown("---")
             col1, col2, col3 = st.columns([1, 1, 1])
@@ -198,6 +229,8 @@ def register():
                     errors.append("Please select parent relation")
                 if not parent_contact or len(parent_contact) < 10:
                     errors.append("Please enter a valid contact number")
+                if possible_duplicates and not confirm_new:
+                    errors.append("This face matches a registered student, confirm it is a different student")
                 
                 if errors:
                     for error in errors:
@@ -235,6 +268,10 @@ def register():
                         if user_id:
                             # Save image to Dropbox
                             if image.save_image_to_dropbox(picture, str(user_id)):
+                                save_extra_photos(extra_photos, str(user_id))
+                                # The photo is in the gallery now, a re-submission must be checked again
+                                st.session_state.pop('regDuplicateCheck', None)
+                                st.session_state.pop('regExtraCheck', None)
                                 st.success(f"🎉 Student registered successfully! Student ID: {user_id}")
                                 st.balloons()
                                 
@@ -310,3 +347,105 @@ def insert_user_detail(user_data):
 
 
 
+
+
+def usable_extra_photos(pictures, limit=MAX_EXTRA_PHOTOS, state_key='regExtraCheck'):
+    """
+    Bytes of the first `limit` additional photos that pass the quality gate
+    and show a face. The result is kept per set of uploads under `state_key`,
+    so form reruns don't repeat the checks.
+    """
+    uploads = [picture.getvalue() for picture in pictures]
+    uploads_hash = hashlib.sha256(b''.join(hashlib.sha256(data).digest() for data in uploads)).hexdigest()
+    cached = st.session_state.get(state_key)
+    if cached and cached[0] == (uploads_hash, limit):
+        usable, warnings = cached[1], cached[2]
+    else:
+        usable, warnings = [], []
+        for i, image_bytes in enumerate(uploads[:limit], start=1):
+            try:
+                img_array = image.decode_image(image_bytes)
+                if QUALITY_GATE:
+                    ok, reason, _ = quality.check_quality(img_array)
+                    if not ok:
+                        warnings.append(f"⚠️ Additional photo {i} skipped: {quality.RETAKE_MESSAGES[reason]}")
+                        continue
+                if not image.detect_faces(img_array):
+                    warnings.append(f"⚠️ Additional photo {i} skipped: no face detected.")
+                    continue
+            except Exception as e:
+                warnings.append(f"⚠️ Additional photo {i} skipped: {e}")
+                continue
+            usable.append(image_bytes)
+
+        if len(uploads) > limit:
+            warnings.append(f"⚠️ Only the first {limit} additional photos are used.")
+        st.session_state[state_key] = ((uploads_hash, limit), usable, warnings)
+
+    for warning in warnings:
+        st.warning(warning)
+    return usable
+
+
+def save_extra_photos(photos, user_id):
+    """Store additional enrollment photos and add them to the face gallery in one sync"""
+    if not photos:
+        return
+    dbx = get_dropbox_client()
+    if not dbx:
+        st.warning("⚠️ Could not connect to Dropbox, additional photos were not saved.")
+        return
+
+    saved = sum(upload_template_to_dropbox(dbx, photo, user_id, refresh=False) for photo in photos)
+    if saved:
+        try:
+            image.refresh_gallery(dbx)
+        except Exception as e:
+            st.warning(f"Photos saved, but the face gallery could not be updated: {e}")
+        st.info(f"📷 {saved} additional photo(s) saved for matching.")
+
+
+def check_duplicate_enrollment(image_bytes, img_array, k=3):
+    """
+    Look the new face up in the gallery before a second ID is created for an
+    already registered student. Shows the closest students and returns the
+    ones under the match threshold. The result is kept per photo, so form
+    reruns don't repeat the search. Returns None when recognition is busy:
+    the check has not run and registration must wait for it.
+    """
+    photo_hash = hashlib.sha256(image_bytes).hexdigest()
+    cached = st.session_state.get('regDuplicateCheck')
+    if cached and cached[0] == photo_hash:
+        results, search_ms = cached[1], cached[2]
+    else:
+        try:
+            with st.spinner("Checking for an existing registration..."):
+                status, results, search_ms = image.find_similar_students(img_array, k=k)
+        except admission.Busy as busy:
+            st.warning(f"⏳ Face recognition is busy, please check again in {busy.retry_after} s")
+            return None
+        except Exception as e:
+            st.warning(f"⚠️ Could not check for an existing registration: {e}")
+            return []
+        if status == image.UNREACHABLE:
+            st.warning("⚠️ Could not connect to Dropbox to check for an existing registration.")
+            return []
+        st.session_state['regDuplicateCheck'] = (photo_hash, results, search_ms)
+
+    if not results:
+        return []
+
+    duplicates = [(user_id, distance) for user_id, distance in results if distance < image.MATCH_THRESHOLD]
+    if duplicates:
+        st.error("⚠️ This face looks like a student who is already registered:")
+    with st.expander(f"🔍 Closest registered students ({search_ms:.1f} ms)", expanded=bool(duplicates)):
+        db = Database()
+        for user_id, distance in results:
+            detail = db.get_user_detail(user_id) or {}
+            flag = "⚠️" if distance < image.MATCH_THRESHOLD else "•"
+            st.markdown(
+                f"{flag} **ID {user_id}** — {detail.get('name', 'Unknown')}, "
+                f"class {detail.get('class', '-')} · distance {distance:.3f} "
+                f"(match under {image.MATCH_THRESHOLD:.3f})"
+            )
+    return duplicates
@@ -0,0 +1,373 @@
+"""
+Rebuild the face gallery from every photo in Dropbox, e.g. after switching
+RECOGNITION_BACKEND / RECOGNITION_MODEL or losing the gallery sidecar.
+
+Photos are listed page by page, then downloaded by a pool of threads while a
+pool of processes (one recognition model each) decodes and embeds them. The
+next batch downloads while the current one embeds. Face crops are rebuilt
+for the new model as the photos go by. Extra enrollment photos are embedded
+too, so students with several photos keep their templates.
+
+Progress is checkpointed to a local directory every --checkpoint-every
+photos. An interrupted run resumes from it. Only photos that are not in it,
+or whose content hash has changed since, are redone. Photos that can't be
+decoded are recorded as such, listed at the end and left out of the gallery;
+replacing the file gets it embedded on the next run. The new gallery is
+uploaded in one overwrite only after every other photo is done, so the app
+never sees a half-built gallery. Restart running app instances after a model switch;
+they keep the gallery they loaded.
+
+Usage:
+    python reindex.py
+    python reindex.py --workers 4 --downloads 16
+    python reindex.py --dry-run --output gallery.npz
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import numpy as np
+
+_backend = None
+
+
+def _init_worker():
+    """Load the recognition model once per pool process"""
+    global _backend
+
+    import backends
+    import models
+
+    _backend = backends.get_backend()
+    if _backend.stores_crops:
+        models._warm_up(embed_here=True)
+        if models.warm_up_error() is not None:
+            raise models.warm_up_error()
+
+
+def _embed_photo(key, content, content_hash, store_crop):
+    """
+    Decode and embed one photo in a pool process, the way the app does.
+    Main photos of model backends go through a freshly cut face crop, which is
+    returned for upload. Returns (key, embedding or None, crop bytes, landmarks,
+    decode error or None).
+    """
+    import face_crops
+    import preprocess
+
+    try:
+        frame = preprocess.prepare_image(content)
+    except Exception as e:
+        # Retrying won't help a corrupt or unsupported file; recorded as unreadable
+        return key, None, None, None, repr(e)
+    if _backend.stores_crops and store_crop:
+        crop, landmarks = face_crops.make_face_crop(frame, content_hash, _backend.model_name)
+        crop_bytes = face_crops.encode_crop(crop)
+        embedding = _backend.embed([{'face': face_crops.decode_crop(crop_bytes)}])[0]
+        return key, embedding, crop_bytes, landmarks, None
+    return key, _backend.embed_image(frame), None, None, None
+
+
+class Checkpoint:
+    """
+    Embeddings done so far, by photo path and content hash, in a local
+    directory. Each save appends one chunk file holding only the photos done
+    since the last save, so writes stay proportional to the new work.
+    """
+
+    def __init__(self, path, model_name, preprocessing=None):
+        self.path = path
+        self.model_name = model_name
+        self.preprocessing = preprocessing or ''
+        # key -> (content hash, embedding or None when the photo had no usable face or can't be decoded)
+        self.done = {}
+        self.unreadable = set()
+        self._unsaved = []
+        self._chunks = 0
+        if path and os.path.isdir(path):
+            self._load()
+
+    def _chunk_paths(self):
+        return sorted(
+            os.path.join(self.path, name) for name in os.listdir(self.path)
+            if name.startswith('chunk-') and name.endswith('.npz')
+        )
+
+    def _load(self):
+        paths = self._chunk_paths()
+        for path in paths:
+            with np.load(path, allow_pickle=False) as payload:
+                if str(payload['model_name']) != self.model_name or str(payload['preprocessing']) != self.preprocessing:
+                    # Done for another model or crop version: none of it can be reused
+                    self.done.clear()
+                    self.unreadable.clear()
+                    for stale in paths:
+                        os.remove(stale)
+                    return
+                rows = iter(payload['embeddings'])
+                for key, content_hash, embedded, unreadable in zip(
+                        payload['keys'], payload['hashes'], payload['embedded'], payload['unreadable']):
+                    key = str(key)
+                    self.done[key] = (str(content_hash), next(rows) if embedded else None)
+                    if unreadable:
+                        self.unreadable.add(key)
+                    else:
+                        self.unreadable.discard(key)
+        self._chunks = len(paths)
+
+    def get(self, key, content_hash):
+        """(True, embedding) if the photo was done at this content hash, else (False, None)"""
+        entry = self.done.get(key)
+        if entry is None or entry[0] != content_hash:
+            return False, None
+        return True, entry[1]
+
+    def add(self, key, content_hash, embedding, unreadable=False):
+        """Record a photo; an unreadable one (it can't be decoded) is done too, without an embedding"""
+        self.done[key] = (content_hash, None if embedding is None else np.asarray(embedding, dtype=np.float32).ravel())
+        if unreadable:
+            self.unreadable.add(key)
+        else:
+            self.unreadable.discard(key)
+        self._unsaved.append(key)
+
+    def save(self):
+        """
+        Write the photos added since the last save as the next chunk, through a
+        temporary file and rename, so a crash never leaves half a chunk
+        """
+        if not self.path or not self._unsaved:
+            return
+        keys = list(dict.fromkeys(self._unsaved))
+        rows = [self.done[key][1] for key in keys if self.done[key][1] is not None]
+        os.makedirs(self.path, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self.path, suffix='.tmp', delete=False) as f:
+            np.savez(
+                f,
+                model_name=np.array(self.model_name),
+                preprocessing=np.array(self.preprocessing),
+                keys=np.array(keys, dtype=str),
+                hashes=np.array([self.done[key][0] for key in keys], dtype=str),
+                embedded=np.array([self.done[key][1] is not None for key in keys], dtype=bool),
+                unreadable=np.array([key in self.unreadable for key in keys], dtype=bool),
+                embeddings=np.stack(rows) if rows else np.empty((0, 0), dtype=np.float32)
+            )
+        os.replace(f.name, os.path.join(self.path, f"chunk-{self._chunks:06d}.npz"))
+        self._chunks += 1
+        self._unsaved = []
+
+    def unreadable_photos(self, photos):
+        """Keys of the listed photos recorded as unreadable at their current content hash"""
+        return [key for key, _, content_hash, _ in photos if key in self.unreadable and self.get(key, content_hash)[0]]
+
+    def remove(self):
+        if self.path and os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+
+
+def list_photos(dbx):
+    """
+    Every photo to embed as (key, user_id, content_hash, is_main_photo),
+    main photos first. Keys are Dropbox paths.
+    """
+    from config import IMAGES_FOLDER
+    from dropbox_utils import list_user_image_hashes, list_template_hashes
+
+    image_hashes = list_user_image_hashes(dbx)
+    template_hashes = list_template_hashes(dbx)
+    if image_hashes is None or template_hashes is None:
+        raise SystemExit("Could not list the photos in Dropbox")
+    photos = [(f"{IMAGES_FOLDER}/{uid}.jpg", uid, content_hash, True) for uid, content_hash in image_hashes.items()]
+    for uid, templates in template_hashes.items():
+        if uid in image_hashes:
+            photos.extend((path, uid, content_hash, False) for path, content_hash in templates.items())
+    return photos, image_hashes, template_hashes
+
+
+def _download(dbx, photo):
+    from dropbox_utils import download_image_from_dropbox, download_template_from_dropbox
+
+    key, user_id, _, main = photo
+    return download_image_from_dropbox(dbx, user_id) if main else download_template_from_dropbox(dbx, key)
+
+
+def build_gallery(model_name, metric, image_hashes, template_hashes, checkpoint, preprocessing=None):
+    """
+    Gallery of every student whose main photo could be embedded, templates
+    included. Main photos that can't be decoded or show no face are recorded
+    as failures, so the app's first sync doesn't embed them again.
+    """
+    from config import IMAGES_FOLDER
+    from gallery import Gallery
+    from image import enrollment_key
+
+    gallery = Gallery(model_name, metric=metric, preprocessing=preprocessing)
+    for user_id, content_hash in image_hashes.items():
+        extras = template_hashes.get(user_id, {})
+        done, embedding = checkpoint.get(f"{IMAGES_FOLDER}/{user_id}.jpg", content_hash)
+        if embedding is None:
+            if done:
+                gallery.mark_failed(user_id, enrollment_key(content_hash, extras))
+            continue  # Not done: the download or the model failed, the app retries it
+
+        embeddings, keys = [embedding], [content_hash]
+        for path, template_hash in sorted(extras.items()):
+            _, template = checkpoint.get(path, template_hash)
+            if template is not None:
+                embeddings.append(template)
+                keys.append(template_hash)
+        gallery.set_templates(user_id, embeddings, keys, enrollment_key(content_hash, extras))
+    return gallery
+
+
+def reindex(dbx, args):
+    """Embed every photo not yet in the checkpoint, then publish the new gallery; returns the run's stats"""
+    import image
+    from dropbox_utils import upload_face_crop_to_dropbox, upload_gallery_to_dropbox
+
+    stats = {'workers': args.workers, 'embedded': 0, 'resumed': 0, 'no_face': 0, 'unreadable': 0, 'failed': 0}
+    checkpoint = Checkpoint(args.checkpoint, image.MODEL_NAME, image.PREPROCESSING)
+
+    start = time.perf_counter()
+    photos, image_hashes, template_hashes = list_photos(dbx)
+    stats['listing_s'] = time.perf_counter() - start
+    stats['photos'] = len(photos)
+
+    todo = []
+    for photo in photos:
+        done, _ = checkpoint.get(photo[0], photo[2])
+        if done:
+            stats['resumed'] += 1
+        else:
+            todo.append(photo)
+    print(f"📋 {len(photos)} photos, {stats['resumed']} already in the checkpoint, {len(todo)} to embed")
+
+    embed_start = time.perf_counter()
+    since_checkpoint = 0
+    batches = [todo[i:i + args.batch] for i in range(0, len(todo), args.batch)]
+    context = mp.get_context('spawn')
+
+    with ThreadPoolExecutor(args.downloads) as io_pool, \
+            ProcessPoolExecutor(args.workers, mp_context=context, initializer=_init_worker) as pool:
+        uploads = []
+        next_contents = [io_pool.submit(_download, dbx, photo) for photo in batches[0]] if batches else []
+
+        for number, batch in enumerate(batches):
+            contents = next_contents
+            # Download the next batch while this one embeds
+            if number + 1 < len(batches):
+                next_contents = [io_pool.submit(_download, dbx, photo) for photo in batches[number + 1]]
+
+            futures = {}
+            for photo, content in zip(batch, contents):
+                key, user_id, content_hash, main = photo
+                try:
+                    content = content.result()
+                except Exception as e:
+                    print(f"⚠️ {key}: {e}")
+                    content = None
+                if not content:
+                    stats['failed'] += 1  # left out of the checkpoint, retried on the next run
+                    continue
+                futures[pool.submit(_embed_photo, key, content, content_hash, main)] = photo
+
+            for future in as_completed(futures):
+                key, user_id, content_hash, main = futures[future]
+                try:
+                    _, embedding, crop_bytes, landmarks, decode_error = future.result()
+                except Exception as e:
+                    print(f"⚠️ {key}: {e}")
+                    stats['failed'] += 1
+                    continue
+
+                if decode_error is not None:
+                    print(f"⚠️ {key} can't be decoded, left out of the gallery: {decode_error}")
+                    checkpoint.add(key, content_hash, None, unreadable=True)
+                    stats['unreadable'] += 1
+                    since_checkpoint += 1
+                    continue
+                if crop_bytes is not None and not args.dry_run:
+                    uploads.append(io_pool.submit(upload_face_crop_to_dropbox, dbx, user_id, crop_bytes, landmarks))
+                checkpoint.add(key, content_hash, embedding)
+                stats['embedded' if embedding is not None else 'no_face'] += 1
+                since_checkpoint += 1
+
+            if since_checkpoint >= args.checkpoint_every:
+                checkpoint.save()
+                since_checkpoint = 0
+            done = stats['embedded'] + stats['no_face'] + stats['unreadable']
+            rate = done / max(time.perf_counter() - embed_start, 1e-9)
+            print(f"   {done}/{len(todo)} photos, {rate:.1f}/s")
+
+        for upload in uploads:
+            upload.result()
+
+    checkpoint.save()
+    stats['embed_s'] = time.perf_counter() - embed_start
+    processed = stats['embedded'] + stats['no_face'] + stats['unreadable']
+    stats['photos_per_s'] = processed / stats['embed_s'] if processed else 0.0
+    stats['photos_per_s_per_core'] = stats['photos_per_s'] / args.workers
+
+    # Resumed ones included; they stay out of the gallery until the file is replaced
+    stats['unreadable_photos'] = checkpoint.unreadable_photos(photos)
+    if stats['unreadable_photos']:
+        print(f"⚠️ {len(stats['unreadable_photos'])} photos can't be decoded and are left out; replace them:")
+        for key in stats['unreadable_photos']:
+            print(f"   {key}")
+
+    if stats['failed']:
+        print(f"❌ {stats['failed']} photos could not be downloaded or embedded; run again to retry them.")
+        return stats
+
+    gallery = build_gallery(image.MODEL_NAME, image.DISTANCE_METRIC, image_hashes, template_hashes, checkpoint,
+                            image.PREPROCESSING)
+    stats['students'] = len(gallery)
+    # Written to a file and uploaded in chunks, so a large school's sidecar is never whole in memory
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.output or os.path.join(directory, 'gallery.npz')
+        gallery.write(path)
+        if args.dry_run:
+            print(f"🧪 Dry run, gallery of {len(gallery)} students not published")
+            return stats
+
+        # One overwrite: readers get the old gallery or the new one, never a mix
+        if upload_gallery_to_dropbox(dbx, path):
+            stats['published'] = True
+            checkpoint.remove()
+            print(f"✅ Published a gallery of {len(gallery)} students ({image.MODEL_NAME})")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="embedding processes")
+    parser.add_argument("--downloads", type=int, default=8, help="concurrent Dropbox downloads and uploads")
+    parser.add_argument("--batch", type=int, default=64, help="photos downloaded ahead of the embedding pool")
+    parser.add_argument("--checkpoint", default=".reindex_checkpoint", help="local progress directory")
+    parser.add_argument("--checkpoint-every", type=int, default=200, help="photos between checkpoint writes")
+    parser.add_argument("--fresh", action="store_true", help="ignore an existing checkpoint")
+    parser.add_argument("--output", default="", help="also write the new gallery to this local file")
+    parser.add_argument("--dry-run", action="store_true", help="don't upload the gallery or face crops")
+    args = parser.parse_args()
+
+    from dropbox_utils import get_dropbox_client
+
+    dbx = get_dropbox_client()
+    if not dbx:
+        raise SystemExit("Could not connect to Dropbox")
+    if args.fresh and os.path.isdir(args.checkpoint):
+        shutil.rmtree(args.checkpoint)
+
+    stats = reindex(dbx, args)
+    print(f"\n⏱️ listing {stats['listing_s']:.1f}s, embedding {stats['embed_s']:.1f}s: "
+          f"{stats['photos_per_s']:.2f} photos/s, {stats['photos_per_s_per_core']:.2f} photos/s per core "
+          f"({stats['workers']} workers; {stats['embedded']} embedded, {stats['no_face']} without a face, "
+          f"{stats['unreadable']} unreadable, {stats['resumed']} resumed, {stats['failed']} failed)")
+
+
+if __name__ == "__main__":
+    main()
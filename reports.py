@@ -1,7 +1,10 @@
 import streamlit as st
 import pandas as pd
 from db import Database
+import admission
+import image
 from dropbox_utils import get_dropbox_client, download_image_from_dropbox
+from config import IMAGES_FOLDER, ARCHIVE_IMAGES_FOLDER
 from PIL import Image, ImageDraw
 from io import BytesIO
 
@@ -30,6 +33,12 @@ def reports():
     # Load all student data
     db = Database()
     df = db.get_all_students()
+
+    # Archived students live in a separate file, only read when asked for
+    include_archived = st.checkbox("📦 Include archived students", key="reportsArchived")
+    if include_archived:
+        archived = db.get_archived_students()
+        df = pd.concat([df.assign(archived=False), archived.assign(archived=True)], ignore_index=True)
     
     if df.empty:
         st.info("📝 No student records found. Please register students first.")
@@ -64,6 +73,8 @@ def reports():
         with col2:
             clear_button = st.button("🔄 Clear Filters", use_container_width=True)
     
+    find_by_face(df, include_archived)
+    
     # Apply filters
     filtered_df = df.copy()
     
@@ -100,76 +111,7 @@ def reports():
         dbx = get_dropbox_client()
         
         for idx, row in filtered_df.iterrows():
-            with st.container():
-                col1, col2, col3 = st.columns([1, 2, 2])
-                
-                with col1:
-                    # Try to load and display student photo
-                    photo_loaded = False
-                    
-                    if dbx:
-                        try:
-                            img_bytes = download_image_from_dropbox(dbx, str(row['id']))
-                            if img_bytes and len(img_bytes) > 0:
-                                # Create BytesIO object from the downloaded bytes
-                                img_buffer = BytesIO(img_bytes)
-                                img = Image.open(img_buffer)
-                                st.image(img, width=150, caption=f"ID: {row['id']}")
-                                photo_loaded = True
-                        except Exception as e:
-                            # Show error but continue
-                            pass
-                    
-                    # If photo not loaded, create a placeholder
-                    if not photo_loaded:
-                        # Create a simple gray placeholder with text
-                        placeholder = Image.new('RGB', (150, 150), color=(220, 220, 220))
-                        draw = ImageDraw.Draw(placeholder)
-                        
-                        # Draw student ID text
-                        text = f"ID: {row['id']}"
-                        draw.text((50, 60), text, fill=(100, 100, 100))
-                        draw.text((40, 80), "No Photo", fill=(150, 150, 150))
-                        
-                        st.image(placeholder, width=150, caption=f"Student {row['id']}")
-                
-                with col2:
-                    st.markdown(f"**👤 Name:** {row.get('name', 'N/A')}")
-                    st.markdown(f"**🆔 Student ID:** {row.get('id', 'N/A')}")
-                    st.markdown(f"**📚 Class:** {row.get('class', 'N/A')}")
-                    st.markdown(f"**👥 Gender:** {row.get('gender', 'N/A')}")
-                    st.markdown(f"**🎂 DOB:** {row.get('dob', 'N/A')}")
-                    st.markdown(f"**🩸 Blood Group:** {row.get('blood_group', 'N/A')}")
-                
-                with col3:
-                    st.markdown(f"**📍 Address:** {row.get('address', 'N/A')}")
-                    st.markdown(f"**🏘️ Area:** {row.get('area', 'N/A')}")
-                    st.markdown(f"**🏙️ City:** {row.get('city', 'N/A')}")
-                    st.markdown(f"**📮 Pincode:** {row.get('pincode', 'N/A')}")
-                    st.markdown(f"**⭐ Special Talent:** {row.get('special_talent', 'N/A')}")
-                
-                # Expandable section for more details
-                with st.expander("👨‍👩‍👧 Parent Details & More"):
-                    pcol1, pcol2 = st.columns(2)
-                    
-                    with pcol1:
-                        st.markdown("**Parent/Guardian Information:**")
-                        st.markdown(f"- **Name:** {row.get('parent_name', 'N/A')}")
-                        st.markdown(f"- **Relation:** {row.get('parent_relation', 'N/A')}")
-                        st.markdown(f"- **Contact:** {row.get('parent_contact', 'N/A')}")
-                        st.markdown(f"- **Occupation:** {row.get('parent_occupation', 'N/A')}")
-                        st.markdown(f"- **Email:** {row.get('parent_email', 'N/A')}")
-                        st.markdown(f"- **Emergency:** {row.get('emergency_contact', 'N/A')}")
-                    
-                    with pcol2:
-                        st.markdown("**Academic Information:**")
-                        st.markdown(f"- **Admission Date:** {row.get('admission_date', 'N/A')}")
-                        st.markdown(f"- **Previous School:** {row.get('previous_school', 'N/A')}")
-                        st.markdown(f"- **Achievements:** {row.get('achievements', 'N/A')}")
-                        st.markdown(f"- **Medical Conditions:** {row.get('medical_conditions', 'N/A')}")
-                        st.markdown(f"- **Notes:** {row.get('additional_notes', 'N/A')}")
-                
-                st.markdown("---")
+            student_card(dbx, row)
     
     else:
         # Table View
@@ -242,43 +184,123 @@ def reports():
             st.metric("Classes", classes_count)
 
 
+def student_card(dbx, row, distance=None):
+    """One student in the card view, with the face distance when found by photo"""
+    with st.container():
+        col1, col2, col3 = st.columns([1, 2, 2])
 
+        with col1:
+            # Try to load and display student photo
+            photo_loaded = False
+
+            if dbx:
+                try:
+                    folder = ARCHIVE_IMAGES_FOLDER if row.get('archived', False) else IMAGES_FOLDER
+                    img_bytes = download_image_from_dropbox(dbx, str(row['id']), folder)
+                    if img_bytes and len(img_bytes) > 0:
+                        # Create BytesIO object from the downloaded bytes
+                        img_buffer = BytesIO(img_bytes)
+                        img = Image.open(img_buffer)
+                        st.image(img, width=150, caption=f"ID: {row['id']}")
+                        photo_loaded = True
+                except Exception as e:
+                    # Show error but continue
+                    pass
+
+            # If photo not loaded, create a placeholder
+            if not photo_loaded:
+                # Create a simple gray placeholder with text
+                placeholder = Image.new('RGB', (150, 150), color=(220, 220, 220))
+                draw = ImageDraw.Draw(placeholder)
+
+                # Draw student ID text
+                text = f"ID: {row['id']}"
+                draw.text((50, 60), text, fill=(100, 100, 100))
+                draw.text((40, 80), "No Photo", fill=(150, 150, 150))
+
+                st.image(placeholder, width=150, caption=f"Student {row['id']}")
+
+            if distance is not None:
+                st.markdown(f"**🎯 Distance:** {distance:.3f}")
 
+        with col2:
+            if row.get('archived', False):
+                st.markdown("**📦 Archived**")
+            st.markdown(f"**👤 Name:** {row.get('name', 'N/A')}")
+            st.markdown(f"**🆔 Student ID:** {row.get('id', 'N/A')}")
+            st.markdown(f"**📚 Class:** {row.get('class', 'N/A')}")
+            st.markdown(f"**👥 Gender:** {row.get('gender', 'N/A')}")
+            st.markdown(f"**🎂 DOB:** {row.get('dob', 'N/A')}")
+            st.markdown(f"**🩸 Blood Group:** {row.get('blood_group', 'N/A')}")
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+        with col3:
+            st.markdown(f"**📍 Address:** {row.get('address', 'N/A')}")
+            st.markdown(f"**🏘️ Area:** {row.get('area', 'N/A')}")
+            st.markdown(f"**🏙️ City:** {row.get('city', 'N/A')}")
+            st.markdown(f"**📮 Pincode:** {row.get('pincode', 'N/A')}")
+            st.markdown(f"**⭐ Special Talent:** {row.get('special_talent', 'N/A')}")
+
+        # Expandable section for more details
+        with st.expander("👨‍👩‍👧 Parent Details & More"):
+            pcol1, pcol2 = st.columns(2)
+
+            with pcol1:
+                st.markdown("**Parent/Guardian Information:**")
+                st.markdown(f"- **Name:** {row.get('parent_name', 'N/A')}")
+                st.markdown(f"- **Relation:** {row.get('parent_relation', 'N/A')}")
+                st.markdown(f"- **Contact:** {row.get('parent_contact', 'N/A')}")
+                st.markdown(f"- **Occupation:** {row.get('parent_occupation', 'N/A')}")
+                st.markdown(f"- **Email:** {row.get('parent_email', 'N/A')}")
+                st.markdown(f"- **Emergency:** {row.get('emergency_contact', 'N/A')}")
+
+            with pcol2:
+                st.markdown("**Academic Information:**")
+                st.markdown(f"- **Admission Date:** {row.get('admission_date', 'N/A')}")
+                st.markdown(f"- **Previous School:** {row.get('previous_school', 'N/A')}")
+                st.markdown(f"- **Achievements:** {row.get('achievements', 'N/A')}")
+                st.markdown(f"- **Medical Conditions:** {row.get('medical_conditions', 'N/A')}")
+                st.markdown(f"- **Notes:** {row.get('additional_notes', 'N/A')}")
+
+        st.markdown("---")
+
+
+def find_by_face(df, include_archived=False):
+    """
+    Identify a student from any photo (a CCTV still, an event picture).
+    Searches the same gallery as login, but nothing is logged as attendance or activity.
+    """
+    with st.expander("🧑 Find by Face"):
+        picture = st.file_uploader("Photo of the student", type=["jpg", "jpeg", "png"], key="reportsFaceUpload")
+        top_k = st.slider("Closest students to show", 1, 10, 5, key="reportsFaceTopK")
+        if not picture or not st.button("🔎 Find Student", key="reportsFaceSearch"):
+            return
+
+        with st.spinner("Searching the face gallery..."):
+            try:
+                status, results, search_ms = image.find_similar_students(
+                    image.decode_image(picture.getvalue()), k=top_k, include_archived=include_archived
+                )
+            except admission.Busy as busy:
+                st.warning(f"⏳ Face recognition is busy, please try again in {busy.retry_after} s")
+                return
+            except Exception as e:
+                st.error(f"Error during face search: {e}")
+                return
+
+        if status == image.UNREACHABLE:
+            st.error("Could not connect to Dropbox, try again")
+            return
+        if status == image.NO_FACE:
+            st.error("No face detected in the uploaded image")
+            return
+        if not results:
+            st.warning("No registered students to search")
+            return
+
+        st.caption(f"Searched in {search_ms:.1f} ms · a distance under {image.MATCH_THRESHOLD:.3f} counts as a match at login")
+        dbx = get_dropbox_client()
+        for user_id, distance in results:
+            rows = df[df['id'] == int(user_id)]
+            if rows.empty:
+                continue
+            student_card(dbx, rows.iloc[0], distance)
@@ -0,0 +1,172 @@
+"""
+Scatter-gather 1:N search over gallery shards held by worker processes.
+
+Students are assigned to one of N shards by a stable hash of their ID. Each
+shard process holds its rows in its own Gallery and answers searches with its
+local top-k; the coordinator sends the probe to every shard, waits up to
+SHARD_TIMEOUT_MS and merges the answers. Each shard scans 1/N of the gallery
+on its own core, outside the app's GIL.
+
+A shard that has died or misses the deadline is left out of that search (the
+result is marked degraded) and a dead shard is restarted from the
+coordinator's gallery before the next one, so a crash never takes the app down.
+"""
+
+import itertools
+import multiprocessing as mp
+import threading
+import time
+import zlib
+from collections import Counter
+from multiprocessing.connection import wait
+import numpy as np
+from gallery import Gallery
+from config import SHARD_TIMEOUT_MS
+
+
+def shard_of(user_id, shards):
+    """Stable shard number of a student (the same in every process and run)"""
+    return zlib.crc32(str(user_id).encode('utf-8')) % shards
+
+
+def _shard_main(conn, model_name, metric, ids, embeddings):
+    """Shard process loop: apply updates in order, answer searches with the local top-k"""
+    gallery = Gallery.from_arrays(model_name, metric, ids, embeddings)
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+
+        command = message[0]
+        if command == 'search':
+            _, request_id, probe, k = message
+            conn.send((request_id, gallery.search(probe, k)))
+        elif command == 'add':
+            gallery.add(message[1], message[2])
+        elif command == 'remove':
+            gallery.remove(message[1])
+        elif command == 'stop':
+            return
+
+
+class ShardPool:
+    """Coordinator for N shard processes mirroring one Gallery"""
+
+    def __init__(self, gallery, shards):
+        self.gallery = gallery
+        self.shards = shards
+        self._context = mp.get_context('spawn')
+        self._processes = [None] * shards
+        self._conns = [None] * shards
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._stats = Counter()
+        self._latencies = []
+        for shard in range(shards):
+            self._start(shard)
+
+    def _start(self, shard):
+        """Start (or restart) one shard process with its rows of the coordinator's gallery"""
+        rows = [i for i, uid in enumerate(self.gallery.ids) if shard_of(uid, self.shards) == shard]
+        ids = [self.gallery.ids[i] for i in rows]
+        embeddings = self.gallery.embeddings[rows] if rows else np.empty((0, 0), dtype=np.float32)
+
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_shard_main,
+            args=(child_conn, self.gallery.model_name, self.gallery.metric, ids, embeddings),
+            name=f"gallery-shard-{shard}",
+            daemon=True
+        )
+        process.start()
+        child_conn.close()
+        self._processes[shard] = process
+        self._conns[shard] = parent_conn
+
+    def _send(self, shard, message):
+        """Send to one shard; a broken pipe just means it died and will be restarted"""
+        try:
+            self._conns[shard].send(message)
+            return True
+        except (BrokenPipeError, EOFError, OSError):
+            return False
+
+    def _restart_dead(self):
+        for shard, process in enumerate(self._processes):
+            if not process.is_alive():
+                self._stats['restarts'] += 1
+                self._conns[shard].close()
+                self._start(shard)
+
+    def add(self, user_id, embedding):
+        """Mirror Gallery.add; call after adding to the coordinator's gallery"""
+        with self._lock:
+            self._send(shard_of(user_id, self.shards), ('add', str(user_id), np.asarray(embedding, dtype=np.float32)))
+
+    def remove(self, user_id):
+        """Mirror Gallery.remove"""
+        with self._lock:
+            self._send(shard_of(user_id, self.shards), ('remove', str(user_id)))
+
+    def search(self, probe, k=5):
+        """
+        Scatter the probe to every shard and merge the local top-k lists.
+        Returns (results, complete) where complete is False if a shard was left out.
+        """
+        with self._lock:
+            self._restart_dead()
+            start = time.perf_counter()
+            request_id = next(self._ids)
+            probe = np.asarray(probe, dtype=np.float32)
+
+            waiting = {}
+            for shard in range(self.shards):
+                if self._send(shard, ('search', request_id, probe, k)):
+                    waiting[self._conns[shard]] = shard
+
+            merged = []
+            deadline = time.monotonic() + SHARD_TIMEOUT_MS / 1000.0
+            while waiting:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                for conn in wait(list(waiting), timeout=remaining):
+                    try:
+                        reply_id, results = conn.recv()
+                    except (EOFError, OSError):
+                        waiting.pop(conn)  # died mid-search
+                        continue
+                    # Replies to earlier, timed-out searches are dropped
+                    if reply_id == request_id:
+                        merged.extend(results)
+                        waiting.pop(conn)
+
+            complete = not waiting
+            self._stats['searches'] += 1
+            self._stats['degraded'] += not complete
+            self._latencies = (self._latencies + [(time.perf_counter() - start) * 1000])[-500:]
+
+        merged.sort(key=lambda result: result[1])
+        return merged[:k], complete
+
+    def metrics(self):
+        """Searches, degraded (partial) searches, shard restarts and scatter-gather latency"""
+        with self._lock:
+            stats = dict(self._stats)
+            latencies = list(self._latencies)
+            stats['alive'] = sum(process.is_alive() for process in self._processes)
+        stats['shards'] = self.shards
+        if latencies:
+            stats['p50_ms'] = float(np.percentile(latencies, 50))
+            stats['p95_ms'] = float(np.percentile(latencies, 95))
+        return stats
+
+    def shutdown(self, timeout=5):
+        with self._lock:
+            for shard, process in enumerate(self._processes):
+                self._send(shard, ('stop',))
+            for process in self._processes:
+                process.join(timeout)
+                if process.is_alive():
+                    process.terminate()